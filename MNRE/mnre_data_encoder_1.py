@@ -1,25 +1,56 @@
-import control_base as ctrl
 import json
+import math
+import os
+import threading
 from datetime import datetime
 
+try:
+    import control_base as ctrl
+except ImportError:
+    # Inside the acquisition process the control module is passed in explicitly (see attach)
+    ctrl = None
+
 IMEI = "1234561234561234"
 STINTERVAL = 15
 POTP = "34123450"
 COTP = "34123450"
 
-with open('device_mapping.json', 'r') as f:
+MAPPINGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mappings')
+VD_GROUPS = {"inverter": 5, "meter": 2}
+ASN_PREFIX = {"inverter": "ASN_3", "meter": "ASN_2"}
+# Counters are reported as their value at the end of the slot, everything else as the slot mean
+LAST_VALUE_FIELDS = ("total_energy", "today_energy", "import_energy", "export_energy")
+
+with open(os.path.join(MAPPINGS_DIR, 'device_mappings.json'), 'r') as f:
     DEVICE_MAP = json.load(f)
 
-with open('key_mapping.json', 'r') as f:
+with open(os.path.join(MAPPINGS_DIR, 'key_mappings.json'), 'r') as f:
     KEY_MAP = json.load(f)
 
-def get_base_payload(vd_group):
-    now = datetime.now()
+def compile_device_plans(device_map, key_map):
+    """Per-device (source field, MNRE key, use_last) lists, built once from the two mapping files."""
+    plans = {}
+    for device_id, dev_info in device_map.items():
+        dev_type = dev_info["type"]
+        if dev_type not in VD_GROUPS:
+            continue
+        dev_index = dev_info["index"]
+        fields = [(fw_key, f"{mnre_key}{dev_index}", fw_key in LAST_VALUE_FIELDS)
+                  for fw_key, mnre_key in key_map.get(dev_type, {}).items()]
+        plans[device_id] = (VD_GROUPS[dev_type], f"{ASN_PREFIX[dev_type]}{dev_index}", device_id.split(":")[-1], fields)
+    return plans
+
+DEVICE_PLANS = compile_device_plans(DEVICE_MAP, KEY_MAP)
+
+def get_base_payload(vd_group, slot_start=None):
+    # Slot payloads carry the slot's own date and index; without a slot this is the current time
+    now = datetime.now() if slot_start is None else datetime.fromtimestamp(slot_start)
+    index = (now.hour * 60 + now.minute) // STINTERVAL + 1
     return {
         "VD": vd_group,
         "TIMESTAMP": now.strftime("%Y-%m-%d %H:%M:%S"),
-        "MAXINDEX": 96,
-        "INDEX": 1,
+        "MAXINDEX": 1440 // STINTERVAL,
+        "INDEX": index,
         "LOAD": 0,
         "STINTERVAL": STINTERVAL,
         "MSGID": "",
@@ -29,39 +60,76 @@ def get_base_payload(vd_group):
         "COTP": COTP
     }
 
-def encode_dynamic_data():
-    raw_data = ctrl.getAllData()
-    
-    inv_payload = get_base_payload(5)
-    meter_payload = get_base_payload(2)
-    
-    for device_id, device_data in raw_data.items():
-        if device_id in DEVICE_MAP:
-            dev_info = DEVICE_MAP[device_id]
-            dev_type = dev_info["type"]
-            dev_index = dev_info["index"]
-            
-            if dev_type == "inverter":
-                target_payload = inv_payload
-                mapping = KEY_MAP["inverter"]
-                target_payload[f"ASN_3{dev_index}"] = device_id.split(":")[-1]
-            elif dev_type == "meter":
-                target_payload = meter_payload
-                mapping = KEY_MAP["meter"]
-                target_payload[f"ASN_2{dev_index}"] = device_id.split(":")[-1]
-            else:
-                continue
-                
-            for fw_key, fw_val in device_data.items():
-                if fw_key in mapping:
-                    mnre_key = f"{mapping[fw_key]}{dev_index}"
-                    target_payload[mnre_key] = fw_val
+def slot_value(summary, use_last):
+    # None when the slot has no finite value; json.dumps would emit NaN, which is not valid JSON
+    if isinstance(summary, dict):
+        if use_last or summary.get("mean") is None:
+            summary = summary.get("last")
+        else:
+            summary = round(summary["mean"], 3)
+    if isinstance(summary, float) and not math.isfinite(summary):
+        return None
+    return summary
+
+def encode_rollup(record, plans=DEVICE_PLANS):
+    """Inverter and meter payloads for one closed 15-minute rollup record."""
+    payloads = {vd_group: get_base_payload(vd_group, record["start"]) for vd_group in VD_GROUPS.values()}
+    devices = record["devices"]
+    for device_id, (vd_group, asn_key, asn_value, fields) in plans.items():
+        device_data = devices.get(device_id)
+        if device_data is None:
+            continue
+        target_payload = payloads[vd_group]
+        target_payload[asn_key] = asn_value
+        for fw_key, mnre_key, use_last in fields:
+            value = slot_value(device_data.get(fw_key), use_last)
+            if value is not None:
+                target_payload[mnre_key] = value
+    return payloads[VD_GROUPS["inverter"]], payloads[VD_GROUPS["meter"]]
+
+_latest_lock = threading.Lock()
+_latest_record = None
+
+def on_rollup(record):
+    global _latest_record
+    with _latest_lock:
+        _latest_record = record
+
+def attach(rollups, callback=None, ctrl=None):
+    """Feeds the encoder from the acquisition's 15-minute rollups.
+
+    callback([inv_payload, meter_payload, daq_payload]) runs as each slot closes; ctrl is the caller's
+    control module for the DAQ payload, the flat control_base import when omitted.
+    """
+    def handle(record):
+        on_rollup(record)
+        if callback is not None:
+            inv_payload, meter_payload = encode_rollup(record)
+            callback([json.dumps(inv_payload), json.dumps(meter_payload), encode_daq_data(ctrl)])
+    rollups.subscribe("%dm" % STINTERVAL, handle)
+
+def _control(control):
+    control = control or ctrl
+    if control is None:
+        raise RuntimeError("control_base is not importable; pass the control module explicitly")
+    return control
 
+def encode_dynamic_data(record=None, control=None):
+    if record is None:
+        with _latest_lock:
+            record = _latest_record
+    if record is None:
+        # No slot closed yet: send the instantaneous values in the same layout
+        raw_data = _control(control).getAllData()
+        record = {"start": None, "devices": {device_id: {k: {"last": v} for k, v in device_data.items()}
+                                             for device_id, device_data in raw_data.items()}}
+    inv_payload, meter_payload = encode_rollup(record)
     return json.dumps(inv_payload), json.dumps(meter_payload)
 
-def encode_daq_data():
-    dido_data = ctrl.getDIDOData()
-    fault_data = ctrl.getFaultData()
+def encode_daq_data(control=None):
+    control = _control(control)
+    dido_data = control.getDIDOData()
+    fault_data = control.getFaultData()
     payload = get_base_payload(12)
     
     for key, val in dido_data.items():
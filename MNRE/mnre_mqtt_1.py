@@ -1,4 +1,5 @@
 import paho.mqtt.client as mqtt
+import logging
 import ssl
 import time
 from mnre_encoder import encode_dynamic_data, encode_daq_data
@@ -14,6 +15,8 @@ PASSWORD = "YOUR_DEVICE_PASSWORD"
 TOPIC_DATA = f"IIOT-1/{SOLUTION}/{IMEI}/Data"
 TOPIC_ONDEMAND = f"IIOT-1/{SOLUTION}/{IMEI}/Ondemand"
 TOPIC_CONFIG = f"IIOT-1/{SOLUTION}/{IMEI}/Config"
+# Messages paho holds while the broker is unreachable: a day of slots with three payloads each
+MAX_QUEUED = 3 * 96
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -23,7 +26,7 @@ def on_connect(client, userdata, flags, rc):
 def on_message(client, userdata, msg):
     pass
 
-def publish_all_data():
+def create_client():
     client = mqtt.Client(client_id=CLIENT_ID)
     client.username_pw_set(USERNAME, PASSWORD)
     
@@ -31,21 +34,49 @@ def publish_all_data():
     
     client.on_connect = on_connect
     client.on_message = on_message
-    
+    return client
+
+class SlotPublisher:
+    """One long-lived TLS connection for slot payloads; publish() queues and returns at once.
+
+    paho's network thread owns the socket and reconnects on its own. qos 1 messages published while
+    the broker is unreachable wait in paho's queue, bounded by MAX_QUEUED, and go out on reconnect.
+    """
+
+    def __init__(self, max_queued=MAX_QUEUED):
+        self.client = create_client()
+        self.client.max_queued_messages_set(max_queued)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+        self.client.connect_async(BROKER, PORT, 60)
+        self.client.loop_start()
+
+    def publish(self, payloads):
+        for payload in payloads:
+            info = self.client.publish(TOPIC_DATA, payload, qos=1)
+            if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                logging.error(f"MNRE payload dropped: {mqtt.error_string(info.rc)}")
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+def publish_payloads(payloads):
+    # One-shot connection for running this module by hand; the acquisition uses SlotPublisher
+    client = create_client()
     client.connect(BROKER, PORT, 60)
     client.loop_start()
     
-    inv_payload, meter_payload = encode_dynamic_data()
-    
-    client.publish(TOPIC_DATA, inv_payload, qos=1)
-    client.publish(TOPIC_DATA, meter_payload, qos=1)
-    
-    daq_payload = encode_daq_data()
-    client.publish(TOPIC_DATA, daq_payload, qos=1)
+    for payload in payloads:
+        client.publish(TOPIC_DATA, payload, qos=1)
     
     time.sleep(2)
     client.loop_stop()
     client.disconnect()
 
+def publish_all_data(record=None):
+    # record: a closed 15-minute rollup; None uses the latest one the encoder has seen
+    inv_payload, meter_payload = encode_dynamic_data(record)
+    publish_payloads([inv_payload, meter_payload, encode_daq_data()])
+
 if __name__ == "__main__":
     publish_all_data()
\ No newline at end of file
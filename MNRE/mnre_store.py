@@ -0,0 +1,67 @@
+'''Local history store and request queue shared by the MNRE publisher and subscriber'''
+
+import json
+import queue
+import sqlite3
+import threading
+
+DB_FILE = 'local_storage.db'
+
+# Requests from the Ondemand topic; the publisher drains them between real-time pushes
+history_queue = queue.Queue()
+
+INSERT_SQL = '''INSERT OR REPLACE INTO local_data (date_val, index_val, vd_group, payload)
+                VALUES (?, ?, ?, ?)'''
+SELECT_SQL = "SELECT vd_group, payload FROM local_data WHERE date_val=? AND index_val=? ORDER BY vd_group"
+
+class HistoryStore:
+    """One long-lived SQLite connection in WAL mode for the History Data Push Mode.
+
+    local_data is a WITHOUT ROWID table clustered on (date_val, index_val, vd_group), so the
+    primary key is a covering index for history lookups: one b-tree seek returns the payloads.
+    The SQL strings are fixed, so sqlite3 reuses its prepared statements.
+    """
+
+    def __init__(self, path=DB_FILE):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._setup()
+
+    def _setup(self):
+        row = self.conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='local_data'").fetchone()
+        with self.conn:
+            if row is not None and "WITHOUT ROWID" not in row[0].upper():
+                # Tables from the old per-call setup are rebuilt once into the clustered layout
+                self.conn.execute("ALTER TABLE local_data RENAME TO local_data_old")
+                row = None
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS local_data
+                                 (date_val INT, index_val INT, vd_group INT, payload TEXT,
+                                  PRIMARY KEY(date_val, index_val, vd_group)) WITHOUT ROWID''')
+            old = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='local_data_old'").fetchone()
+            if old is not None:
+                self.conn.execute('''INSERT OR REPLACE INTO local_data (date_val, index_val, vd_group, payload)
+                                     SELECT date_val, index_val, vd_group, payload FROM local_data_old''')
+                self.conn.execute("DROP TABLE local_data_old")
+
+    def save(self, date_val, index_val, vd_group, payload_dict):
+        with self.lock, self.conn:
+            self.conn.execute(INSERT_SQL, (date_val, index_val, vd_group, json.dumps(payload_dict)))
+
+    def save_many(self, rows):
+        # rows: (date_val, index_val, vd_group, payload_dict); one transaction per publish cycle
+        with self.lock, self.conn:
+            self.conn.executemany(INSERT_SQL, [(d, i, vd, json.dumps(p)) for d, i, vd, p in rows])
+
+    def fetch(self, date_val, index_val):
+        with self.lock:
+            rows = self.conn.execute(SELECT_SQL, (date_val, index_val)).fetchall()
+        return [json.loads(payload) for _, payload in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def queue_history_request(date_val, index_val):
+    history_queue.put({"DATE": date_val, "INDEX": index_val})
@@ -4,73 +4,49 @@ https://gemini.google.com/share/46969f017cee'''
 
 import paho.mqtt.client as mqtt
 import json
+import queue
 import ssl
 import time
-import sqlite3
 from datetime import datetime
 
+import mnre_store
+import subscribe
+
 CONFIG_FILE = 'config.json'
-DB_FILE = 'local_storage.db'
-
-def setup_database():
-    """Initializes local SQLite database for History Data Push Mode"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS local_data 
-                 (date_val INT, index_val INT, vd_group INT, payload TEXT, 
-                  PRIMARY KEY(date_val, index_val, vd_group))''')
-    conn.commit()
-    conn.close()
-
-def save_to_db(date_val, index_val, vd_group, payload_dict):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    payload_str = json.dumps(payload_dict)
-    c.execute('''INSERT OR REPLACE INTO local_data (date_val, index_val, vd_group, payload) 
-                 VALUES (?, ?, ?, ?)''', (date_val, index_val, vd_group, payload_str))
-    conn.commit()
-    conn.close()
+HISTORY_GAP = 0.5
 
 def load_config():
     with open(CONFIG_FILE, 'r') as f:
         return json.load(f)
 
-def clear_history_queue():
-    config = load_config()
-    config['history_queue'] = []
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=4)
-
-def process_history_queue(client, publish_topic):
-    """Checks config for missing data requests and publishes them from SQLite"""
-    config = load_config()
-    queue = config.get('history_queue', [])
-    
-    if not queue:
-        return
-
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-
-    for req in queue:
-        req_date = req['DATE']
-        req_index = req['INDEX']
-        
-        print(f"Processing missing data request for DATE: {req_date}, INDEX: {req_index}")
-        
-        c.execute("SELECT payload FROM local_data WHERE date_val=? AND index_val=?", (req_date, req_index))
-        rows = c.fetchall()
-        
-        for row in rows:
-            history_payload = json.loads(row[0])
-            # Set LOAD to 1 or whatever value the server requires to identify historical data
-            history_payload["LOAD"] = 1 
-            client.publish(publish_topic, json.dumps(history_payload), qos=1)
-            print(f"Published historical data for VD: {history_payload['VD']}")
-            time.sleep(0.5)
-
-    conn.close()
-    clear_history_queue() # Clear queue after processing
+def process_history_request(client, publish_topic, store, req):
+    """Publishes the stored payloads for one missing-data request"""
+    req_date = req['DATE']
+    req_index = req['INDEX']
+
+    print(f"Processing missing data request for DATE: {req_date}, INDEX: {req_index}")
+
+    for history_payload in store.fetch(req_date, req_index):
+        # Set LOAD to 1 or whatever value the server requires to identify historical data
+        history_payload["LOAD"] = 1
+        client.publish(publish_topic, json.dumps(history_payload), qos=1)
+        print(f"Published historical data for VD: {history_payload['VD']}")
+        time.sleep(HISTORY_GAP)
+
+def serve_history_until(client, publish_topic, store, deadline):
+    """Answers history requests as they arrive until the next real-time push is due"""
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        try:
+            req = mnre_store.history_queue.get(timeout=remaining)
+        except queue.Empty:
+            return
+        try:
+            process_history_request(client, publish_topic, store, req)
+        except Exception as e:
+            print(f"History request {req} failed: {e}")
 
 # ... [Keep the get_meter_payload, get_inverter_payload functions from the previous response] ...
 def get_base_payload(config, vd_group, index_val, date_val, now_str):
@@ -88,18 +64,24 @@ def get_base_payload(config, vd_group, index_val, date_val, now_str):
         "COTP": config['cotp']
     }
 
-if __name__ == "__main__":
-    setup_database()
-    config = load_config()
-    
+def create_client(config):
+    """One long-lived client for both directions; the subscriber's handlers run on its network loop"""
     client_id = f"d:{config['imei']}${config['solution']}$27"
     username = f"{config['imei']}${config['solution']}$27"
-    
-    client = mqtt.Client(client_id)
+
+    client = mqtt.Client(client_id, userdata={'config': config})
     client.username_pw_set(username, password="your_password")
     client.tls_set(ca_certs=config['ca_cert'], certfile=config['client_cert'],
                    keyfile=config['client_key'], tls_version=ssl.PROTOCOL_TLSv1_2)
+    client.on_connect = subscribe.on_connect
+    client.on_message = subscribe.on_message
+    return client
 
+if __name__ == "__main__":
+    store = mnre_store.HistoryStore()
+    config = load_config()
+
+    client = create_client(config)
     client.connect(config['broker_url'], config['broker_port'], 60)
     client.loop_start()
 
@@ -110,6 +92,7 @@ if __name__ == "__main__":
     try:
         while True:
             current_config = load_config()
+            cycle_start = time.monotonic()
             now = datetime.now()
             now_str = now.strftime("%Y-%m-%d %H:%M:%S")
             date_val = int(now.strftime("%y%m%d"))
@@ -122,26 +105,25 @@ if __name__ == "__main__":
             # ... Add inverter specific data here
 
             # Save to Local SQLite Database (History Mode Provision)
-            save_to_db(date_val, current_index, 2, meter_data)
-            save_to_db(date_val, current_index, 5, inverter_data)
+            store.save_many([(date_val, current_index, 2, meter_data),
+                             (date_val, current_index, 5, inverter_data)])
             
             # Publish Real-time Data
             client.publish(publish_topic, json.dumps(meter_data), qos=1)
             client.publish(publish_topic, json.dumps(inverter_data), qos=1)
             print(f"Published real-time data for INDEX: {current_index}")
             
-            # Check and process any requested missing history data
-            process_history_queue(client, publish_topic)
-            
             current_index += 1
             if current_index > (1440 / current_config['stinterval']):
                 current_index = 1 # Reset index at midnight
             
-            print(f"Sleeping for {current_config['stinterval']} minutes...")
-            time.sleep(current_config['stinterval'] * 60)
+            print(f"Next push in {current_config['stinterval']} minutes...")
+            # Missing-data requests are served while waiting instead of once per interval
+            serve_history_until(client, publish_topic, store, cycle_start + current_config['stinterval'] * 60)
             
     except KeyboardInterrupt:
         print("Stopping publisher...")
     finally:
         client.loop_stop()
-        client.disconnect()
\ No newline at end of file
+        client.disconnect()
+        store.close()
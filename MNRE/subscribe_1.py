@@ -2,9 +2,9 @@
 https://gemini.google.com/share/46969f017cee'''
 
 
-import paho.mqtt.client as mqtt
 import json
-import ssl
+
+import mnre_store
 
 CONFIG_FILE = 'config.json'
 
@@ -19,11 +19,8 @@ def update_config_key(key, value):
         json.dump(config, f, indent=4)
 
 def queue_history_request(date_val, index_val):
-    """Adds a missing data request to the queue for the publisher to handle."""
-    config = load_config()
-    config['history_queue'].append({"DATE": date_val, "INDEX": index_val})
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=4)
+    """Hands a missing data request to the publisher on the shared client."""
+    mnre_store.queue_history_request(date_val, index_val)
 
 def on_connect(client, userdata, flags, rc):
     config = userdata['config']
@@ -90,20 +87,3 @@ def on_message(client, userdata, msg):
 
     except json.JSONDecodeError:
         print("Invalid JSON received.")
-
-if __name__ == "__main__":
-    config = load_config()
-    client_id = f"d:{config['imei']}${config['solution']}$27"
-    username = f"{config['imei']}${config['solution']}$27"
-    
-    client = mqtt.Client(client_id, userdata={'config': config})
-    client.username_pw_set(username, password="your_password")
-    client.tls_set(ca_certs=config['ca_cert'],
-                   certfile=config['client_cert'],
-                   keyfile=config['client_key'],
-                   tls_version=ssl.PROTOCOL_TLSv1_2)
-
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.connect(config['broker_url'], config['broker_port'], 60)
-    client.loop_forever()
\ No newline at end of file
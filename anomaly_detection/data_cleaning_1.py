@@ -29,6 +29,14 @@ class SolarDataCleaner:
         print("Loaded rows:", len(df))
         return df
 
+    def load_archive(self, archive_dir, start, end, columns=None, device_ids=None):
+        # Daily Parquet archive: already flat, so extract_json is not needed
+        from database import archive
+
+        df = archive.readColumns(archive_dir, start, end, columns, device_ids).to_pandas()
+        print("Loaded rows:", len(df))
+        return df
+
     # --------------------------------------------------
     # STEP 2: EXTRACT JSON
     # --------------------------------------------------
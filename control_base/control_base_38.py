@@ -5,6 +5,8 @@ import time
 from control import error_reporting as err
 from control import control_der as ctrl_der
 from modbus_master import modbusmasterapi as mbus
+from utils import fastlog
+from utils import scheduler
 import platform
 import sys
 from pymodbus.payload import BinaryPayloadDecoder
@@ -16,6 +18,8 @@ import json
 import path_config
 import datetime
 import os
+import queue
+import threading
 
 default_Ts = 3
 default_Ki = 0.0001
@@ -53,6 +57,8 @@ component_data = {
     "cell_voltage": []
 }
 
+log = fastlog.getLogger("control_base")
+
 path_config.path_cfg = path_config.pathConfig()
 CONTROL_JSON_PATH = os.path.join(path_config.path_cfg.base_path, 'control', 'control.json')
 COST_JSON_PATH = os.path.join(path_config.path_cfg.base_path, 'control', 'cost.json')
@@ -238,7 +244,7 @@ class dataModel:
             else:
                 self.value = tmp + self.addition_factor
         except Exception as e:
-            logging.warning(str(e) + str(" block : ") + str(self.block_num) + str(" offset : ") + str(self.offset))
+            log.warning("%s block : %s offset : %s", e, self.block_num, self.offset, every=60)
 
     def decodeFactor(self):
         self.factor_value = -1
@@ -252,7 +258,7 @@ class dataModel:
                 )
                 self.factor_value = decoded_factor.decode_16bit_int()
         except Exception as e:
-            logging.warning(str(e) + str(data))
+            log.warning("%s %s", e, data, every=60)
 
     def encode(self):
         data = self.value - self.addition_factor
@@ -263,10 +269,9 @@ class dataModel:
             payload = decoded.build()
             return payload
         elif self.factor_type == factorType.mf_value:
-            print("---- into encode by m_f factor ----")
             decoded = BinaryPayloadBuilder()
             tmp = int(data / self.factor_value)
-            print("value after m_f factor",tmp)
+            log.debug("value after m_f factor %s", tmp)
             getattr(decoded, self.decoderFunc)(tmp)
             payload = decoded.build()
             return payload
@@ -318,6 +323,11 @@ class systemDevice:
     phase :str="A"
     connected_to : str = ""
     minimum_limit : int = 0
+    # Comm-layer health, updated by the acquisition layer after every read attempt
+    last_read_ok : float = 0.0
+    reads_ok : int = 0
+    read_errors : int = 0
+    consecutive_errors : int = 0
 
     def __init__(self, devicetype, commtype, cfg,rated_power=3800,storage_capacity=0) -> None:
         self.device_type = devicetype
@@ -487,8 +497,7 @@ class systemDevice:
         pass
 
     def encodeWrite(self, msg_json:dict):
-        print("----into encodeWrite----")
-        print("msg_json into encodeWrite",msg_json)
+        log.debug("encodeWrite device %s msg %s", self.device_id, msg_json)
         if msg_json["param"] == "active_power":
             if(self.control_data.poweer_lt.model_present):
                 self.control_data.poweer_lt.value = eval(msg_json['value'])
@@ -503,9 +512,8 @@ class systemDevice:
                 self.writeDataToRegisters( mbus.bytes_to_registers(payload),self.control_data.poweer_lt.en_start_addr + self.control_data.poweer_lt.en_offset)
                 self.writeDataToRegisters( mbus.bytes_to_registers(self.control_data.poweer_lt.encode()),self.control_data.poweer_lt.batch_start_addr + self.control_data.poweer_lt.offset)
             elif(self.control_data.power_pct_stpt.model_present):
-                print("----pct_stpt----")
                 self.control_data.power_pct_stpt.value = round(eval(msg_json['value'])*100/self.rated_power)
-                print("pct_stpt is : ",self.control_data.power_pct_stpt.value)
+                log.debug("pct_stpt is : %s", self.control_data.power_pct_stpt.value)
                 self.writeDataToRegisters( mbus.bytes_to_registers(self.control_data.power_pct_stpt.encode()),self.control_data.power_pct_stpt.batch_start_addr + self.control_data.power_pct_stpt.offset)
                 decoded = BinaryPayloadBuilder()
                 decoded.add_16bit_uint(True)
@@ -513,11 +521,9 @@ class systemDevice:
                 self.writeDataToRegisters( mbus.bytes_to_registers(payload),self.control_data.power_pct_stpt.en_start_addr + self.control_data.power_pct_stpt.en_offset)
         
         elif msg_json["param"] == "reactive_kvar":
-            print("----into reactive encodeWrite----")
-            print("msg_json into reactive encodeWrite",msg_json)
             if self.control_data.reactive_stpt.model_present:
                 self.control_data.reactive_stpt.value = int(eval(msg_json['value']))
-                print(f"reactive_stpt value is {self.control_data.reactive_stpt.value}")
+                log.debug("reactive_stpt value is %s", self.control_data.reactive_stpt.value)
                 self.writeDataToRegisters(mbus.bytes_to_registers(self.control_data.reactive_stpt.encode()), self.control_data.reactive_stpt.batch_start_addr + self.control_data.reactive_stpt.offset)
                 decoded = BinaryPayloadBuilder()
                 decoded.add_16bit_uint(0xA2)
@@ -612,6 +618,17 @@ class systemDevice:
             mbus.writeModbusData(self, address, data)
 
 device_list = []
+device_groups = {}
+
+def deviceRole(device_type, connected_to=None):
+    if device_type == deviceType.meter and connected_to not in (None, ""):
+        return "meter:" + deviceType(connected_to).name
+    return deviceType(device_type).name
+
+def getDeviceGroup(device_type, connected_to=None):
+    if device_groups:
+        return device_groups.get(deviceRole(device_type, connected_to), [])
+    return [d for d in device_list if d.device_type == device_type and (connected_to is None or d.connected_to == connected_to)]
 
 class operatingDetails:
     system_operating_mode = None
@@ -672,12 +689,11 @@ class operatingDetails:
         self.grid_return_time = 0
 
     def controlGridPF(self):
-        print("---- into controlGridPF ----")
         if system_operating_details.aggDG > 0:
             is_dg_on = True
-            print(f"dg is on and power of dg is {system_operating_details.aggDG}, turning off controlling reactive power ")
+            log.debug("dg is on and power of dg is %s, turning off controlling reactive power", system_operating_details.aggDG)
         else:
-            print("DG is off")
+            log.debug("DG is off")
             is_dg_on = False
 
         PF_TARGET = 0.95
@@ -696,59 +712,59 @@ class operatingDetails:
 
         P = self.filtered_P / 1000
         Q = self.filtered_Q / 1000
-        print(f"aggGrid is {P} KW and aggGrid_Q is {Q} kvar")
+        log.debug("aggGrid is %s KW and aggGrid_Q is %s kvar", P, Q)
 
         if P >= 0:
             pf_target_signed = PF_TARGET
         else:
             pf_target_signed = -PF_TARGET 
 
-        print(f"PF target based on direction is {pf_target_signed}")
+        log.debug("PF target based on direction is %s", pf_target_signed)
 
         if abs(P) < 1:
-            print(f"aggGrid is less than 0 {P} setting target_q_at_meter as 0")
+            log.debug("aggGrid is less than 0 %s setting target_q_at_meter as 0", P)
             target_q_at_meter = 0
         
         if abs(abs(self.aggGrid_PF) - pf_target_signed) <= PF_TOL:
-            print(f"power_factor at grid is already at Target self.aggGrid_PF is {self.aggGrid_PF} so it will return as it is")
+            log.debug("power_factor at grid is already at Target self.aggGrid_PF is %s so it will return as it is", self.aggGrid_PF)
             return
 
         target_q_at_meter = P * TAN_PHI_TARGET
-        print(f"target reactive power at meter = {P} * {TAN_PHI_TARGET} = {target_q_at_meter}")
+        log.debug("target reactive power at meter = %s * %s = %s", P, TAN_PHI_TARGET, target_q_at_meter)
 
         q_error = target_q_at_meter - Q
-        print(f"q_error = target_q_at_meter {target_q_at_meter} - aggGrid_Q {Q} = {q_error}")
+        log.debug("q_error = target_q_at_meter %s - aggGrid_Q %s = %s", target_q_at_meter, Q, q_error)
 
         q_correction = KP * q_error
-        print(f"q_correction is 0.5 * q_error = {q_correction}")
+        log.debug("q_correction is %s * q_error = %s", KP, q_correction)
 
         solar_devices = [d for d in device_list if d.device_type == deviceType.solar] 
         num_inv = len(solar_devices) if solar_devices else 1
-        print(f"Total number of inverters {num_inv}")
+        log.debug("Total number of inverters %s", num_inv)
 
         q_per_inv = q_correction / num_inv
-        print(f"q_per_inv is {q_per_inv}")
+        log.debug("q_per_inv is %s", q_per_inv)
 
         for device in solar_devices:
             current_inv_q = 0
 
             if hasattr(device.measured_data, 'reactive_power') and device.measured_data.reactive_power.model_present:
                 current_inv_q = device.measured_data.reactive_power.value / 1000
-                print(f"current inv reactive power is {current_inv_q}")
+                log.debug("current inv reactive power is %s", current_inv_q)
 
             delta_q = max(min(q_per_inv, MAX_STEP), -MAX_STEP)
-            print(f"delta_q is {delta_q}")
+            log.debug("delta_q is %s", delta_q)
 
             new_q_stpt = current_inv_q + delta_q
-            print(f"new_q_stpt is {new_q_stpt}")
+            log.debug("new_q_stpt is %s", new_q_stpt)
 
             new_q_stpt = max(min(new_q_stpt, 55), -55)
             
             if is_dg_on:
                 new_q_stpt = 0
-                print("Setting reactive power 0")
+                log.debug("Setting reactive power 0")
 
-            print(f"final q_stpt after all calculations is {new_q_stpt}")
+            log.debug("final q_stpt after all calculations is %s", new_q_stpt)
             device.encodeWrite({"param": "reactive_kvar", "value": str(new_q_stpt)})
 
     def controlFuncConstPower(self):
@@ -759,7 +775,7 @@ class operatingDetails:
                 - system_operating_details.ref
             )
         ),self.storage_max),self.storage_min)
-        print("in cosnt power",system_operating_details.load,system_operating_details.aggPV,system_operating_details.ref,system_operating_details.storage_max,system_operating_details.storage_min)
+        log.debug("in const power %s %s %s %s %s", system_operating_details.load, system_operating_details.aggPV, system_operating_details.ref, system_operating_details.storage_max, system_operating_details.storage_min)
 
     def controlPVChargeOnly(self):
         self.storage_stpt = (-system_operating_details.aggPV)
@@ -821,77 +837,65 @@ class operatingDetails:
         if(self.agg_batt_rated > 0):
             self.storage_stpt = max(min(tmp - self.aggPV,self.agg_batt_rated),-self.agg_batt_rated)
             if(self.storage_stpt <= -self.agg_batt_rated):
-                print("tmp : ",tmp,self.aggLoad)
+                log.debug("tmp : %s %s", tmp, self.aggLoad)
                 self.pv_stpt = min(tmp - self.storage_stpt,self.agg_pv_rated)
         else:
             self.pv_stpt = max(min(self.agg_pv_rated,self.aggDG + self.aggPV - self.dg_lim),0)
 
     def dg_pv_sync_func(self):
-        print("---- into dg_pv_sync_func ----")
-        
         if self.grid_state != gridState.off:
-            print(f"[DEBUG] Grid is ON. Checking transition timer. self.grid_return_time: {self.grid_return_time}")
+            log.debug("Grid is ON. Checking transition timer. self.grid_return_time: %s", self.grid_return_time)
             
             if self.grid_return_time == 0:
                 self.grid_return_time = time.time()
-                print(f"[DEBUG] Grid detected! Starting safe transition delay at {self.grid_return_time}")
+                log.debug("Grid detected! Starting safe transition delay at %s", self.grid_return_time)
 
             elapsed_time = time.time() - self.grid_return_time
             safe_delay = 60
-            print(f"[DEBUG] Elapsed time since grid return: {elapsed_time:.2f}s / {safe_delay}s")
+            log.debug("Elapsed time since grid return: %.2fs / %ss", elapsed_time, safe_delay)
 
             if elapsed_time > safe_delay and self.aggDG <= 1000:
-                print(f"[DEBUG] Transition complete! DG is at {self.aggDG}W (<= 1000W). Unleashing PV to max rated: {self.agg_pv_rated}W")
+                log.debug("Transition complete! DG is at %sW (<= 1000W). Unleashing PV to max rated: %sW", self.aggDG, self.agg_pv_rated)
                 self.pv_stpt = self.agg_pv_rated
                 return
             else:
-                print(f"[DEBUG] Still in transition period. Elapsed: {elapsed_time:.2f}s, DG: {self.aggDG}W. Proceeding to protection math.")
+                log.debug("Still in transition period. Elapsed: %.2fs, DG: %sW. Proceeding to protection math.", elapsed_time, self.aggDG)
                 pass
         else:
             if self.grid_return_time != 0:
-                print("[DEBUG] Grid is OFF. Resetting transition timer to 0.")
+                log.debug("Grid is OFF. Resetting transition timer to 0.")
             self.grid_return_time = 0
 
         margin = 2000
         ramp_up = 1000
         deadband = 1000
-        print(f"[DEBUG] Constants - Margin: {margin}W, Ramp Up: {ramp_up}W, Deadband: {deadband}W")
 
         if not hasattr(self, "pv_stpt"):
             self.pv_stpt = 0
-            print("[DEBUG] pv_stpt attribute not found, initialized to 0W")
+            log.debug("pv_stpt attribute not found, initialized to 0W")
 
-        print(f"[DEBUG] Current DG Power (aggDG): {self.aggDG}W")
-        print(f"[DEBUG] DG Limit (dg_lim): {self.dg_lim}W")
-        print(f"[DEBUG] Current PV Setpoint (pv_stpt): {self.pv_stpt}W")
+        log.debug("aggDG: %sW, dg_lim: %sW, pv_stpt: %sW", self.aggDG, self.dg_lim, self.pv_stpt)
 
         if self.aggDG <= 10000: 
-            print(f"[DEBUG] EMERGENCY TRIP TRIGGERED! DG Power ({self.aggDG}W) <= 10000W. Setting PV to 0W instantly.")
+            log.warning("EMERGENCY TRIP TRIGGERED! DG Power (%sW) <= 10000W. Setting PV to 0W instantly.", self.aggDG, every=30)
             self.pv_stpt = 0
             return
 
         estimated_load = self.aggDG + self.aggPV
-        print(f"[DEBUG] Math: estimated_load = aggDG ({self.aggDG}W) + aggPV ({self.aggPV}W) = {estimated_load}W")
-        
         pv_allowed_raw = estimated_load - self.dg_lim - margin
-        print(f"[DEBUG] Math: pv_allowed_raw = estimated_load ({estimated_load}W) - dg_lim ({self.dg_lim}W) - margin ({margin}W) = {pv_allowed_raw}W")
-        
         pv_allowed = max(min(pv_allowed_raw, self.agg_pv_rated), 0)
-        print(f"[DEBUG] Math: Clamped pv_allowed (Min: 0, Max: {self.agg_pv_rated}W) = {pv_allowed}W")
+        log.debug("estimated_load %sW, pv_allowed_raw %sW (margin %sW), pv_allowed %sW", estimated_load, pv_allowed_raw, margin, pv_allowed)
 
         diff = pv_allowed - self.pv_stpt
-        print(f"[DEBUG] Math: diff = pv_allowed ({pv_allowed}W) - current pv_stpt ({self.pv_stpt}W) = {diff}W")
 
         if diff < -deadband:
-            print(f"[DEBUG] diff ({diff}W) < -deadband ({-deadband}W). FAST DROP initiated.")
             self.pv_stpt = pv_allowed
-            print(f"[DEBUG] New pv_stpt set directly to {self.pv_stpt}W")
+            log.debug("diff %sW < -%sW. FAST DROP, pv_stpt set to %sW", diff, deadband, self.pv_stpt)
         elif diff > deadband:
-            print(f"[DEBUG] diff ({diff}W) > deadband ({deadband}W). SLOW RAMP UP initiated.")
             self.pv_stpt = min(self.pv_stpt + ramp_up, pv_allowed)
-            print(f"[DEBUG] New pv_stpt incremented by {ramp_up}W to {self.pv_stpt}W")
+            log.debug("diff %sW > %sW. SLOW RAMP UP, pv_stpt incremented to %sW", diff, deadband, self.pv_stpt)
         else:
-            print(f"[DEBUG] diff ({diff}W) is within deadband (+/- {deadband}W). Holding current pv_stpt at {self.pv_stpt}W.")
+            log.debug("diff %sW within deadband (+/- %sW). Holding pv_stpt at %sW", diff, deadband, self.pv_stpt)
 
     def export_lim_export_priority_func(self):
         self.storage_stpt = min(0,self.aggBatt + min(0,self.ref+self.aggGrid))
@@ -974,19 +978,16 @@ def SetController(Kp,Ki,Ts):
     system_operating_details.Ts = Ts
 
 def getAgg(device_type):
-    print("----into getAgg calculating aggPV and agg_pv_rated----")
     tmp = 0
     agg_power = 0
     agg_capacity = 0
-    i = 0
-    for device in device_list:
-        if device.device_type == device_type:
-            if hasattr(device.measured_data, 'total_power'):
-                tmp += device.measured_data.total_power.value
-            agg_power += device.rated_power
-            if device.device_type == deviceType.battery:
-                agg_capacity += device.storage_capacity
-    print("aggPV and agg_pv_rated are : ", tmp, agg_power)
+    for device in getDeviceGroup(device_type):
+        if hasattr(device.measured_data, 'total_power'):
+            tmp += device.measured_data.total_power.value
+        agg_power += device.rated_power
+        if device.device_type == deviceType.battery:
+            agg_capacity += device.storage_capacity
+    log.debug("getAgg %s : power %s rated %s", device_type, tmp, agg_power)
     if device_type == deviceType.battery:
         return tmp, agg_power, agg_capacity
     else:
@@ -1005,14 +1006,105 @@ def setModeSrc(src : str):
     elif(src == "direct"):
         system_operating_details.mode_src = modeSrc.direct_comm
 
+# Scheduler task woken when a command arrives
+CONTROL_TASK = "ControlLoop"
+# Only the latest command matters, so at most one waits for the loop however long it is off
+command_queue = queue.Queue(maxsize=1)
+_command_lock = threading.Lock()
+active_control = None
+command_stats = {"received": 0, "rejected": 0, "applied": 0, "last_latency": 0.0, "max_latency": 0.0}
+_pending_command_ts = None
+_persist_cond = threading.Condition()
+_persist_message = None
+_persist_thread = None
+
+def _persistControl():
+    global _persist_message
+    while True:
+        with _persist_cond:
+            while _persist_message is None:
+                _persist_cond.wait()
+            message, _persist_message = _persist_message, None
+        # Only the newest command is kept; control.json is read back on restart
+        tmp_path = CONTROL_JSON_PATH + ".tmp"
+        try:
+            with open(tmp_path, 'w') as control_file:
+                control_file.write(message)
+            os.replace(tmp_path, CONTROL_JSON_PATH)
+        except OSError as e:
+            log.error("Unable to persist control.json: %s", e, every=60)
+
+def persistControlAsync(message : str):
+    global _persist_message, _persist_thread
+    with _persist_cond:
+        _persist_message = message
+        if _persist_thread is None:
+            _persist_thread = threading.Thread(target=_persistControl, name="ControlPersist", daemon=True)
+            _persist_thread.start()
+        _persist_cond.notify()
+
 def processMQTTMessage(message : str):
-    print("")
-    print("==================")
-    print("")
-    with(open(CONTROL_JSON_PATH,'w') as control_file):
-        control_file.write(message)
-    print("====================")
-    print("")
+    # Validated commands go straight to the control loop; the file write is off the subscriber thread
+    try:
+        control_json = json.loads(message)
+    except (json.JSONDecodeError, ValueError):
+        control_json = None
+    if not isinstance(control_json, dict) or not isinstance(control_json.get("op_details", {}), dict):
+        command_stats["rejected"] += 1
+        log.warning("Rejected control command: %s", message[:200])
+        return False
+    command_stats["received"] += 1
+    received = time.monotonic()
+    with _command_lock:
+        try:
+            # An unapplied command is replaced; its receive time is kept for the actuation latency
+            received, _ = command_queue.get_nowait()
+        except queue.Empty:
+            pass
+        command_queue.put_nowait((received, control_json))
+    persistControlAsync(message)
+    scheduler.shared_scheduler.wake(CONTROL_TASK)
+    log.info("Control command queued: %s", fastlog.lazyJson(control_json.get("op_details", {})))
+    return True
+
+def loadControlJson():
+    try:
+        with(open(CONTROL_JSON_PATH) as control_file):
+            return json.load(control_file)
+    except (json.JSONDecodeError, FileNotFoundError):
+        log.warning("Control JSON not found or invalid. Defaulting JSON limits.", every=300)
+        return {}
+
+def drainCommands():
+    # Latest command wins; its receive time is kept for the actuation latency
+    global active_control, _pending_command_ts
+    if active_control is None:
+        active_control = loadControlJson()
+    while True:
+        try:
+            received, control_json = command_queue.get_nowait()
+        except queue.Empty:
+            break
+        active_control = control_json
+        if _pending_command_ts is None:
+            _pending_command_ts = received
+    return active_control
+
+def recordActuation():
+    global _pending_command_ts
+    if _pending_command_ts is None:
+        return
+    latency = time.monotonic() - _pending_command_ts
+    _pending_command_ts = None
+    command_stats["applied"] += 1
+    command_stats["last_latency"] = round(latency, 4)
+    command_stats["max_latency"] = max(command_stats["max_latency"], round(latency, 4))
+    log.info("Control command actuated in %.3fs", latency)
+
+def getCommandStats():
+    stats = dict(command_stats)
+    stats["queued"] = command_queue.qsize()
+    return stats
 
 def startLiveData():
     system_operating_details.live_data = True
@@ -1025,49 +1117,36 @@ def stopLiveData():
     print("live data stopped")
 
 def getActiveControlMode():
-    print("----into getActiveControlMode----")
-    
-    print("Setting Control Mode to: dg_pv_sync (Running Continuously)")
     system_operating_details.system_operating_mode = systemOperatingModes.dg_pv_sync
     system_operating_details.controlFunc = system_operating_details.dg_pv_sync_func
     system_operating_details.ref = system_operating_details.dg_lim
 
-    try:
-        with(open(CONTROL_JSON_PATH) as control_file):
-            control_json = json.load(control_file)
-            
-            op_details = control_json.get("op_details", {})
-            
-            system_operating_details.limit_export = op_details.get("Limit_export", False)
-            
-            if "batt_to_load" in op_details:
-                system_operating_details.storage_max = op_details["batt_to_load"] * system_operating_details.agg_batt_rated
-            else:
-                system_operating_details.storage_max = 0
-                
-            if "storage_min" in op_details:
-                system_operating_details.storage_min = op_details["storage_min"] * system_operating_details.agg_batt_rated / 100
-            else:
-                 system_operating_details.storage_min = -system_operating_details.agg_batt_rated
-                 
-            if "storage_max" in op_details:
-                system_operating_details.storage_max = op_details["storage_max"] * system_operating_details.agg_batt_rated / 100
-            else:
-                system_operating_details.storage_max = system_operating_details.agg_batt_rated
-                
-            if "solar_max" in op_details:
-                system_operating_details.solar_max = op_details["solar_max"] * system_operating_details.agg_pv_rated / 100
-            else:
-                system_operating_details.solar_max  = system_operating_details.agg_pv_rated  
-                
-    except (json.JSONDecodeError, FileNotFoundError):
-        print("Control JSON not found or invalid. Defaulting JSON limits.")
-        system_operating_details.limit_export = False
+    control_json = drainCommands()
+    op_details = control_json.get("op_details", {})
+
+    system_operating_details.limit_export = op_details.get("Limit_export", False)
+
+    if "batt_to_load" in op_details:
+        system_operating_details.storage_max = op_details["batt_to_load"] * system_operating_details.agg_batt_rated
+    else:
+        system_operating_details.storage_max = 0
+
+    if "storage_min" in op_details:
+        system_operating_details.storage_min = op_details["storage_min"] * system_operating_details.agg_batt_rated / 100
+    else:
         system_operating_details.storage_min = -system_operating_details.agg_batt_rated
+
+    if "storage_max" in op_details:
+        system_operating_details.storage_max = op_details["storage_max"] * system_operating_details.agg_batt_rated / 100
+    else:
         system_operating_details.storage_max = system_operating_details.agg_batt_rated
-        system_operating_details.solar_max = system_operating_details.agg_pv_rated
 
-    print(f"Active func confirmed as: {system_operating_details.controlFunc}")
+    if "solar_max" in op_details:
+        system_operating_details.solar_max = op_details["solar_max"] * system_operating_details.agg_pv_rated / 100
+    else:
+        system_operating_details.solar_max  = system_operating_details.agg_pv_rated
+
+    log.debug("Active func confirmed as: %s", system_operating_details.controlFunc)
 
 def getAllData():
     data = {}
@@ -1141,15 +1220,53 @@ def getLivePower():
                 live_power_data[device_id_str] = model.value
     return live_power_data
 
+def getDeviceFaultWords(device):
+    device_faults = {}
+    for param in fault_data:
+        if hasattr(device.measured_data, param):
+            model = getattr(device.measured_data, param)
+            if model is not None and model.model_present:
+                device_faults[param] = model.value
+    return device_faults
+
+def recordReadResult(device, ok):
+    if ok:
+        device.last_read_ok = time.time()
+        device.reads_ok += 1
+        device.consecutive_errors = 0
+    else:
+        device.read_errors += 1
+        device.consecutive_errors += 1
+
+def getCommHealth(device):
+    return {
+        "last_read_ok": device.last_read_ok,
+        "reads_ok": device.reads_ok,
+        "read_errors": device.read_errors,
+        "consecutive_errors": device.consecutive_errors,
+    }
+
+def getComponentActivity(device, threshold=0.0):
+    # Per-MPPT/string flags straight from the current models, with the same sanity cap as getAllData
+    activity = {}
+    for base_param in ("mppt_current", "string_current"):
+        models = getattr(device.measured_data, base_param, None)
+        if not models:
+            continue
+        category = base_param.split('_', 1)[0]
+        flags = {}
+        for idx, model in enumerate(models, 1):
+            if model is not None and model.model_present:
+                val = round(model.value, 2)
+                flags[f"{category}_{idx}"] = threshold < val <= 30
+        if flags:
+            activity[category] = flags
+    return activity
+
 def getFaultData():
     fault_output = {}
     for device in device_list:
-        device_faults = {}
-        for param in fault_data:
-            if hasattr(device.measured_data, param):
-                model = getattr(device.measured_data, param)
-                if model is not None and model.model_present:
-                    device_faults[param] = model.value
+        device_faults = getDeviceFaultWords(device)
         if device_faults:
             fault_output[str(device.device_id)] = device_faults
     return fault_output
@@ -1165,7 +1282,7 @@ def getDeviceStatusData():
                     device_status[param] = model.value
         if device_status:
             status_output[str(device.device_id)] = device_status
-            print("status is ",status_output[str(device.device_id)])
+            log.debug("status is %s", device_status)
     return status_output
 
 def getDIDOData():
@@ -1182,57 +1299,45 @@ def getDIDOData():
     return dido_output
 
 def getAggDG():
-    print("----into gerAggDG----")
     system_operating_details.aggDG = 0
-    for device in device_list:
-        if(device.device_type == deviceType.meter and device.connected_to == deviceType.DG):
-             if hasattr(device.measured_data, 'total_power'):
-                system_operating_details.aggDG += device.measured_data.total_power.value
+    for device in getDeviceGroup(deviceType.meter, deviceType.DG):
+        if hasattr(device.measured_data, 'total_power'):
+            system_operating_details.aggDG += device.measured_data.total_power.value
 
-    print("agg dg : ",system_operating_details.aggDG)
+    log.debug("agg dg : %s", system_operating_details.aggDG)
 
 def getAggDGlim():
-    print("----into getAggDGlim----")
     system_operating_details.dg_lim = 0
-    for device in device_list:
-        if(device.device_type == deviceType.meter and device.connected_to == deviceType.DG):
-            if hasattr(device.measured_data, 'total_power'):
-                if device.measured_data.total_power.value > 0:
-                    print(device.measured_data.total_power.value,device)
-                    system_operating_details.dg_lim += device.minimum_limit
+    for device in getDeviceGroup(deviceType.meter, deviceType.DG):
+        if hasattr(device.measured_data, 'total_power'):
+            if device.measured_data.total_power.value > 0:
+                system_operating_details.dg_lim += device.minimum_limit
     
-    print("agg dg limit : ",system_operating_details.dg_lim)
+    log.debug("agg dg limit : %s", system_operating_details.dg_lim)
 
 def getAggGrid():
-    print("----into getAggGrid----")
     system_operating_details.aggGrid = 0
     system_operating_details.aggGrid_Q = 0
     system_operating_details.aggGrid_PF = 0
-    for device in device_list:
-        if(device.device_type == deviceType.meter and device.connected_to == deviceType.grid):
-            if hasattr(device.measured_data, 'total_power') and device.measured_data.total_power.model_present:
-                system_operating_details.aggGrid += device.measured_data.total_power.value
-            if hasattr(device.measured_data, 'reactive_power') and device.measured_data.reactive_power.model_present:
-                system_operating_details.aggGrid_Q += device.measured_data.reactive_power.value
-            if hasattr(device.measured_data, 'power_factor') and device.measured_data.power_factor.model_present:
-                system_operating_details.aggGrid_PF += device.measured_data.power_factor.value
+    for device in getDeviceGroup(deviceType.meter, deviceType.grid):
+        if hasattr(device.measured_data, 'total_power') and device.measured_data.total_power.model_present:
+            system_operating_details.aggGrid += device.measured_data.total_power.value
+        if hasattr(device.measured_data, 'reactive_power') and device.measured_data.reactive_power.model_present:
+            system_operating_details.aggGrid_Q += device.measured_data.reactive_power.value
+        if hasattr(device.measured_data, 'power_factor') and device.measured_data.power_factor.model_present:
+            system_operating_details.aggGrid_PF += device.measured_data.power_factor.value
 
-    print("agg grid : ",system_operating_details.aggGrid)
-    print("agg grid Q : ",system_operating_details.aggGrid_Q)
-    print("agg grid PF : ",system_operating_details.aggGrid_PF)
+    log.debug("agg grid : %s Q : %s PF : %s", system_operating_details.aggGrid, system_operating_details.aggGrid_Q, system_operating_details.aggGrid_PF)
 
 def getAggLoad():
-    print("----into getAggLoad----")
     system_operating_details.aggLoad = 0
-    for device in device_list:
-        if(device.device_type == deviceType.meter and device.connected_to == deviceType.load):
-            if hasattr(device.measured_data, 'total_power'):
-                system_operating_details.aggLoad += device.measured_data.total_power.value
+    for device in getDeviceGroup(deviceType.meter, deviceType.load):
+        if hasattr(device.measured_data, 'total_power'):
+            system_operating_details.aggLoad += device.measured_data.total_power.value
 
-    print("agg load : ",system_operating_details.aggLoad)
+    log.debug("agg load : %s", system_operating_details.aggLoad)
 
 def runSysControlLoop():
-    print("----into runSysControlLoop----")
     system_operating_details.aggPV,system_operating_details.agg_pv_rated = getAgg(deviceType.solar)
     system_operating_details.aggBatt,system_operating_details.agg_batt_rated, system_operating_details.battery_storage_capacity = getAgg(deviceType.battery)
     system_operating_details.aggEV, aggEV = getAgg(deviceType.EV)
@@ -1244,14 +1349,14 @@ def runSysControlLoop():
     system_operating_details.controlGridPF()
     
     if system_operating_details.aggDG > 1000:
-        print(f"Grid state is OFF. DG is currently carrying the load: {system_operating_details.aggDG} W")
+        log.debug("Grid state is OFF. DG is currently carrying the load: %s W", system_operating_details.aggDG)
         system_operating_details.grid_state = gridState.off
     else:
-        print("Grid state is ON. DG is inactive.")
+        log.debug("Grid state is ON. DG is inactive.")
         system_operating_details.grid_state = gridState.on
 
     if system_operating_details.prev_grid_state == gridState.on and system_operating_details.grid_state == gridState.off:
-        print("[EMERGENCY] Grid Failure Detected! DG is taking load. Resetting PV setpoints to 0 instantly.")
+        log.warning("Grid Failure Detected! DG is taking load. Resetting PV setpoints to 0 instantly.")
         system_operating_details.pv_stpt = 0
         system_operating_details.grid_return_time = 0 
 
@@ -1262,23 +1367,21 @@ def runSysControlLoop():
         system_operating_details.controlFunc()
         for device in device_list:
             if device.device_type == deviceType.battery:
-                print("====battery device =====")
                 power = system_operating_details.storage_stpt
                 data_msg = {"param" : "active_power","value":str(power)}
-                print(data_msg,system_operating_details.storage_stpt)
+                log.debug("battery %s msg %s", device.device_id, data_msg)
                 device.encodeWrite(data_msg)
             if device.device_type == deviceType.solar:
                 
                 if system_operating_details.agg_pv_rated > 0:
-                    print("proportional power is : ")
                     proportional_power = system_operating_details.pv_stpt * (device.rated_power / system_operating_details.agg_pv_rated)
                 else:
                     proportional_power = 0
-                print("proportional_power of inv : ", proportional_power)
                 device.control_data.power_pct_stpt.value = proportional_power
                 data_msg = {"param" : "active_power","value":str(proportional_power)}
-                print("data_msg going to encodeWrite : ",data_msg)
+                log.debug("inverter %s proportional power %s", device.device_id, proportional_power)
                 device.encodeWrite(data_msg)
+        recordActuation()
 
 def getDeviceType(device_id):
     for device in device_list:
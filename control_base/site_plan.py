@@ -0,0 +1,158 @@
+import ast
+import hashlib
+import json
+import os
+import pickle
+import struct
+import logging
+
+from control import control_base as ctrl
+from modbus_master import modbusmasterapi as mbus
+from utils import fastlog
+
+log = fastlog.getLogger("site_plan")
+
+PLAN_MAGIC = b"EDGEPLAN"
+PLAN_VERSION = 1
+PLAN_HEADER = struct.Struct("!8sH32s")
+
+def parseNumber(value):
+    # installer_cfg stores numbers as strings; literal_eval instead of eval
+    if isinstance(value, (int, float)):
+        return value
+    return ast.literal_eval(str(value).strip())
+
+def codePaths():
+    # The cache pickles register models; any change to the modules defining them invalidates it
+    return [os.path.abspath(module.__file__) for module in (ctrl, mbus)] + [os.path.abspath(__file__)]
+
+def configHash(paths):
+    digest = hashlib.sha256()
+    digest.update(str(PLAN_VERSION).encode())
+    for path in list(paths) + codePaths():
+        digest.update(path.encode())
+        with open(path, "rb") as cfg_file:
+            digest.update(cfg_file.read())
+    return digest.digest()
+
+def compileSitePlan(installer_cfg, mappings_path, control_registers_path):
+    with open(mappings_path) as mapfile:
+        mbus_maps = json.load(mapfile)
+    with open(control_registers_path) as ctrlfile:
+        ctrl_maps = json.load(ctrlfile)
+
+    plan = {"site_id": installer_cfg["site id"], "devices": [], "groups": {}}
+    for device in installer_cfg["device_list"]:
+        comm_type = device["comm_type"]
+        spec = {
+            "device_id": device["device_id"],
+            "comm_type": comm_type,
+            "num_phases": parseNumber(device["num_phases"]),
+            "phase": [int(s) for s in device["phases"].split(',')],
+            "cfg": device,
+        }
+        if comm_type in ("modbus-tcp", "modbus-rtu"):
+            spec["device_type"] = ctrl.deviceType_l2e[device["device_type"]]
+            spec["read_map"] = {"map": mbus_maps[device["part_num"]]}
+            spec["ctrl_map"] = {"map": ctrl_maps[device["part_num"]]}
+        elif comm_type == "none":
+            spec["device_type"] = ctrl.deviceType.DG
+        else:
+            logging.error(f"Unsupported comm_type {comm_type} for device {device['device_id']}, skipping")
+            continue
+
+        if comm_type == "modbus-tcp":
+            tcp_details = device["modbus_tcp_details"]
+            spec["comm"] = {
+                "ip": tcp_details["IP"],
+                "port": parseNumber(tcp_details["port"]),
+                "slave_id": parseNumber(tcp_details["slave_id"]) if "slave_id" in tcp_details else 1,
+            }
+        elif comm_type == "modbus-rtu":
+            rtu_details = device["modbus_rtu_details"]
+            spec["comm"] = {
+                "port": rtu_details["port"],
+                "slave_id": parseNumber(rtu_details["slave_id"]),
+                "parity": rtu_details["parity"],
+                "baud": parseNumber(rtu_details["baudrate"]),
+                "stop_bits": parseNumber(rtu_details["stop_bits"]),
+            }
+
+        if "rated_power" in device:
+            spec["rated_power"] = parseNumber(device["rated_power"])
+        if "connected_to" in device:
+            spec["connected_to"] = ctrl.deviceType_l2e[device["connected_to"]]
+        if "minimum_limit" in device:
+            spec["minimum_limit"] = parseNumber(device["minimum_limit"])
+
+        role = ctrl.deviceRole(spec["device_type"], spec.get("connected_to"))
+        plan["groups"].setdefault(role, []).append(len(plan["devices"]))
+        plan["devices"].append(spec)
+    return plan
+
+def buildDevice(spec):
+    comm = spec.get("comm", {})
+    if spec["comm_type"] == "modbus-tcp":
+        device = mbus.modbusTCPDevice(spec["device_type"], ctrl.commType.modbus_tcp, comm["ip"], port=comm["port"], slave_id=comm["slave_id"],
+                                      address_map=spec["read_map"], ctrl_map=spec["ctrl_map"], cfg=spec["cfg"])
+    elif spec["comm_type"] == "modbus-rtu":
+        device = mbus.modbusRTUDevice(spec["device_type"], ctrl.commType.modbus_rtu, spec["read_map"], spec["ctrl_map"], comm["port"],
+                                      comm["parity"], comm["stop_bits"], comm["baud"], comm["slave_id"], cfg=spec["cfg"])
+    else:
+        device = ctrl.systemDevice(devicetype=ctrl.deviceType.DG, commtype=ctrl.commType.none, cfg=spec["cfg"])
+
+    device.device_id = spec["device_id"]
+    device.num_phases = spec["num_phases"]
+    if "measured_data" in spec:
+        device.measured_data = spec["measured_data"]
+        device.control_data = spec["control_data"]
+    elif spec["comm_type"] != "none":
+        device.createMeasureRegisterMap()
+        device.createControlRegisterMap()
+    device.phase = spec["phase"]
+    if "rated_power" in spec:
+        device.rated_power = spec["rated_power"]
+    if "connected_to" in spec:
+        device.connected_to = spec["connected_to"]
+    if "minimum_limit" in spec:
+        device.minimum_limit = spec["minimum_limit"]
+    return device
+
+def buildDevices(plan):
+    devices = [buildDevice(spec) for spec in plan["devices"]]
+    for spec, device in zip(plan["devices"], devices):
+        if "measured_data" not in spec:
+            # Keep the freshly compiled register models so the next start can skip createMeasureRegisterMap
+            spec["measured_data"] = device.measured_data
+            spec["control_data"] = device.control_data
+    ctrl.device_groups = {role: [devices[i] for i in idx] for role, idx in plan["groups"].items()}
+    return devices
+
+def loadSitePlan(cache_path, config_paths):
+    try:
+        with open(cache_path, "rb") as cache_file:
+            raw = cache_file.read()
+        magic, version, digest = PLAN_HEADER.unpack_from(raw)
+        if magic != PLAN_MAGIC or version != PLAN_VERSION:
+            log.info("Site plan cache format changed, recompiling")
+            return None
+        if digest != configHash(config_paths):
+            log.info("Site configuration or software changed, recompiling site plan")
+            return None
+        return pickle.loads(raw[PLAN_HEADER.size:])
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.error(f"Discarding unreadable site plan cache {cache_path}: {e}")
+        return None
+
+def saveSitePlan(cache_path, config_paths, plan):
+    header = PLAN_HEADER.pack(PLAN_MAGIC, PLAN_VERSION, configHash(config_paths))
+    tmp_path = cache_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as cache_file:
+            cache_file.write(header)
+            cache_file.write(pickle.dumps(plan, protocol=pickle.HIGHEST_PROTOCOL))
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logging.error(f"Unable to write site plan cache {cache_path}: {e}")
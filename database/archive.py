@@ -0,0 +1,252 @@
+import glob
+import json
+import os
+import shutil
+import time
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+
+from utils import fastlog
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+log = fastlog.getLogger("archive")
+
+FILE_PREFIX = "device_logs_"
+METADATA_KEY = b"edge_archive"
+HOT_DAYS = 7
+ARCHIVE_DAYS = 3650
+COMPRESSION = "zstd"
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+def available():
+    return pa is not None
+
+def dayName(day):
+    return day.astimezone(pytz.utc).strftime("%Y%m%d")
+
+def flattenRecord(data):
+    # Same "mppt.mppt1_voltage" naming as the metric store, so column names match metric names
+    for param, value in data.items():
+        if isinstance(value, dict):
+            for key, nested_value in value.items():
+                yield f"{param}.{key}", nested_value
+        else:
+            yield param, value
+
+def isNumber(value):
+    return isinstance(value, (int, float))
+
+def _column(values):
+    # float64 when every value is numeric (bools included), otherwise text
+    if all(v is None or isNumber(v) for v in values):
+        return pa.array([None if v is None else float(v) for v in values], type=pa.float64())
+    return pa.array([None if v is None else v if isinstance(v, str) else json.dumps(v) for v in values], type=pa.string())
+
+def buildDeviceTables(rows):
+    """Groups (capture_time, device_id, data) rows ordered by device into one wide table per device."""
+    devices = {}
+    for capture_time, device_id, data in rows:
+        records = devices.setdefault(str(device_id), [])
+        records.append((capture_time, dict(flattenRecord(data)) if isinstance(data, dict) else {}))
+
+    tables = {}
+    for device_id, records in devices.items():
+        names = sorted({name for _, fields in records for name in fields})
+        columns = {
+            "timestamp": pa.array([t for t, _ in records], type=pa.timestamp("ms", tz="UTC")),
+            "device_id": pa.array([device_id] * len(records), type=pa.string()),
+        }
+        for name in names:
+            columns[name] = _column([fields.get(name) for _, fields in records])
+        tables[device_id] = pa.table(columns)
+    return tables
+
+def _conform(table, schema):
+    # Casts to the file schema, adds null columns for fields a device never reported and orders the columns
+    arrays = []
+    for field in schema:
+        if field.name not in table.column_names:
+            arrays.append(pa.chunked_array([pa.nulls(len(table), type=field.type)], type=field.type))
+            continue
+        column = table[field.name]
+        arrays.append(column if column.type == field.type else pc.cast(column, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def _unifySchema(schemas):
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            known = fields.get(field.name)
+            # A column that is text on any device is text in the file
+            if known is None or (known.type != field.type and field.type == pa.string()):
+                fields[field.name] = field
+    ordered = [fields.pop("timestamp"), fields.pop("device_id")] + [fields[name] for name in sorted(fields)]
+    return pa.schema(ordered)
+
+def writeDayFile(path, parts, day):
+    """Merges per-device Parquet parts into one file, one row group per device, one device in memory at a time.
+
+    The device -> row group map is kept in the file metadata.
+    """
+    devices = sorted(parts)
+    row_groups = {device_id: index for index, device_id in enumerate(devices)}
+    schema = _unifySchema(pq.read_schema(parts[device_id]) for device_id in devices)
+    schema = schema.with_metadata({METADATA_KEY: json.dumps({"day": day, "devices": row_groups})})
+    tmp_path = path + ".tmp"
+    with pq.ParquetWriter(tmp_path, schema, compression=COMPRESSION) as writer:
+        for device_id in devices:
+            table = pq.read_table(parts[device_id])
+            writer.write_table(_conform(table, schema), row_group_size=max(len(table), 1))
+    os.replace(tmp_path, path)
+
+def dayFiles(archive_dir, day):
+    # Base file plus numbered parts for rows that reached the store after the day was archived
+    return sorted(glob.glob(os.path.join(archive_dir, f"{FILE_PREFIX}{day}*.parquet")))
+
+def toMillis(capture_time):
+    # Archive timestamps are stored in ms; truncate the same way pyarrow does
+    return (capture_time - EPOCH) // timedelta(milliseconds=1)
+
+def archivedTimes(paths, device_id):
+    """Capture times (ms) of a device already in the given day files, read from its row groups only."""
+    times = set()
+    for path in paths:
+        pf = pq.ParquetFile(path)
+        meta = json.loads((pf.schema_arrow.metadata or {}).get(METADATA_KEY, b"{}"))
+        index = meta.get("devices", {}).get(device_id)
+        if index is not None:
+            column = pf.read_row_group(index, columns=["timestamp"])["timestamp"]
+            times.update(column.cast(pa.int64()).to_pylist())
+    return times
+
+def readColumns(archive_dir, start, end, columns=None, device_ids=None):
+    """Loads selected columns of archived rows with start <= timestamp < end as one pyarrow Table.
+
+    Only the row groups of the requested devices are read; columns missing from a file come back as nulls.
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed")
+    start = start.astimezone(pytz.utc)
+    end = end.astimezone(pytz.utc)
+    wanted = None if device_ids is None else {str(d) for d in device_ids}
+    tables = []
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < end:
+        for path in dayFiles(archive_dir, dayName(day)):
+            pf = pq.ParquetFile(path)
+            names = pf.schema_arrow.names
+            select = None if columns is None else ["timestamp", "device_id"] + [c for c in columns if c in names and c not in ("timestamp", "device_id")]
+            meta = json.loads((pf.schema_arrow.metadata or {}).get(METADATA_KEY, b"{}"))
+            groups = meta.get("devices", {})
+            if wanted is None:
+                table = pf.read(columns=select)
+            else:
+                indexes = sorted(groups[d] for d in wanted if d in groups)
+                if not indexes:
+                    continue
+                table = pf.read_row_groups(indexes, columns=select)
+            tables.append(table)
+        day += timedelta(days=1)
+    if not tables:
+        return pa.table({"timestamp": pa.array([], type=pa.timestamp("ms", tz="UTC")), "device_id": pa.array([], type=pa.string())})
+
+    schema = _unifySchema(t.schema for t in tables)
+    if columns is not None:
+        schema = pa.schema([f for f in schema if f.name in ("timestamp", "device_id")] +
+                           [schema.field(c) if c in schema.names else pa.field(c, pa.float64())
+                            for c in columns if c not in ("timestamp", "device_id")])
+    table = pa.concat_tables([_conform(t, schema) for t in tables])
+    in_range = pc.and_(pc.greater_equal(table["timestamp"], pa.scalar(start, type=pa.timestamp("ms", tz="UTC"))),
+                       pc.less(table["timestamp"], pa.scalar(end, type=pa.timestamp("ms", tz="UTC"))))
+    return table.filter(in_range)
+
+class DailyArchiver:
+    """Nightly cold tier: days older than hot_days move from the report store into Parquet files.
+
+    A day is only archived once all of its rows were shipped to the cloud, and the hot store is pruned
+    up to the last day written successfully. Rows already in the day's files are skipped, so a run that
+    died between writing a file and pruning just prunes next time. Archive files older than archive_days
+    are deleted.
+    """
+
+    def __init__(self, storage, archive_dir, hot_days=HOT_DAYS, archive_days=ARCHIVE_DAYS):
+        if pa is None:
+            raise RuntimeError("pyarrow is not installed")
+        self.storage = storage
+        self.archive_dir = archive_dir
+        self.hot_days = hot_days
+        self.archive_days = archive_days
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def _nextPath(self, day):
+        existing = dayFiles(self.archive_dir, day)
+        name = f"{FILE_PREFIX}{day}.parquet" if not existing else f"{FILE_PREFIX}{day}.{len(existing)}.parquet"
+        return os.path.join(self.archive_dir, name)
+
+    def archiveDay(self, day):
+        # Each device is fetched and written to its own temporary part, so memory holds one device-day
+        start = time.monotonic()
+        name = dayName(day)
+        existing = dayFiles(self.archive_dir, name)
+        parts_dir = os.path.join(self.archive_dir, f".{FILE_PREFIX}{name}.parts")
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir)
+        try:
+            parts = {}
+            archived = 0
+            for device_id in self.storage.day_devices(day):
+                device_id = str(device_id)
+                rows = self.storage.fetch_day(day, device_id)
+                if existing:
+                    seen = archivedTimes(existing, device_id)
+                    rows = [row for row in rows if toMillis(row[0]) not in seen]
+                if not rows:
+                    continue
+                part = os.path.join(parts_dir, f"{len(parts)}.parquet")
+                pq.write_table(buildDeviceTables(rows)[device_id], part, compression=COMPRESSION)
+                parts[device_id] = part
+                archived += len(rows)
+            if not parts:
+                return 0
+            path = self._nextPath(name)
+            writeDayFile(path, parts, name)
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+        log.info("Archived %d rows of %d devices for %s to %s in %.1fs", archived, len(parts), name,
+                 os.path.basename(path), time.monotonic() - start)
+        return archived
+
+    def _expire(self):
+        cutoff = dayName(datetime.now(pytz.utc) - timedelta(days=self.archive_days))
+        for path in glob.glob(os.path.join(self.archive_dir, f"{FILE_PREFIX}*.parquet")):
+            if os.path.basename(path)[len(FILE_PREFIX):len(FILE_PREFIX) + 8] < cutoff:
+                os.remove(path)
+                log.info("Deleted expired archive %s", os.path.basename(path))
+
+    def run(self):
+        now = datetime.now(pytz.utc)
+        cutoff = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=self.hot_days)
+        # Rows still waiting for the uplink keep their day in the hot store
+        unsent = self.storage.oldest_unsent()
+        if unsent is not None:
+            cutoff = min(cutoff, unsent.astimezone(pytz.utc).replace(hour=0, minute=0, second=0, microsecond=0))
+
+        archived_until = None
+        for day in self.storage.list_days(cutoff):
+            try:
+                self.archiveDay(day)
+            except Exception as e:
+                logging.error(f"Archiving {dayName(day)} failed, keeping it in the hot store: {e}")
+                break
+            archived_until = day + timedelta(days=1)
+        if archived_until is not None:
+            self.storage.prune_before(archived_until)
+        self._expire()
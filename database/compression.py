@@ -0,0 +1,192 @@
+import math
+
+DEADBAND = "deadband"
+SWINGING_DOOR = "swinging_door"
+
+# Metric classes by name fragment, first match wins; abs/rel are the allowed reconstruction error
+DEFAULT_RULES = {
+    "energy": {"match": ("energy",), "method": SWINGING_DOOR, "abs": 0.01, "rel": 0.0, "max_interval": 3600},
+    "temperature": {"match": ("temperature",), "method": DEADBAND, "abs": 0.2, "rel": 0.0, "max_interval": 1800},
+    "power_factor": {"match": ("power_factor",), "method": DEADBAND, "abs": 0.005, "rel": 0.0, "max_interval": 900},
+    "frequency": {"match": ("freq",), "method": DEADBAND, "abs": 0.01, "rel": 0.0, "max_interval": 900},
+    "voltage": {"match": ("voltage",), "method": SWINGING_DOOR, "abs": 0.5, "rel": 0.002, "max_interval": 900},
+    "current": {"match": ("current",), "method": SWINGING_DOOR, "abs": 0.05, "rel": 0.005, "max_interval": 900},
+    "power": {"match": ("power",), "method": SWINGING_DOOR, "abs": 0.05, "rel": 0.01, "max_interval": 900},
+    "default": {"match": (), "method": DEADBAND, "abs": 0.0, "rel": 0.0, "max_interval": 3600},
+}
+
+class _Series:
+    __slots__ = ("archived_t", "archived_v", "last_t", "last_v", "slope_max", "slope_min")
+
+    def __init__(self):
+        self.archived_t = None
+        self.archived_v = None
+        self.last_t = None
+        self.last_v = None
+        self.slope_max = math.inf
+        self.slope_min = -math.inf
+
+    def copy(self):
+        other = _Series()
+        for name in self.__slots__:
+            setattr(other, name, getattr(self, name))
+        return other
+
+class MetricCompressor:
+    """Per-series deadband / swinging-door filter; add() returns the points worth storing.
+
+    Deadband points reconstruct by holding the last stored value, swinging-door points by linear
+    interpolation; either way the error stays within errorBound() of the original samples.
+    Swinging door stores a point one sample late, so the newest sample of a series can be pending.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = dict(DEFAULT_RULES)
+        for name, rule in (rules or {}).items():
+            self.rules[name] = dict(self.rules.get(name, DEFAULT_RULES["default"]), **rule)
+        self._class_cache = {}
+        self.series = {}
+        self._undo = {}
+        self.points_in = 0
+        self.points_out = 0
+
+    def metricClass(self, metric):
+        cls = self._class_cache.get(metric)
+        if cls is None:
+            cls = "default"
+            for name, rule in self.rules.items():
+                if any(fragment in metric for fragment in rule.get("match", ())):
+                    cls = name
+                    break
+            self._class_cache[metric] = cls
+        return cls
+
+    def rule(self, metric):
+        return self.rules[self.metricClass(metric)]
+
+    def errorBound(self, metric, value=0.0):
+        rule = self.rule(metric)
+        return max(rule["abs"], rule["rel"] * abs(value))
+
+    def method(self, metric):
+        return self.rule(metric)["method"]
+
+    def _state(self, key):
+        state = self.series.get(key)
+        if state is None:
+            state = self.series[key] = _Series()
+            self._undo.setdefault(key, None)
+        elif key not in self._undo:
+            self._undo[key] = state.copy()
+        return state
+
+    def commit(self):
+        self._undo = {}
+
+    def rollback(self):
+        # Restores series touched since the last commit so a retried batch compresses identically
+        for key, saved in self._undo.items():
+            if saved is None:
+                self.series.pop(key, None)
+            else:
+                self.series[key] = saved
+        self._undo = {}
+
+    def add(self, device_id, metric, t, value):
+        self.points_in += 1
+        key = (device_id, metric)
+        current = self.series.get(key)
+        if current is not None and current.last_t is not None and t <= current.last_t:
+            # Out-of-order sample (e.g. a replayed offline window): store as-is, leave the series alone
+            self.points_out += 1
+            return [(t, value)]
+        state = self._state(key)
+        rule = self.rule(metric)
+        if rule["method"] == SWINGING_DOOR:
+            out = self._swingingDoor(state, rule, t, value)
+        else:
+            out = self._deadband(state, rule, t, value)
+        self.points_out += len(out)
+        return out
+
+    def _archive(self, state, t, value):
+        state.archived_t = t
+        state.archived_v = value
+        state.slope_max = math.inf
+        state.slope_min = -math.inf
+
+    def _deadband(self, state, rule, t, value):
+        state.last_t, state.last_v = t, value
+        if state.archived_t is None or math.isnan(value) or math.isnan(state.archived_v):
+            self._archive(state, t, value)
+            return [(t, value)]
+        bound = max(rule["abs"], rule["rel"] * abs(state.archived_v))
+        if abs(value - state.archived_v) > bound or t - state.archived_t >= rule["max_interval"]:
+            self._archive(state, t, value)
+            return [(t, value)]
+        return []
+
+    def _closeSegment(self, state, end_t, end_v):
+        # End the segment on the corridor, not on the raw sample, so every sample it spans stays in bound
+        slope = (end_v - state.archived_v) / (end_t - state.archived_t)
+        slope = min(max(slope, state.slope_min), state.slope_max)
+        point = (end_t, state.archived_v + slope * (end_t - state.archived_t))
+        self._archive(state, *point)
+        return point
+
+    def _swingingDoor(self, state, rule, t, value):
+        prev_t, prev_v = state.last_t, state.last_v
+        state.last_t, state.last_v = t, value
+        if state.archived_t is None or math.isnan(value) or math.isnan(state.archived_v):
+            out = []
+            if prev_t is not None and prev_t != state.archived_t:
+                out.append(self._closeSegment(state, prev_t, prev_v))
+            self._archive(state, t, value)
+            return out + [(t, value)]
+
+        out = []
+        if t - state.archived_t >= rule["max_interval"] and prev_t != state.archived_t:
+            out.append(self._closeSegment(state, prev_t, prev_v))
+
+        bound = max(rule["abs"], rule["rel"] * abs(value))
+        dt = t - state.archived_t
+        upper = (value + bound - state.archived_v) / dt
+        lower = (value - bound - state.archived_v) / dt
+        slope_min = max(state.slope_min, lower)
+        slope_max = min(state.slope_max, upper)
+        if slope_min > slope_max:
+            # The doors crossed: the previous sample is the last one a single line can cover
+            out.append(self._closeSegment(state, prev_t, prev_v))
+            dt = t - state.archived_t
+            slope_min = (value - bound - state.archived_v) / dt
+            slope_max = (value + bound - state.archived_v) / dt
+        state.slope_min = slope_min
+        state.slope_max = slope_max
+        return out
+
+    def pending(self, device_id, metric):
+        # Newest sample not yet stored by swinging door, for readers that need the current tail
+        state = self.series.get((device_id, metric))
+        if state is None or state.last_t is None or state.last_t == state.archived_t:
+            return None
+        return (state.last_t, state.last_v)
+
+    def stats(self):
+        ratio = self.points_in / self.points_out if self.points_out else 0.0
+        return {"points_in": self.points_in, "points_out": self.points_out, "ratio": round(ratio, 2)}
+
+def reconstruct(points, times, method):
+    """Values at `times` from stored (t, value) points: step-hold for deadband, linear for swinging door."""
+    out = []
+    i = 0
+    for t in times:
+        while i + 1 < len(points) and points[i + 1][0] <= t:
+            i += 1
+        if not points or t < points[0][0]:
+            out.append(None)
+        elif method == SWINGING_DOOR and i + 1 < len(points):
+            (t0, v0), (t1, v1) = points[i], points[i + 1]
+            out.append(v0 + (v1 - v0) * (t - t0) / (t1 - t0))
+        else:
+            out.append(points[i][1])
+    return out
@@ -1,135 +1,568 @@
-# import psycopg2
-# from psycopg2.extras import execute_values
-# import json
-# import logging
-# from datetime import datetime
-
-# class LocalStorage:
-#     def __init__(self, db_params):
-#         self.db_params = db_params
-#         self.buffer = []
-#         self.buffer_limit = 30  # Batch 30 seconds to protect RPi storage
-#         self._init_db()
-
-#     def _get_connection(self):
-#         return psycopg2.connect(**self.db_params)
-
-#     def _init_db(self):
-#         try:
-#             with self._get_connection() as conn:
-#                 with conn.cursor() as cur:
-#                     # Flexible schema for all device types
-#                     cur.execute("""
-#                         CREATE TABLE IF NOT EXISTS device_logs (
-#                             timestamp TIMESTAMPTZ NOT NULL,
-#                             device_id INTEGER NOT NULL,
-#                             data JSONB NOT NULL
-#                         );
-#                     """)
-#                     # TimescaleDB hypertable for per-second efficiency
-#                     cur.execute("""
-#                         SELECT create_hypertable('device_logs', 'timestamp', 
-#                         if_not_exists => TRUE, chunk_time_interval => INTERVAL '1 day');
-#                     """)
-#                     # 90-day retention policy
-#                     cur.execute("""
-#                         SELECT add_retention_policy('device_logs', INTERVAL '90 days', 
-#                         if_not_exists => TRUE);
-#                     """)
-#                     conn.commit()
-#         except Exception as e:
-#             logging.error(f"PostgreSQL Init Error: {e}")
-
-#     def save_reading(self, device_id, data_payload):
-#         # Capture the exact moment of reading
-#         capture_time = datetime.now()
-#         data_payload.pop('type', None) # Remove metadata
-        
-#         self.buffer.append((
-#             capture_time,
-#             device_id,
-#             json.dumps(data_payload)
-#         ))
-
-#         if len(self.buffer) >= self.buffer_limit:
-#             self.flush()
-
-#     def flush(self):
-#         if not self.buffer: return
-#         try:
-#             with self._get_connection() as conn:
-#                 with conn.cursor() as cur:
-#                     execute_values(cur, 
-#                         "INSERT INTO device_logs (timestamp, device_id, data) VALUES %s", 
-#                         self.buffer
-#                     )
-#                     conn.commit()
-#             self.buffer = []
-#         except Exception as e:
-#             logging.error(f"PostgreSQL Flush Error: {e}")
-
+import csv
+import io
+import threading
+import time
+import logging
+from datetime import datetime, timedelta, timezone
 
 import psycopg2
-from psycopg2.extras import execute_values
-import json
-import logging
-from datetime import datetime
 
-class LocalStorage:
-    def __init__(self, db_params):
+from utils import fastlog
+from database import compression
+from database.storage_backend import StorageBackend, UPLINK_CURSOR, QUEUE_SIZE, BATCH_ROWS, FLUSH_INTERVAL, MAX_RECONNECT_DELAY, SPILL_MAX_BYTES
+
+log = fastlog.getLogger("local_storage")
+
+METRIC_COMPRESS_AFTER = "2 days"
+# Backfill slices stay small and spaced out so they never hold up ingest for long on a Pi
+MIGRATION_STEP_ROWS = 500
+MIGRATION_INTERVAL = 5.0
+MIGRATION_STATEMENT_TIMEOUT_MS = 5000
+MIGRATION_MAX_ATTEMPTS = 10
+
+# (view, bucket, refresh start_offset, end_offset, schedule_interval). The views aggregate every stored
+# window exactly; they are only kept while compression is off (see _rebuilt_rollup for the other case).
+METRIC_ROLLUPS = (
+    ("device_metrics_1m", "1 minute", "1 hour", "1 minute", "1 minute"),
+    ("device_metrics_15m", "15 minutes", "1 day", "15 minutes", "15 minutes"),
+    ("device_metrics_1d", "1 day", "7 days", "1 hour", "1 hour"),
+)
+ROLLUP_SECONDS = {"1m": 60, "15m": 900, "1d": 86400}
+
+def isMetricValue(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def flattenMetrics(data):
+    # Numeric scalars keep their name; nested mppt/string dicts become "mppt.mppt1_voltage"
+    for param, value in data.items():
+        if isMetricValue(value):
+            yield param, float(value)
+        elif isinstance(value, dict):
+            for key, nested_value in value.items():
+                if isMetricValue(nested_value):
+                    yield f"{param}.{key}", float(nested_value)
+
+class LocalStorage(StorageBackend):
+    """TimescaleDB store; rows go through a bounded queue to one writer thread that bulk-loads with COPY."""
+
+    name = "LocalStorage"
+    transient_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+    def __init__(self, db_params, queue_size=QUEUE_SIZE, batch_rows=BATCH_ROWS, flush_interval=FLUSH_INTERVAL,
+                 metric_store=False, jsonb_retention_days=90, compression_rules=False, spill_path=None, spill_max_bytes=SPILL_MAX_BYTES):
+        print("Initializing LocalStorage...")
+        super().__init__(queue_size, batch_rows, flush_interval, spill_path, spill_max_bytes)
         self.db_params = db_params
-        self.buffer = []
-        self.buffer_limit = 30 # Writes to SD card every 30 readings
-        self._init_db()
+        self.metric_store = metric_store
+        self.jsonb_retention_days = jsonb_retention_days
+        self.metric_ids = {}
+        # Opt-in deadband / swinging-door filtering of device_metrics; device_logs always keeps exact windows
+        self.compressor = None
+        if metric_store and compression_rules:
+            self.compressor = compression.MetricCompressor(compression_rules if isinstance(compression_rules, dict) else None)
+        self._migration_done = not metric_store
+        self._migration_next = 0.0
+        self._write_conn = None
+        self._read_conn = None
+        self._read_lock = threading.Lock()
+        self._schema_ready = False
+        self.start()
 
     def _get_connection(self):
+        log.debug("Connecting to PostgreSQL as user: %s", self.db_params.get('user'))
         return psycopg2.connect(**self.db_params)
 
-    def _init_db(self):
+    def _init_db(self, conn):
+        cur = conn.cursor()
+
+        print("Ensuring TimescaleDB extension exists...")
+        cur.execute("CREATE EXTENSION IF NOT EXISTS timescaledb CASCADE;")
+
+        print("Ensuring table 'device_logs' exists...")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS device_logs (
+                timestamp TIMESTAMPTZ NOT NULL,
+                device_id TEXT NOT NULL,
+                data JSONB NOT NULL
+            );
+        """)
+
+        print("Configuring Hypertable...")
+        cur.execute("""
+            SELECT create_hypertable(
+                'device_logs',
+                'timestamp',
+                if_not_exists => TRUE,
+                migrate_data => TRUE,
+                chunk_time_interval => INTERVAL '1 day'
+            );
+        """)
+
+        # Ingest sequence drives the uplink cursor; offline windows can predate rows already sent
+        cur.execute("ALTER TABLE device_logs ADD COLUMN IF NOT EXISTS seq BIGSERIAL;")
+        cur.execute("CREATE INDEX IF NOT EXISTS device_logs_seq_idx ON device_logs (seq);")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS uplink_cursor (
+                name TEXT PRIMARY KEY,
+                seq BIGINT NOT NULL
+            );
+        """)
+        # Everything stored before the cursor existed was only stored after a successful POST
+        cur.execute("""
+            INSERT INTO uplink_cursor (name, seq)
+            SELECT %s, COALESCE(MAX(seq), 0) FROM device_logs
+            ON CONFLICT (name) DO NOTHING;
+        """, (UPLINK_CURSOR,))
+
+        print(f"Setting {self.jsonb_retention_days}-Day Retention Policy...")
+        cur.execute("""
+            SELECT add_retention_policy(
+                'device_logs',
+                drop_after => make_interval(days => %s),
+                if_not_exists => TRUE
+            );
+        """, (self.jsonb_retention_days,))
+
+        conn.commit()
+        cur.close()
+        if self.metric_store:
+            self._init_metric_store(conn)
+        print("TimescaleDB initialized successfully")
+
+    def _init_metric_store(self, conn):
+        # Narrow typed store next to device_logs; device_logs stays the store-and-forward source
+        cur = conn.cursor()
+        print("Ensuring metric store exists...")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS metric_dict (
+                metric_id SERIAL PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS device_metrics (
+                ts TIMESTAMPTZ NOT NULL,
+                device_id TEXT NOT NULL,
+                metric_id INTEGER NOT NULL,
+                value DOUBLE PRECISION
+            );
+        """)
+        cur.execute("""
+            SELECT create_hypertable(
+                'device_metrics',
+                'ts',
+                if_not_exists => TRUE,
+                chunk_time_interval => INTERVAL '1 day'
+            );
+        """)
+        cur.execute("""
+            ALTER TABLE device_metrics SET (
+                timescaledb.compress,
+                timescaledb.compress_segmentby = 'device_id, metric_id',
+                timescaledb.compress_orderby = 'ts DESC'
+            );
+        """)
+        cur.execute("SELECT add_compression_policy('device_metrics', INTERVAL %s, if_not_exists => TRUE);", (METRIC_COMPRESS_AFTER,))
+        cur.execute("SELECT add_retention_policy('device_metrics', drop_after => INTERVAL '90 days', if_not_exists => TRUE);")
+
+        for view, bucket, start_offset, end_offset, schedule in METRIC_ROLLUPS:
+            if self.compressor is not None:
+                # Aggregates over compressed points would be biased; stop refreshing views left from before
+                cur.execute("SELECT to_regclass(%s);", (view,))
+                if cur.fetchone()[0] is not None:
+                    cur.execute("SELECT remove_continuous_aggregate_policy(%s, if_exists => TRUE);", (view,))
+                continue
+            cur.execute(f"""
+                CREATE MATERIALIZED VIEW IF NOT EXISTS {view}
+                WITH (timescaledb.continuous) AS
+                SELECT time_bucket(INTERVAL '{bucket}', ts) AS bucket,
+                       device_id,
+                       metric_id,
+                       avg(value) AS mean,
+                       min(value) AS min,
+                       max(value) AS max,
+                       last(value, ts) AS last
+                FROM device_metrics
+                GROUP BY bucket, device_id, metric_id
+                WITH NO DATA;
+            """)
+            cur.execute("""
+                SELECT add_continuous_aggregate_policy(%s,
+                    start_offset => INTERVAL %s,
+                    end_offset => INTERVAL %s,
+                    schedule_interval => INTERVAL %s,
+                    if_not_exists => TRUE);
+            """, (view, start_offset, end_offset, schedule))
+
+        # Rows written before dual-writing started (seq <= stop_seq) are backfilled from device_logs
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS storage_migrations (
+                name TEXT PRIMARY KEY,
+                done_seq BIGINT NOT NULL,
+                stop_seq BIGINT NOT NULL,
+                finished BOOLEAN NOT NULL DEFAULT FALSE
+            );
+        """)
+        cur.execute("""
+            ALTER TABLE storage_migrations
+                ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS failed BOOLEAN NOT NULL DEFAULT FALSE,
+                ADD COLUMN IF NOT EXISTS last_error TEXT;
+        """)
+        cur.execute("""
+            INSERT INTO storage_migrations (name, done_seq, stop_seq)
+            SELECT 'jsonb_to_metrics', 0, COALESCE(MAX(seq), 0) FROM device_logs
+            ON CONFLICT (name) DO NOTHING;
+        """)
+        cur.execute("SELECT metric_id, name FROM metric_dict;")
+        self.metric_ids = {name: metric_id for metric_id, name in cur.fetchall()}
+        conn.commit()
+        cur.close()
+
+    def _close(self, conn):
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _ensure_write_conn(self):
+        if self._write_conn is not None and not self._write_conn.closed:
+            return self._write_conn
+        delay = 1
+        while True:
+            try:
+                conn = self._get_connection()
+            except Exception as e:
+                log.error("PostgreSQL connection failed, retrying in %ss: %s", delay, e, every=60)
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            if not self._schema_ready:
+                try:
+                    print("Initializing Database...")
+                    self._init_db(conn)
+                except Exception as e:
+                    # Writes need seq / uplink_cursor / the metric tables; retry init rather than write without them
+                    log.error("TimescaleDB init failed, retrying in %ss: %s", delay, e, every=60)
+                    self._close(conn)
+                    time.sleep(delay)
+                    delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                    continue
+                self._schema_ready = True
+            self._write_conn = conn
+            with self._stats_lock:
+                self._stats["connects"] += 1
+            return conn
+
+    def _resolve_metric_ids(self, cur, names):
+        missing = [name for name in names if name not in self.metric_ids]
+        if not missing:
+            return
+        cur.execute("INSERT INTO metric_dict (name) SELECT unnest(%s::text[]) ON CONFLICT (name) DO NOTHING;", (missing,))
+        cur.execute("SELECT metric_id, name FROM metric_dict WHERE name = ANY(%s);", (missing,))
+        for metric_id, name in cur.fetchall():
+            self.metric_ids[name] = metric_id
+
+    def _copy_metrics(self, cur, rows):
+        samples = []
+        names = set()
+        for capture_time, device_id, _, data in rows:
+            if not isinstance(data, dict):
+                continue
+            for name, value in flattenMetrics(data):
+                if self.compressor is None:
+                    samples.append((capture_time, device_id, name, value))
+                else:
+                    for t, kept in self.compressor.add(device_id, name, capture_time.timestamp(), value):
+                        samples.append((datetime.fromtimestamp(t, tz=timezone.utc), device_id, name, kept))
+                names.add(name)
+        if not samples:
+            return
+        self._resolve_metric_ids(cur, names)
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for capture_time, device_id, name, value in samples:
+            writer.writerow((capture_time.isoformat(), device_id, self.metric_ids[name], repr(value)))
+        buf.seek(0)
+        cur.copy_expert("COPY device_metrics (ts, device_id, metric_id, value) FROM STDIN WITH (FORMAT csv)", buf)
+
+    def _write_rows(self, rows):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for capture_time, device_id, data, _ in rows:
+            writer.writerow((capture_time.isoformat(), device_id, data))
+        buf.seek(0)
+        conn = self._ensure_write_conn()
         try:
-            with self._get_connection() as conn:
-                with conn.cursor() as cur:
-                    # Flexible schema for any device type
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS device_logs (
-                            timestamp TIMESTAMPTZ NOT NULL,
-                            device_id INTEGER NOT NULL,
-                            data JSONB NOT NULL
-                        );
-                    """)
-                    # Hypertable for high-frequency data performance
-                    cur.execute("""
-                        SELECT create_hypertable('device_logs', 'timestamp', 
-                        if_not_exists => TRUE, chunk_time_interval => INTERVAL '1 day');
-                    """)
-                    # 90-day retention policy to manage RPi storage
-                    cur.execute("""
-                        SELECT add_retention_policy('device_logs', INTERVAL '90 days', 
-                        if_not_exists => TRUE);
-                    """)
-                    conn.commit()
-        except Exception as e:
-            logging.error(f"PostgreSQL Init Error: {e}")
+            with conn.cursor() as cur:
+                cur.copy_expert("COPY device_logs (timestamp, device_id, data) FROM STDIN WITH (FORMAT csv)", buf)
+                if self.metric_store:
+                    self._copy_metrics(cur, rows)
+            conn.commit()
+            if self.compressor is not None:
+                self.compressor.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._close(conn)
+            self._write_conn = None
+            self._rollback_compressor()
+            raise
+        except Exception:
+            conn.rollback()
+            # A rolled-back dictionary insert must not leave stale ids cached
+            self.metric_ids = {}
+            self._rollback_compressor()
+            raise
+
+    def _rollback_compressor(self):
+        if self.compressor is not None:
+            self.compressor.rollback()
 
-    def save_device_data(self, device_id, data_dict):
-        """Captures reading with timestamp and buffers it."""
-        capture_time = datetime.now() # Site-time capture
-        data_dict.pop('type', None) # Remove metadata
-        
-        self.buffer.append((capture_time, device_id, json.dumps(data_dict)))
+    def stats(self):
+        stats = super().stats()
+        if self.compressor is not None:
+            stats["compression"] = self.compressor.stats()
+        return stats
+
+    def _idle(self):
+        if not self._migration_done and time.monotonic() >= self._migration_next:
+            self._migration_next = time.monotonic() + MIGRATION_INTERVAL
+            self._migrate_step()
+
+    def _migrate_step(self):
+        # Backfills a slice of device_logs into device_metrics per idle writer cycle
+        conn = self._ensure_write_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT done_seq, stop_seq, finished, failed FROM storage_migrations WHERE name = 'jsonb_to_metrics';")
+                row = cur.fetchone()
+                conn.commit()
+                if row is None or row[2]:
+                    self._migration_done = True
+                    return
+                done_seq, stop_seq, _, failed = row
+                if failed:
+                    # Parked after repeated failures; clear storage_migrations.failed to resume from done_seq
+                    self._migration_done = True
+                    log.warning("Metric migration is parked as failed at seq %s of %s", done_seq, stop_seq)
+                    return
+                if done_seq >= stop_seq:
+                    self._finish_migration(conn)
+                    return
+                upto_seq = min(done_seq + MIGRATION_STEP_ROWS, stop_seq)
+                cur.execute("SET LOCAL statement_timeout = %s;", (MIGRATION_STATEMENT_TIMEOUT_MS,))
+                cur.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS migrate_samples (
+                        ts TIMESTAMPTZ, device_id TEXT, name TEXT, value DOUBLE PRECISION
+                    ) ON COMMIT DELETE ROWS;
+                """)
+                cur.execute("""
+                    INSERT INTO migrate_samples
+                    SELECT l.timestamp, l.device_id, f.name, f.value
+                    FROM device_logs l
+                    CROSS JOIN LATERAL (
+                        SELECT e.key AS name, e.value::text::double precision AS value
+                        FROM jsonb_each(l.data) e
+                        WHERE jsonb_typeof(e.value) = 'number'
+                        UNION ALL
+                        SELECT o.key || '.' || n.key, n.value::text::double precision
+                        FROM (SELECT key, value FROM jsonb_each(l.data) WHERE jsonb_typeof(value) = 'object') o
+                        CROSS JOIN LATERAL jsonb_each(o.value) n
+                        WHERE jsonb_typeof(n.value) = 'number'
+                    ) f
+                    WHERE l.seq > %s AND l.seq <= %s;
+                """, (done_seq, upto_seq))
+                cur.execute("INSERT INTO metric_dict (name) SELECT DISTINCT name FROM migrate_samples ON CONFLICT (name) DO NOTHING;")
+                cur.execute("""
+                    INSERT INTO device_metrics (ts, device_id, metric_id, value)
+                    SELECT s.ts, s.device_id, m.metric_id, s.value
+                    FROM migrate_samples s JOIN metric_dict m ON m.name = s.name;
+                """)
+                migrated = cur.rowcount
+                cur.execute("UPDATE storage_migrations SET done_seq = %s, attempts = 0, last_error = NULL WHERE name = 'jsonb_to_metrics';", (upto_seq,))
+            conn.commit()
+            self.metric_ids = {}
+            log.info("Migrated %d JSONB samples (seq %s-%s of %s) into device_metrics", migrated, done_seq + 1, upto_seq, stop_seq)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            self._close(conn)
+            self._write_conn = None
+            log.warning("Metric migration interrupted: %s", e, every=300)
+        except Exception as e:
+            conn.rollback()
+            self._migration_failed(conn, e)
 
-        if len(self.buffer) >= self.buffer_limit:
-            self.flush()
+    def _migration_failed(self, conn, error):
+        # The slice is retried with backoff; after MIGRATION_MAX_ATTEMPTS it is parked, not silently finished
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE storage_migrations
+                    SET attempts = attempts + 1, last_error = %s, failed = attempts + 1 >= %s
+                    WHERE name = 'jsonb_to_metrics'
+                    RETURNING attempts, failed;
+                """, (str(error)[:500], MIGRATION_MAX_ATTEMPTS))
+                attempts, failed = cur.fetchone()
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Unable to record metric migration failure: {e}")
+            attempts, failed = 1, False
+        self._migration_next = time.monotonic() + min(MAX_RECONNECT_DELAY * 10, MIGRATION_INTERVAL * 2 ** attempts)
+        if failed:
+            self._migration_done = True
+        logging.error(f"JSONB to metric store migration step failed (attempt {attempts}{', parked' if failed else ''}): {error}")
 
-    def flush(self):
-        if not self.buffer: return
+    def _finish_migration(self, conn):
+        # Continuous aggregate policies only look back a few buckets; materialise the backfill once
+        conn.autocommit = True
         try:
-            with self._get_connection() as conn:
-                with conn.cursor() as cur:
-                    execute_values(cur, 
-                        "INSERT INTO device_logs (timestamp, device_id, data) VALUES %s", 
-                        self.buffer)
-                    conn.commit()
-            self.buffer = []
+            with conn.cursor() as cur:
+                if self.compressor is None:
+                    for view, *_ in METRIC_ROLLUPS:
+                        cur.execute(f"CALL refresh_continuous_aggregate('{view}', NULL, NULL);")
+                cur.execute("UPDATE storage_migrations SET finished = TRUE WHERE name = 'jsonb_to_metrics';")
         except Exception as e:
-            logging.error(f"PostgreSQL Flush Error: {e}")
\ No newline at end of file
+            log.warning("Continuous aggregate refresh after migration failed: %s", e)
+        finally:
+            conn.autocommit = False
+        self._migration_done = True
+        print("Metric store migration complete")
+
+    def _query(self, sql, params, fetch=None):
+        with self._read_lock:
+            for attempt in range(2):
+                if self._read_conn is None or self._read_conn.closed:
+                    self._read_conn = self._get_connection()
+                try:
+                    with self._read_conn.cursor() as cur:
+                        cur.execute(sql, params)
+                        result = cur.fetchone() if fetch == "one" else cur.fetchall() if fetch == "all" else None
+                    self._read_conn.commit()
+                    return result
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    # Stale connection after a server restart; reconnect once
+                    self._close(self._read_conn)
+                    self._read_conn = None
+                    if attempt:
+                        raise
+                except Exception:
+                    self._read_conn.rollback()
+                    raise
+
+    def get_cursor(self, name=UPLINK_CURSOR):
+        row = self._query("SELECT seq FROM uplink_cursor WHERE name = %s;", (name,), fetch="one")
+        return row[0] if row else 0
+
+    def set_cursor(self, seq, name=UPLINK_CURSOR):
+        self._query("""
+            INSERT INTO uplink_cursor (name, seq) VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET seq = EXCLUDED.seq;
+        """, (name, seq))
+
+    def fetch_backlog(self, after_seq, limit=BATCH_ROWS):
+        return self._query("""
+            SELECT seq, timestamp, device_id, data FROM device_logs
+            WHERE seq > %s ORDER BY seq LIMIT %s;
+        """, (after_seq, limit), fetch="all")
+
+    def query_range(self, device_id, start, end):
+        return self._query("""
+            SELECT timestamp, data FROM device_logs
+            WHERE device_id = %s AND timestamp >= %s AND timestamp < %s ORDER BY timestamp;
+        """, (str(device_id), start, end), fetch="all")
+
+    def list_days(self, before):
+        # device_logs chunks are one UTC day each
+        rows = self._query("""
+            SELECT range_start FROM timescaledb_information.chunks
+            WHERE hypertable_name = 'device_logs' AND range_end <= %s ORDER BY range_start;
+        """, (before,), fetch="all")
+        return [row[0] for row in rows]
+
+    def day_devices(self, day):
+        rows = self._query("""
+            SELECT DISTINCT device_id FROM device_logs
+            WHERE timestamp >= %s AND timestamp < %s ORDER BY device_id;
+        """, (day, day + timedelta(days=1)), fetch="all")
+        return [row[0] for row in rows]
+
+    def fetch_day(self, day, device_id=None):
+        if device_id is None:
+            return self._query("""
+                SELECT timestamp, device_id, data FROM device_logs
+                WHERE timestamp >= %s AND timestamp < %s ORDER BY device_id, timestamp;
+            """, (day, day + timedelta(days=1)), fetch="all")
+        return self._query("""
+            SELECT timestamp, device_id, data FROM device_logs
+            WHERE device_id = %s AND timestamp >= %s AND timestamp < %s ORDER BY timestamp;
+        """, (str(device_id), day, day + timedelta(days=1)), fetch="all")
+
+    def oldest_unsent(self, name=UPLINK_CURSOR):
+        row = self._query("""
+            SELECT min(l.timestamp) FROM device_logs l JOIN uplink_cursor c ON l.seq > c.seq
+            WHERE c.name = %s;
+        """, (name,), fetch="one")
+        return row[0] if row else None
+
+    def prune_before(self, cutoff):
+        self._query("SELECT drop_chunks('device_logs', older_than => %s);", (cutoff,), fetch="all")
+
+    def error_bound(self, metric, value=0.0):
+        # Max deviation of stored raw metric points from the original samples
+        return self.compressor.errorBound(metric, value) if self.compressor is not None else 0.0
+
+    def query_metric(self, device_id, metric, start, end, resolution="raw"):
+        # resolution: raw, 1m, 15m or 1d; rollups return (bucket, mean, min, max, last)
+        # With compression on, raw points are compressed: use compression.reconstruct() with
+        # compressor.method(metric) to resample them
+        if resolution == "raw":
+            return self._query("""
+                SELECT d.ts, d.value FROM device_metrics d JOIN metric_dict m USING (metric_id)
+                WHERE d.device_id = %s AND m.name = %s AND d.ts >= %s AND d.ts < %s ORDER BY d.ts;
+            """, (str(device_id), metric, start, end), fetch="all")
+        views = {"1m": "device_metrics_1m", "15m": "device_metrics_15m", "1d": "device_metrics_1d"}
+        if resolution not in views:
+            raise ValueError(f"Unknown resolution {resolution}")
+        if self.compressor is not None:
+            return self._rebuilt_rollup(device_id, metric, start, end, ROLLUP_SECONDS[resolution])
+        return self._query(f"""
+            SELECT r.bucket, r.mean, r.min, r.max, r.last FROM {views[resolution]} r JOIN metric_dict m USING (metric_id)
+            WHERE r.device_id = %s AND m.name = %s AND r.bucket >= %s AND r.bucket < %s ORDER BY r.bucket;
+        """, (str(device_id), metric, start, end), fetch="all")
+
+    def _rebuilt_rollup(self, device_id, metric, start, end, seconds):
+        """Rollup rows rebuilt from compressed points at the time of every stored window.
+
+        Compressed points are not a sample of the windows, so they are not aggregated directly. Each
+        rebuilt value is within error_bound() of the window it replaces, so every bucket's mean, min,
+        max and last are within the largest bound of the bucket's values. Window times come from
+        device_logs, so this covers the range still held there; older days are in the archive.
+        """
+        margin = timedelta(seconds=self.compressor.rule(metric)["max_interval"])
+        points = [(ts.timestamp(), value) for ts, value in self._query("""
+            SELECT d.ts, d.value FROM device_metrics d JOIN metric_dict m USING (metric_id)
+            WHERE d.device_id = %s AND m.name = %s AND d.ts >= %s AND d.ts < %s ORDER BY d.ts;
+        """, (str(device_id), metric, start - margin, end + margin), fetch="all")]
+        pending = self.compressor.pending(str(device_id), metric)
+        if pending is not None and (not points or pending[0] > points[-1][0]):
+            points.append(pending)
+        times = [row[0].timestamp() for row in self._query("""
+            SELECT timestamp FROM device_logs
+            WHERE device_id = %s AND timestamp >= %s AND timestamp < %s
+              AND jsonb_typeof(data #> %s) = 'number' ORDER BY timestamp;
+        """, (str(device_id), start, end, metric.split(".")), fetch="all")]
+        buckets = {}
+        for t, value in zip(times, compression.reconstruct(points, times, self.compressor.method(metric))):
+            if value is None:
+                continue
+            bucket = buckets.get(t // seconds * seconds)
+            if bucket is None:
+                buckets[t // seconds * seconds] = [1, value, value, value, value]
+            else:
+                bucket[0] += 1
+                bucket[1] += value
+                bucket[2] = min(bucket[2], value)
+                bucket[3] = max(bucket[3], value)
+                bucket[4] = value
+        return [(datetime.fromtimestamp(start_t, tz=timezone.utc), total / count, low, high, last)
+                for start_t, (count, total, low, high, last) in sorted(buckets.items())]
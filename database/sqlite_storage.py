@@ -0,0 +1,193 @@
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from utils import fastlog
+from database.storage_backend import StorageBackend, UPLINK_CURSOR, QUEUE_SIZE, BATCH_ROWS, FLUSH_INTERVAL, SPILL_MAX_BYTES
+
+log = fastlog.getLogger("sqlite_storage")
+
+PARTITION_PREFIX = "device_logs_"
+RETENTION_CHECK_INTERVAL = 3600
+
+def partitionName(capture_time):
+    return PARTITION_PREFIX + capture_time.astimezone(pytz.utc).strftime("%Y%m%d")
+
+def toEpoch(value):
+    return value.timestamp() if isinstance(value, datetime) else float(value)
+
+class SQLiteStorage(StorageBackend):
+    """Embedded store for controllers without PostgreSQL: WAL, one transaction per batch, one table per UTC day."""
+
+    name = "SQLiteStorage"
+    transient_errors = (sqlite3.OperationalError,)
+
+    def __init__(self, db_path, retention_days=90, queue_size=QUEUE_SIZE, batch_rows=BATCH_ROWS, flush_interval=FLUSH_INTERVAL,
+                 spill_path=None, spill_max_bytes=SPILL_MAX_BYTES):
+        print("Initializing SQLiteStorage...")
+        super().__init__(queue_size, batch_rows, flush_interval, spill_path, spill_max_bytes)
+        self.db_path = db_path
+        self.retention_days = retention_days
+        self._write_conn = self._connect()
+        self._read_conn = self._connect()
+        self._read_lock = threading.Lock()
+        self._partitions = set()
+        self._last_retention = None
+        self._prune_before = None
+        self._init_db()
+        self.start()
+
+    def _connect(self):
+        # Autocommit mode; batches use explicit BEGIN IMMEDIATE so the write lock is taken up front
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        with self._stats_lock:
+            self._stats["connects"] += 1
+        return conn
+
+    def _init_db(self):
+        conn = self._write_conn
+        conn.execute("CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);")
+        conn.execute("CREATE TABLE IF NOT EXISTS uplink_cursor (name TEXT PRIMARY KEY, seq INTEGER NOT NULL);")
+        conn.execute("INSERT OR IGNORE INTO storage_meta (key, value) VALUES ('last_seq', 0);")
+        conn.execute("INSERT OR IGNORE INTO uplink_cursor (name, seq) VALUES (?, 0);", (UPLINK_CURSOR,))
+        self.last_seq = conn.execute("SELECT value FROM storage_meta WHERE key = 'last_seq';").fetchone()[0]
+        self._partitions = set(self._list_partitions(conn))
+        print("SQLite storage initialized successfully")
+
+    def _list_partitions(self, conn):
+        rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ? ORDER BY name;",
+                            (PARTITION_PREFIX + "[0-9]*",)).fetchall()
+        return [row[0] for row in rows]
+
+    def _ensure_partition(self, conn, table):
+        if table in self._partitions:
+            return
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                seq INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                device_id TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+        """)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_device_ts ON {table} (device_id, ts);")
+        self._partitions.add(table)
+
+    def _write_rows(self, rows):
+        conn = self._write_conn
+        seq = self.last_seq
+        by_partition = {}
+        for capture_time, device_id, data, _ in rows:
+            seq += 1
+            by_partition.setdefault(partitionName(capture_time), []).append((seq, capture_time.timestamp(), device_id, data))
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            for table, values in by_partition.items():
+                self._ensure_partition(conn, table)
+                conn.executemany(f"INSERT INTO {table} (seq, ts, device_id, data) VALUES (?, ?, ?, ?);", values)
+            conn.execute("UPDATE storage_meta SET value = ? WHERE key = 'last_seq';", (seq,))
+            conn.execute("COMMIT;")
+        except Exception:
+            conn.execute("ROLLBACK;")
+            # Tables created inside the rolled-back transaction are gone again
+            self._partitions = set(self._list_partitions(conn))
+            raise
+        self.last_seq = seq
+
+    def _idle(self):
+        if self._last_retention is not None and time.monotonic() - self._last_retention < RETENTION_CHECK_INTERVAL:
+            return
+        self._last_retention = time.monotonic()
+        # Retention is a DROP TABLE per expired day instead of a large DELETE
+        cutoff = partitionName(datetime.now(pytz.utc) - timedelta(days=self.retention_days))
+        if self._prune_before is not None:
+            cutoff = max(cutoff, self._prune_before)
+        for table in self._list_partitions(self._write_conn):
+            if table < cutoff:
+                self._write_conn.execute(f"DROP TABLE IF EXISTS {table};")
+                self._partitions.discard(table)
+                log.info("Dropped expired partition %s", table)
+
+    def _read(self, sql, params=()):
+        with self._read_lock:
+            return self._read_conn.execute(sql, params).fetchall()
+
+    def get_cursor(self, name=UPLINK_CURSOR):
+        rows = self._read("SELECT seq FROM uplink_cursor WHERE name = ?;", (name,))
+        return rows[0][0] if rows else 0
+
+    def set_cursor(self, seq, name=UPLINK_CURSOR):
+        with self._read_lock:
+            self._read_conn.execute("""
+                INSERT INTO uplink_cursor (name, seq) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET seq = excluded.seq;
+            """, (name, seq))
+
+    def fetch_backlog(self, after_seq, limit=BATCH_ROWS):
+        with self._read_lock:
+            partitions = self._list_partitions(self._read_conn)
+        if not partitions:
+            return []
+        # Offline windows can land in older day tables, so the seq range spans every partition
+        union = " UNION ALL ".join(f"SELECT seq, ts, device_id, data FROM {table} WHERE seq > ?" for table in partitions)
+        rows = self._read(f"{union} ORDER BY seq LIMIT ?;", tuple([after_seq] * len(partitions)) + (limit,))
+        return [(seq, datetime.fromtimestamp(ts, tz=pytz.utc), device_id, json.loads(data)) for seq, ts, device_id, data in rows]
+
+    def query_range(self, device_id, start, end):
+        start_ts, end_ts = toEpoch(start), toEpoch(end)
+        first = partitionName(datetime.fromtimestamp(start_ts, tz=pytz.utc))
+        last = partitionName(datetime.fromtimestamp(end_ts, tz=pytz.utc))
+        with self._read_lock:
+            partitions = [t for t in self._list_partitions(self._read_conn) if first <= t <= last]
+        if not partitions:
+            return []
+        union = " UNION ALL ".join(f"SELECT ts, data FROM {table} WHERE device_id = ? AND ts >= ? AND ts < ?" for table in partitions)
+        rows = self._read(f"{union} ORDER BY ts;", tuple((str(device_id), start_ts, end_ts) * len(partitions)))
+        return [(datetime.fromtimestamp(ts, tz=pytz.utc), json.loads(data)) for ts, data in rows]
+
+    def list_days(self, before):
+        cutoff = partitionName(before)
+        with self._read_lock:
+            partitions = self._list_partitions(self._read_conn)
+        return [pytz.utc.localize(datetime.strptime(t[len(PARTITION_PREFIX):], "%Y%m%d")) for t in partitions if t < cutoff]
+
+    def day_devices(self, day):
+        table = partitionName(day)
+        with self._read_lock:
+            if table not in self._list_partitions(self._read_conn):
+                return []
+        return [row[0] for row in self._read(f"SELECT DISTINCT device_id FROM {table} ORDER BY device_id;")]
+
+    def fetch_day(self, day, device_id=None):
+        table = partitionName(day)
+        with self._read_lock:
+            if table not in self._list_partitions(self._read_conn):
+                return []
+        if device_id is None:
+            rows = self._read(f"SELECT ts, device_id, data FROM {table} ORDER BY device_id, ts;")
+        else:
+            rows = self._read(f"SELECT ts, device_id, data FROM {table} WHERE device_id = ? ORDER BY ts;", (str(device_id),))
+        return [(datetime.fromtimestamp(ts, tz=pytz.utc), device_id, json.loads(data)) for ts, device_id, data in rows]
+
+    def oldest_unsent(self, name=UPLINK_CURSOR):
+        cursor = self.get_cursor(name)
+        with self._read_lock:
+            partitions = self._list_partitions(self._read_conn)
+        if not partitions:
+            return None
+        union = " UNION ALL ".join(f"SELECT min(ts) AS ts FROM {table} WHERE seq > ?" for table in partitions)
+        rows = self._read(f"SELECT min(ts) FROM ({union});", tuple([cursor] * len(partitions)))
+        ts = rows[0][0] if rows else None
+        return datetime.fromtimestamp(ts, tz=pytz.utc) if ts is not None else None
+
+    def prune_before(self, cutoff):
+        # DROP TABLE runs on the writer connection so the partition cache stays consistent
+        self._prune_before = partitionName(cutoff)
+        self._last_retention = None
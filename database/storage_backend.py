@@ -0,0 +1,313 @@
+import json
+import os
+import queue
+import threading
+import time
+import logging
+from datetime import datetime
+
+import pytz
+
+from utils import fastlog
+
+log = fastlog.getLogger("storage_backend")
+
+UPLINK_CURSOR = "cloud_report"
+QUEUE_SIZE = 2000
+BATCH_ROWS = 500
+FLUSH_INTERVAL = 2.0
+PUT_TIMEOUT = 5.0
+MAX_RECONNECT_DELAY = 60
+STATS_INTERVAL = 300
+SPILL_MAX_BYTES = 64 * 1024 * 1024
+
+class _FlushMarker:
+    __slots__ = ("done",)
+
+    def __init__(self):
+        self.done = threading.Event()
+
+class StorageBackend:
+    """Report store used by dataBank: bounded queue, one writer thread, uplink cursor and range reads.
+
+    Rows are (capture_time, device_id, data_json, data) tuples. Subclasses implement _write_rows and
+    the query methods; transient_errors are retried with backoff, anything else drops the batch.
+    """
+
+    name = "storage"
+    transient_errors = ()
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch_rows=BATCH_ROWS, flush_interval=FLUSH_INTERVAL,
+                 spill_path=None, spill_max_bytes=SPILL_MAX_BYTES):
+        self.batch_rows = batch_rows
+        self.spill_path = spill_path
+        self.spill_max_bytes = spill_max_bytes
+        self._spill_lock = threading.Lock()
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.on_commit = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "rows_written": 0,
+            "batches": 0,
+            "dropped": 0,
+            "spilled": 0,
+            "replayed": 0,
+            "connects": 0,
+            "last_flush_latency": 0.0,
+            "max_flush_latency": 0.0,
+        }
+        self._rate_rows = 0
+        self._rate_start = time.monotonic()
+        self._rows_per_s = 0.0
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer, name=f"{type(self).__name__}Writer", daemon=True)
+            self._thread.start()
+
+    def _capture_time(self, device_id, payload_timestamp):
+        # Resolve capture timestamp directly from payload data if available
+        if isinstance(payload_timestamp, (int, float)):
+            try:
+                return datetime.fromtimestamp(payload_timestamp, tz=pytz.utc)
+            except Exception as e:
+                logging.error(f"Timestamp parsing error for {device_id}: {e}. Using system time.")
+        return datetime.now(pytz.utc)
+
+    def _enqueue(self, rows):
+        # Blocks the producer for up to PUT_TIMEOUT when the writer falls behind, then spills to disk
+        try:
+            self.queue.put(rows, timeout=PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+        if self._spill(rows):
+            return True
+        with self._stats_lock:
+            self._stats["dropped"] += len(rows)
+        log.error("%s queue full, dropped %d rows", self.name, len(rows), every=60)
+        return False
+
+    def _spill(self, rows):
+        # One JSON line per queue item, so a window is replayed as one write
+        if self.spill_path is None:
+            return False
+        line = json.dumps([[row[0].timestamp(), row[1], row[2]] for row in rows]) + "\n"
+        with self._spill_lock:
+            try:
+                size = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+                if size + len(line) > self.spill_max_bytes:
+                    log.error("%s spill file is full (%d bytes)", self.name, size, every=60)
+                    return False
+                with open(self.spill_path, "a") as spill_file:
+                    spill_file.write(line)
+            except OSError as e:
+                log.error("%s unable to spill rows: %s", self.name, e, every=60)
+                return False
+        with self._stats_lock:
+            self._stats["spilled"] += len(rows)
+        log.warning("%s queue full, spilled %d rows to %s", self.name, len(rows), self.spill_path, every=60)
+        return True
+
+    def _replaySpill(self):
+        # Writer thread only, once the queue has drained; rows written before a crash may be written twice
+        if self.spill_path is None or self.queue.qsize() > self.queue.maxsize // 2:
+            return False
+        replay_path = self.spill_path + ".replay"
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spill_path):
+                    return False
+                os.replace(self.spill_path, replay_path)
+        replayed = 0
+        with open(replay_path) as replay_file:
+            for line in replay_file:
+                try:
+                    items = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.error(f"{self.name} skipping corrupt spill line")
+                    continue
+                rows = [(datetime.fromtimestamp(ts, tz=pytz.utc), device_id, data_json, json.loads(data_json))
+                        for ts, device_id, data_json in items]
+                if rows and self._write_batch(rows):
+                    replayed += len(rows)
+        os.remove(replay_path)
+        with self._stats_lock:
+            self._stats["replayed"] += replayed
+        log.info("%s replayed %d spilled rows", self.name, replayed)
+        return replayed > 0
+
+    def save_device_data(self, device_id, data_dict, payload_timestamp=None):
+        # 'type' is kept so the stored row can be replayed to the cloud as-is
+        row = (self._capture_time(device_id, payload_timestamp), str(device_id), json.dumps(data_dict), data_dict)
+        return self._enqueue([row])
+
+    def save_window(self, report):
+        # One queue item per window keeps its rows in a single write and contiguous in seq
+        payload_ts = report.get("timestamp")
+        rows = [(self._capture_time(key, payload_ts), str(key), json.dumps(value), value)
+                for key, value in report.items() if key != "timestamp"]
+        if not rows:
+            return True
+        return self._enqueue(rows)
+
+    def flush(self, timeout=30):
+        marker = _FlushMarker()
+        try:
+            self.queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(timeout)
+
+    def _write_rows(self, rows):
+        raise NotImplementedError
+
+    def _idle(self):
+        pass
+
+    def _write_batch(self, rows, items=None):
+        # Retries until the batch lands; the bounded queue pushes back on producers meanwhile.
+        # items are the queue items (windows) the batch was drained from, used to isolate a bad one
+        delay = 1
+        while True:
+            start = time.monotonic()
+            try:
+                self._write_rows(rows)
+                break
+            except self.transient_errors as e:
+                log.error("%s write failed, retrying: %s", self.name, e, every=60)
+            except Exception as e:
+                if items is not None and len(items) > 1:
+                    log.error("%s write error, retrying %d windows one by one: %s", self.name, len(items), e, every=60)
+                    written = [self._write_batch(item) for item in items]
+                    return any(written)
+                log.error("%s write error, dropping %d rows: %s", self.name, len(rows), e, every=60)
+                with self._stats_lock:
+                    self._stats["dropped"] += len(rows)
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+        latency = time.monotonic() - start
+        with self._stats_lock:
+            self._stats["rows_written"] += len(rows)
+            self._stats["batches"] += 1
+            self._stats["last_flush_latency"] = latency
+            self._stats["max_flush_latency"] = max(self._stats["max_flush_latency"], latency)
+            self._rate_rows += len(rows)
+        log.debug("%s stored %d records in %.3fs", self.name, len(rows), latency)
+        return True
+
+    def _writer(self):
+        last_stats = time.monotonic()
+        while True:
+            rows = []
+            items = []
+            markers = []
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            # Drain whatever is already queued into one batch
+            while item is not None:
+                if isinstance(item, _FlushMarker):
+                    markers.append(item)
+                else:
+                    rows.extend(item)
+                    items.append(item)
+                if len(rows) >= self.batch_rows:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = None
+
+            if rows and self._write_batch(rows, items) and self.on_commit is not None:
+                try:
+                    self.on_commit()
+                except Exception as e:
+                    logging.error(f"{self.name} commit callback failed: {e}")
+            for marker in markers:
+                marker.done.set()
+            if not rows:
+                try:
+                    if self._replaySpill() and self.on_commit is not None:
+                        self.on_commit()
+                    self._idle()
+                except Exception as e:
+                    logging.error(f"{self.name} maintenance failed: {e}")
+
+            if time.monotonic() - last_stats >= STATS_INTERVAL:
+                last_stats = time.monotonic()
+                log.info("%s stats: %s", self.name, fastlog.lazyJson(self.stats()))
+
+    def stats(self):
+        with self._stats_lock:
+            now = time.monotonic()
+            elapsed = now - self._rate_start
+            if elapsed >= 1.0:
+                self._rows_per_s = self._rate_rows / elapsed
+                self._rate_rows = 0
+                self._rate_start = now
+            stats = dict(self._stats)
+        stats["rows_per_s"] = round(self._rows_per_s, 2)
+        stats["queue_depth"] = self.queue.qsize()
+        stats["last_flush_latency"] = round(stats["last_flush_latency"], 4)
+        stats["max_flush_latency"] = round(stats["max_flush_latency"], 4)
+        return stats
+
+    def get_cursor(self, name=UPLINK_CURSOR):
+        raise NotImplementedError
+
+    def set_cursor(self, seq, name=UPLINK_CURSOR):
+        raise NotImplementedError
+
+    def fetch_backlog(self, after_seq, limit=BATCH_ROWS):
+        # Returns (seq, capture_time, device_id, data) ordered by seq
+        raise NotImplementedError
+
+    def query_range(self, device_id, start, end):
+        # Returns (capture_time, data) for one device in [start, end)
+        raise NotImplementedError
+
+    def list_days(self, before):
+        # UTC days (midnight datetimes) that still hold rows, oldest first, ending before `before`
+        raise NotImplementedError
+
+    def day_devices(self, day):
+        # Device ids with rows on one UTC day, sorted
+        raise NotImplementedError
+
+    def fetch_day(self, day, device_id=None):
+        # Returns (capture_time, device_id, data) for one UTC day ordered by device_id, capture_time;
+        # device_id limits it to one device so a day can be read a device at a time
+        raise NotImplementedError
+
+    def oldest_unsent(self, name=UPLINK_CURSOR):
+        # Capture time of the oldest row past the uplink cursor, None when everything was shipped
+        raise NotImplementedError
+
+    def prune_before(self, cutoff):
+        # Drops whole UTC days before cutoff; backends may finish this on the writer thread
+        raise NotImplementedError
+
+def createStorage(storage_cfg, db_params, spill_path=None):
+    # "backend": "timescale" (default) or "sqlite"; drivers are imported only for the chosen backend
+    backend = storage_cfg.get("backend", "timescale")
+    spill_path = storage_cfg.get("spill_path", spill_path)
+    spill_max_bytes = storage_cfg.get("spill_max_bytes", SPILL_MAX_BYTES)
+    if backend == "sqlite":
+        from database.sqlite_storage import SQLiteStorage
+        return SQLiteStorage(storage_cfg.get("sqlite_path", "edge_storage.db"),
+                             retention_days=storage_cfg.get("retention_days", 90),
+                             spill_path=spill_path, spill_max_bytes=spill_max_bytes)
+    if backend != "timescale":
+        logging.error(f"Unknown storage backend {backend}, using timescale")
+    from database.local_storage import LocalStorage
+    return LocalStorage(db_params,
+                        metric_store=storage_cfg.get("metric_store", False),
+                        jsonb_retention_days=storage_cfg.get("jsonb_retention_days", 90),
+                        compression_rules=storage_cfg.get("compression", False),
+                        spill_path=spill_path, spill_max_bytes=spill_max_bytes)
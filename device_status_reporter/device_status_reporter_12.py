@@ -1,18 +1,35 @@
 import time
-import requests
 import logging
+from threading import Lock
 import control.control_base as ctrl
+from utils import scheduler
+from uplink import http_client
+from uplink import priority_scheduler
+
+# A device is offline after this many failed reads in a row, or when its last good read is too old
+OFFLINE_ERRORS = 3
+OFFLINE_AFTER = 180
 
 class DeviceStatusReporter:
-    def __init__(self, poll_interval=60):
+    """Online/offline from the acquisition layer's read health, posted per device as soon as it changes.
+
+    check_and_report() runs after every acquisition cycle; the scheduled task is only a watchdog
+    that marks devices offline when the acquisition loop itself stops.
+    """
+
+    def __init__(self, poll_interval=60, offline_errors=OFFLINE_ERRORS, offline_after=OFFLINE_AFTER):
         self.last_known_statuses = {}
         self.poll_interval = poll_interval
+        self.offline_errors = offline_errors
+        self.offline_after = offline_after
+        self.lock = Lock()
         self.api_url = "https://app.enercog.com/ui/client/no-auth/device-status"
-        self.session = requests.Session()
+        # The status lane retries failed posts, so the client does not retry inline
+        http_client.shared_client.register("device_status", self.api_url, timeout=10, retries=0)
         self.logger = logging.getLogger("DeviceStatusReporter")
         self.logger.setLevel(logging.INFO)
-        
-        self.logger.propagate = False 
+
+        self.logger.propagate = False
 
         if not self.logger.handlers:
             handler = logging.StreamHandler()
@@ -20,95 +37,49 @@ class DeviceStatusReporter:
             handler.setFormatter(formatter)
             self.logger.addHandler(handler)
 
-    def check_and_report(self):
-        try:
-            all_data = ctrl.getAllData()
-        except Exception as e:
-            self.logger.error(f"Could not get all data: {e}")
-            return
-        
-        if not all_data:
-            self.logger.info("No data available to check.")
-            return
-
-        current_statuses_payload = {}
-        report_timestamp = all_data.get("timestamp", int(time.time())) * 1000
-
-        for device_id, device_data in all_data.items():
-            if device_id == "timestamp":
-                continue
-            
-            if not isinstance(device_data, dict):
-                self.logger.warning(f"Skipping invalid data for device_id: {device_id}")
-                continue
+    def _device_status(self, device, now):
+        health = ctrl.getCommHealth(device)
+        online = (health["last_read_ok"] > 0
+                  and now - health["last_read_ok"] <= self.offline_after
+                  and health["consecutive_errors"] < self.offline_errors)
+        device_status_block = {"status": "online" if online else "offline"}
+        for category, flags in ctrl.getComponentActivity(device).items():
+            device_status_block[category] = {name: "online" if online and active else "offline" for name, active in flags.items()}
+        return device_status_block
 
-            device_status_block = {}
-            
-            total_power = device_data.get("total_power")
-            irradiance = device_data.get("global_tilt_irradiance")
-            voltage = device_data.get("voltage")
-
-            if total_power is not None:
-                device_status_block["status"] = "online" if total_power > 0 else "offline"
-            elif irradiance is not None:
-                device_status_block["status"] = "online" if irradiance > 0 else "offline"
-            elif voltage is not None:
-                device_status_block["status"] = "online" if voltage > 0 else "offline"
-            else:
-                device_status_block["status"] = "offline"
-
-            mppt_data = device_data.get("mppt")
-            if mppt_data and isinstance(mppt_data, dict):
-                mppt_status = {}
-                for key, value in mppt_data.items():
-                    if key.endswith("_current") and "mppt" in key:
-                        mppt_name = key.replace("_current", "").replace("mppt", "mppt_")
-                        mppt_status[mppt_name] = "online" if value and value > 0 else "offline"
-                if mppt_status:
-                    device_status_block["mppt"] = mppt_status
-
-            string_data = device_data.get("string")
-            if string_data and isinstance(string_data, dict):
-                string_status = {}
-                for key, value in string_data.items():
-                    if key.endswith("_current") and "string" in key:
-                        string_name = key.replace("_current", "").replace("string", "string_")
-                        string_status[string_name] = "online" if value and value > 0 else "offline"
-                if string_status:
-                    device_status_block["string"] = string_status
-            
-            current_statuses_payload[device_id] = device_status_block
+    def _post(self, payload):
+        response = http_client.shared_client.post("device_status", payload)
+        if response.status_code < 400:
+            self.logger.info(f"API update successful (Code: {response.status_code}).")
+            return True
+        if response.status_code < 500 and response.status_code not in priority_scheduler.RETRYABLE_CLIENT_STATUS:
+            self.logger.error(f"API rejected status update (Code: {response.status_code}), dropping it.")
+            return True
+        self.logger.error(f"API update failed (Code: {response.status_code}), will retry.")
+        return False
 
-        if not current_statuses_payload:
-            self.logger.info("No device data processed.")
-            return
+    def check_and_report(self):
+        now = time.time()
+        changed = {}
+        with self.lock:
+            for device in ctrl.device_list:
+                # Only modbus reads record comm health
+                if device.comm_type not in (ctrl.commType.modbus_tcp, ctrl.commType.modbus_rtu):
+                    continue
+                device_id = str(device.device_id)
+                device_status_block = self._device_status(device, now)
+                if self.last_known_statuses.get(device_id) != device_status_block:
+                    changed[device_id] = device_status_block
+                    self.last_known_statuses[device_id] = device_status_block
 
-        if self.last_known_statuses == current_statuses_payload:
-            self.logger.info("No status changes detected.")
+        if not changed:
             return
 
-        self.logger.info("Status change detected. Sending new payload.")
-        
-        final_payload_dict = {"timestamp": report_timestamp}
-        final_payload_dict.update(current_statuses_payload)
-        payload = [final_payload_dict]
-        
-        self.logger.info(f"Sending payload: {payload}")
-        
-        try:
-            response = self.session.post(self.api_url, json=payload, timeout=10)
-            response.raise_for_status()
-            self.last_known_statuses = current_statuses_payload
-            self.logger.info(f"API update successful (Code: {response.status_code}).")
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"API update failed: {e}")
-
-    def run(self):
-        self.logger.info("Device Status Reporter thread started.")
-        startup_delay = 20
-        self.logger.info(f"Waiting for a {startup_delay}-second grace period before the first check.")
-        time.sleep(startup_delay)
+        payload = [{"timestamp": int(now * 1000), **changed}]
+        self.logger.info(f"Status change detected for {len(changed)} device(s). Sending payload: {payload}")
+        priority_scheduler.shared_uplink.submit(priority_scheduler.STATUS, lambda: self._post(payload), len(str(payload)), retry=True)
 
-        while True:
-            self.check_and_report()
-            time.sleep(self.poll_interval)
\ No newline at end of file
+    def run(self, sched=None):
+        self.logger.info("Device Status Reporter watchdog task registered.")
+        sched = sched or scheduler.shared_scheduler
+        sched.add_task("StatusReporter", self.check_and_report, self.poll_interval, align=True, start_delay=self.poll_interval)
@@ -1,14 +1,137 @@
 import json
-import time
 import logging
-import requests
-from control import control_base as ctrl
+import bisect
+from utils import fastlog
+from uplink import http_client
+from uplink import priority_scheduler
+
+log = fastlog.getLogger("fault_reporting")
+
+FAULT_WORDS = ("fault", "warning")
+CLEARED_MESSAGES = {"fault": "Fault Cleared", "warning": "Warning Cleared"}
+# Consecutive reads a new word value must hold before it is reported; clears are debounced
+# so a chattering fault bit does not flood the alert endpoint
+RAISE_CYCLES = 1
+CLEAR_CYCLES = 2
+
+def faultObject(code, info):
+    return {
+        "fault_code": code,
+        "fault_message": info.get("fault_message"),
+        "severity": info.get("severity")
+    }
+
+class FaultDecoder:
+    """One part number's fault word decoder, compiled once from its error_codes.json entry."""
+
+    def __init__(self, config):
+        self.type = config.get("type")
+        definitions = config.get("codes", {})
+        self.bits = []
+        self.exact = {}
+        self.starts = []
+        self.ranges = []
+        if self.type == 'bitfield':
+            for bit_pos_str, fault_info in definitions.items():
+                try:
+                    self.bits.append((1 << int(bit_pos_str), bit_pos_str, fault_info))
+                except ValueError:
+                    logging.error(f"Invalid bit position {bit_pos_str} in error codes")
+        elif self.type == 'hexadecimal':
+            # "0x1a" wins over "1a" when both are defined, as in the old string lookup
+            for hex_key in sorted(definitions, key=lambda k: k.lower().startswith("0x")):
+                try:
+                    self.exact[int(hex_key, 16)] = definitions[hex_key]
+                except ValueError:
+                    logging.error(f"Invalid hexadecimal code {hex_key} in error codes")
+        elif self.type == 'code':
+            self._compileCodes(definitions)
+
+    def _compileCodes(self, definitions):
+        # The first key in file order that matches a code wins; ranges are flattened into
+        # disjoint sorted segments so a lookup is one dict probe plus one bisect
+        exact = {}
+        intervals = []
+        for order, (complex_key, fault_info) in enumerate(definitions.items()):
+            for part in complex_key.split('|'):
+                try:
+                    if '-' in part:
+                        range_parts = part.split('-')
+                        if len(range_parts) == 2:
+                            start, end = int(range_parts[0]), int(range_parts[1])
+                            if start <= end:
+                                intervals.append((start, end, order, fault_info))
+                    else:
+                        exact.setdefault(int(part), (order, fault_info))
+                except ValueError:
+                    continue
+        self.exact = exact
+        bounds = sorted({start for start, _, _, _ in intervals} | {end + 1 for _, end, _, _ in intervals})
+        for lo, hi in zip(bounds, bounds[1:]):
+            covering = [(order, info) for start, end, order, info in intervals if start <= lo and hi - 1 <= end]
+            if not covering:
+                continue
+            winner = min(covering, key=lambda item: item[0])
+            if self.ranges and self.ranges[-1][1] == lo - 1 and self.ranges[-1][2] is winner[1]:
+                self.ranges[-1] = (self.ranges[-1][0], hi - 1, winner[1], winner[0])
+                continue
+            self.starts.append(lo)
+            self.ranges.append((lo, hi - 1, winner[1], winner[0]))
+
+    def _lookupCode(self, fault_code):
+        found = self.exact.get(fault_code)
+        index = bisect.bisect_right(self.starts, fault_code) - 1
+        if index >= 0:
+            start, end, info, order = self.ranges[index]
+            if fault_code <= end and (found is None or order < found[0]):
+                return info
+        return found[1] if found is not None else None
+
+    def decode(self, fault_code):
+        """Active faults for a non-zero fault word as a list of fault objects (empty when unknown)."""
+        if self.type == 'bitfield':
+            return [faultObject(bit_pos_str, info) for mask, bit_pos_str, info in self.bits if fault_code & mask]
+        if self.type == 'hexadecimal':
+            info = self.exact.get(fault_code)
+            return [faultObject(hex(fault_code), info)] if info else []
+        if self.type == 'code':
+            info = self._lookupCode(fault_code)
+            return [faultObject(str(fault_code), info)] if info else []
+        return []
+
+def compileDecoders(error_map, word="fault"):
+    decoders = {}
+    for part_num, part_config in error_map.items():
+        device_config = part_config.get(word.capitalize(), part_config.get(word, {}))
+        if device_config:
+            decoders[part_num] = FaultDecoder(device_config)
+    return decoders
+
+class _WordState:
+    __slots__ = ("reported", "candidate", "candidate_ts", "count")
+
+    def __init__(self, value):
+        self.reported = value
+        self.candidate = None
+        self.candidate_ts = 0
+        self.count = 0
 
 class FaultProcessor:
-    def __init__(self, error_codes_path='error_codes.json', poll_interval=5):
+    """Edge detector over each device's fault/warning words, fed by the acquisition cycle.
+
+    observe() runs after every successful device read; confirmed transitions are decoded, stamped
+    with the capture time of the read that first saw them and posted on the durable alert lane
+    of the uplink scheduler, which retries them until the cloud accepts them.
+    """
+
+    def __init__(self, error_codes_path='error_codes.json', raise_cycles=RAISE_CYCLES, clear_cycles=CLEAR_CYCLES):
         self.api_url = "https://app.enercog.com/ui/client/no-auth/timescaledb/save-alerts"
-        self.last_faults = {}
-        self.poll_interval = poll_interval
+        # The alert lane retries with its own backoff; retries here would hold the link
+        http_client.shared_client.register("alerts", self.api_url, timeout=10, retries=0)
+        self.raise_cycles = raise_cycles
+        self.clear_cycles = clear_cycles
+        self.states = {}
+        self.uplink = None
         self._running = False
         try:
             with open(error_codes_path) as error_json:
@@ -16,136 +139,73 @@ class FaultProcessor:
         except (FileNotFoundError, json.JSONDecodeError) as e:
             logging.critical(f"Failed to load error codes file: {e}")
             self.error_map = {}
-
-    def _send_faults_to_api(self, payload: list):
-        if not payload:
-            return
-        
-        print(f"--- FaultProcessor: PAYLOAD TO BE SENT:\n{json.dumps(payload, indent=4)} ---")
-        try:
-            response = requests.post(self.api_url, json=payload, timeout=10)
-            response.raise_for_status()
-            fault_object = payload[0]
-            device_count = len(fault_object) - 1
-            logging.info(f"Successfully sent new fault data for {device_count} device(s) to API.")
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Failed to send faults to API: {e}")
+        self.decoders = {word: compileDecoders(self.error_map, word) for word in FAULT_WORDS}
 
     def stop(self):
         self._running = False
         logging.info("Fault processor stop signal received.")
 
-    def run(self):
-        self._running = True
-        
+    def run(self, uplink=None):
         if not self.error_map:
             logging.critical("Fault processor cannot run, error map is not loaded.")
             return
 
-        while self._running:
-            try:
-                fault_data = ctrl.getFaultData()
-                print(f"--- FaultProcessor: Received data from getFaultData(): {fault_data} ---")
-                
-                new_faults_by_device = {}
-
-                for device_id, fault_dict in fault_data.items():
-                    fault_code = fault_dict.get('fault', 0)
-                    part_num = device_id.split(':')[1]
-                    last_code = self.last_faults.get(device_id)
-
-                    if fault_code == last_code:
-                        continue
-
-                    self.last_faults[device_id] = fault_code
-
-                    if fault_code != 0:
-                        device_config = self.error_map.get(part_num, {}).get("Fault", self.error_map.get(part_num, {}).get("fault", {}))
-                        
-                        if not device_config:
-                            continue
-
-                        fault_type = device_config.get("type")
-                        fault_definitions = device_config.get("codes", {})
-                        
-                        if fault_type == 'bitfield':
-                            active_faults = []
-                            for bit_pos_str, fault_info in fault_definitions.items():
-                                if fault_code & (1 << int(bit_pos_str)):
-                                    active_faults.append({
-                                        "fault_code": bit_pos_str,
-                                        "fault_message": fault_info.get("fault_message"),
-                                        "severity": fault_info.get("severity")
-                                    })
-                            if active_faults:
-                                new_faults_by_device[device_id] = active_faults
-                        
-                        elif fault_type == 'hexadecimal':
-                            hex_key_with_prefix = hex(fault_code).lower()
-                            hex_key_without_prefix = hex_key_with_prefix[2:]
-                            
-                            fault_info = fault_definitions.get(hex_key_with_prefix) or fault_definitions.get(hex_key_without_prefix)
-                            
-                            if fault_info:
-                                fault_obj = {
-                                    "fault_code": hex_key_with_prefix,
-                                    "fault_message": fault_info.get("fault_message"),
-                                    "severity": fault_info.get("severity")
-                                }
-                                new_faults_by_device[device_id] = [fault_obj]
-
-                        elif fault_type == 'code':
-                            found_fault_info = None
-                            
-                            for complex_key, fault_info in fault_definitions.items():
-                                if found_fault_info:
-                                    break
-                                
-                                parts = complex_key.split('|')
-                                
-                                for part in parts:
-                                    try:
-                                        if '-' in part:
-                                            range_parts = part.split('-')
-                                            if len(range_parts) == 2:
-                                                start = int(range_parts[0])
-                                                end = int(range_parts[1])
-                                                if start <= fault_code <= end:
-                                                    found_fault_info = fault_info
-                                                    break
-                                        else:
-                                            if int(part) == fault_code:
-                                                found_fault_info = fault_info
-                                                break
-                                    except ValueError:
-                                        continue 
-                            
-                            if found_fault_info:
-                                fault_obj = {
-                                    "fault_code": str(fault_code),
-                                    "fault_message": found_fault_info.get("fault_message"),
-                                    "severity": found_fault_info.get("severity")
-                                }
-                                new_faults_by_device[device_id] = [fault_obj]
-                        
-                    else:
-                        fault_obj = {
-                            "fault_code": "0",
-                            "fault_message": "Fault Cleared",
-                            "severity": "Info"
-                        }
-                        new_faults_by_device[device_id] = [fault_obj]
-
-                if new_faults_by_device:
-                    payload_object = {
-                        "timestamp": int(time.time()),
-                        **new_faults_by_device
-                    }
-                    self._send_faults_to_api([payload_object])
-
-            except Exception as e:
-                logging.error(f"An unexpected error occurred in the fault processing loop: {e}")
-
-            time.sleep(self.poll_interval)
-        
-        logging.info("Fault processor has stopped.")
\ No newline at end of file
+        self.uplink = uplink or priority_scheduler.shared_uplink
+        self._running = True
+
+    def _decode(self, part_num, word, code):
+        if code == 0:
+            # Warning clears are only meaningful for parts that define warning codes
+            if word != "fault" and part_num not in self.decoders[word]:
+                return []
+            return [{"fault_code": "0", "fault_message": CLEARED_MESSAGES[word], "severity": "Info"}]
+        decoder = self.decoders[word].get(part_num)
+        return decoder.decode(code) if decoder is not None else []
+
+    def _step(self, key, code, capture_ts):
+        # Returns the capture time of a confirmed transition, None while the word is stable or debouncing
+        state = self.states.get(key)
+        if state is None:
+            # First read after start reports the current state, as the poller did
+            self.states[key] = _WordState(code)
+            return capture_ts
+        if code == state.reported:
+            state.candidate = None
+            return None
+        if state.candidate is None or code != state.candidate:
+            state.candidate = code
+            state.candidate_ts = capture_ts
+            state.count = 0
+        state.count += 1
+        if state.count < (self.clear_cycles if code == 0 else self.raise_cycles):
+            return None
+        state.reported = code
+        state.candidate = None
+        return state.candidate_ts
+
+    def observe(self, device_id, words, capture_ts):
+        """Feeds one device read ({"fault": code, "warning": code}) into the edge detector."""
+        if not self._running:
+            return
+        device_id = str(device_id)
+        part_num = device_id.split(':')[1]
+        alerts = []
+        for word, code in words.items():
+            edge_ts = self._step((device_id, word), code, capture_ts)
+            if edge_ts is None:
+                continue
+            decoded = self._decode(part_num, word, code)
+            if decoded:
+                alerts.append((edge_ts, device_id, decoded))
+        if alerts:
+            payload = self._buildPayload(alerts)
+            log.debug("FaultProcessor payload to be sent: %s", fastlog.lazyJson(payload))
+            self.uplink.postAlert("alerts", payload)
+
+    def _buildPayload(self, alerts):
+        # One payload object per capture second, as the cloud groups alerts by "timestamp"
+        by_ts = {}
+        for capture_ts, device_id, decoded in alerts:
+            payload_object = by_ts.setdefault(int(capture_ts), {"timestamp": int(capture_ts)})
+            payload_object.setdefault(device_id, []).extend(decoded)
+        return [by_ts[ts] for ts in sorted(by_ts)]
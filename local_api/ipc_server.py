@@ -0,0 +1,192 @@
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import logging
+
+from utils import fastlog
+from utils import snapshot
+
+log = fastlog.getLogger("ipc_server")
+
+# Frames are a 4-byte big-endian length followed by that many bytes of UTF-8 JSON
+HEADER = struct.Struct(">I")
+MAX_FRAME = 1024 * 1024
+MAX_CLIENTS = 16
+HEARTBEAT = 30.0
+SOCKET_MODE = 0o660
+
+def encodeFrame(message):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    return HEADER.pack(len(body)) + body
+
+def _readExact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+def readFrame(sock):
+    header = _readExact(sock, HEADER.size)
+    if header is None:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ValueError(f"frame of {size} bytes exceeds {MAX_FRAME}")
+    body = _readExact(sock, size)
+    if body is None:
+        return None
+    return json.loads(body)
+
+def selectData(data, devices=None, fields=None):
+    # devices / fields of None mean all; unknown names are left out rather than reported as errors
+    if devices is None and fields is None:
+        return data
+    out = {}
+    for device_id in (data if devices is None else [str(d) for d in devices]):
+        device = data.get(device_id)
+        if device is None:
+            continue
+        out[device_id] = device if fields is None else {name: device[name] for name in fields if name in device}
+    return out
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        if not server.admit():
+            self.request.sendall(encodeFrame({"ok": False, "error": "too many clients"}))
+            return
+        try:
+            while True:
+                try:
+                    request = readFrame(self.request)
+                except (ValueError, json.JSONDecodeError) as e:
+                    self.request.sendall(encodeFrame({"ok": False, "error": f"bad frame: {e}"}))
+                    return
+                if request is None:
+                    return
+                if not isinstance(request, dict):
+                    self.request.sendall(encodeFrame({"ok": False, "error": "request must be an object"}))
+                    continue
+                op = request.get("op")
+                if op == "subscribe":
+                    # The connection stays a delta stream until the client closes it
+                    server.stream(self.request, request.get("devices"), request.get("fields"))
+                    return
+                self.request.sendall(encodeFrame(server.answer(op, request)))
+        except OSError:
+            pass
+        finally:
+            server.release()
+
+class LocalApiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Local read API over a Unix socket for the RpiBackend and on-site HMIs.
+
+    Requests and replies are length-prefixed JSON frames:
+      {"op": "snapshot"}                                -> whole site, as in getAllData()
+      {"op": "query", "devices": [...], "fields": [...]} -> subset of the snapshot
+      {"op": "subscribe", "devices": ..., "fields": ...} -> a snapshot frame, then one delta frame
+                                                          per acquisition cycle with changed fields
+    Every reply is served from the shared snapshot, so clients add no Modbus reads. Unfiltered
+    delta frames are encoded once per cycle and shared by all subscribers.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, site_snapshot=None, max_clients=MAX_CLIENTS):
+        self.path = path
+        self.snapshot = site_snapshot or snapshot.shared_snapshot
+        self.max_clients = max_clients
+        self.clients = 0
+        self.lock = threading.Lock()
+        self._frame_cache = {}
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, _Handler)
+        os.chmod(path, SOCKET_MODE)
+        self._thread = None
+
+    def admit(self):
+        with self.lock:
+            if self.clients >= self.max_clients:
+                return False
+            self.clients += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.clients -= 1
+
+    def answer(self, op, request):
+        version, timestamp, data = self.snapshot.get()
+        if op == "snapshot":
+            return {"ok": True, "version": version, "timestamp": timestamp, "data": data}
+        if op == "query":
+            return {"ok": True, "version": version, "timestamp": timestamp,
+                    "data": selectData(data, request.get("devices"), request.get("fields"))}
+        if op == "ping":
+            return {"ok": True, "version": version}
+        return {"ok": False, "error": f"unknown op {op}"}
+
+    def _deltaFrame(self, version, timestamp, delta):
+        with self.lock:
+            frame = self._frame_cache.get(version)
+            if frame is None:
+                frame = encodeFrame({"type": "delta", "version": version, "timestamp": timestamp, "data": delta})
+                # Subscribers are at most a few versions apart
+                if len(self._frame_cache) >= 8:
+                    self._frame_cache.pop(min(self._frame_cache))
+                self._frame_cache[version] = frame
+            return frame
+
+    def stream(self, sock, devices=None, fields=None):
+        filtered = devices is not None or fields is not None
+        version, timestamp, data = self.snapshot.get()
+        sock.sendall(encodeFrame({"type": "snapshot", "version": version, "timestamp": timestamp,
+                                  "data": selectData(data, devices, fields)}))
+        while True:
+            if not self.snapshot.wait(version, HEARTBEAT):
+                sock.sendall(encodeFrame({"type": "heartbeat", "version": version}))
+                continue
+            entries = self.snapshot.deltasSince(version)
+            if entries is None:
+                # Too far behind for the delta history: resync from the full snapshot
+                version, timestamp, data = self.snapshot.get()
+                sock.sendall(encodeFrame({"type": "snapshot", "version": version, "timestamp": timestamp,
+                                          "data": selectData(data, devices, fields)}))
+                continue
+            for version, timestamp, delta in entries:
+                if not filtered:
+                    sock.sendall(self._deltaFrame(version, timestamp, delta))
+                    continue
+                selected = {device_id: changed for device_id, changed in selectData(delta, devices, fields).items() if changed}
+                if selected:
+                    sock.sendall(encodeFrame({"type": "delta", "version": version, "timestamp": timestamp, "data": selected}))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.serve_forever, name="LocalApiServer", daemon=True)
+            self._thread.start()
+            log.info("Local API listening on %s", self.path)
+
+def startServer(path, site_snapshot=None, max_clients=MAX_CLIENTS):
+    try:
+        server = LocalApiServer(path, site_snapshot, max_clients)
+    except OSError as e:
+        logging.error(f"Unable to open local API socket {path}: {e}")
+        return None
+    server.start()
+    return server
+
+def request(path, message, timeout=5.0):
+    """One request/reply round trip, for scripts and tests on the box."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(encodeFrame(message))
+        return readFrame(sock)
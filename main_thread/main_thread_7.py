@@ -4,42 +4,59 @@ import time
 from modbus_master import modbusmasterapi as mbus
 import json
 import control.control_base as ctrl
+from control import site_plan
 import reports_handling.report_handler as rpthndler
 import path_config
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 from mqtt_master import subscribe
 from getmac import get_mac_address as gma
 from fault_reporting import FaultProcessor
-#from device_status_reporter import DeviceStatusReporter
+from device_status_reporter import DeviceStatusReporter
 from mqtt_master import livedata
+from utils import fastlog
+from utils import scheduler
+from utils import config_watcher
+from utils import snapshot
+from local_api import ipc_server
+from uplink.registration_queue import RegistrationQueue
+from uplink import priority_scheduler
 import sys
 import logging
 
 install_file : bool = False
 send_project_details : bool = False
 logger_enrolled : bool = False
+devices_ready = threading.Event()
+registration_queue : RegistrationQueue = None
+fault_processor : FaultProcessor = None
+status_reporter : DeviceStatusReporter = None
+live_stream : livedata.LiveStream = None
+
+CREATE_PROJECT_DEVICE_URL = "https://app.enercog.com//ui/customer/project/create-project-device"
+START_LIVE_DATA_URL = "https://app.enercog.com/ui/no-auth/start-live-data"
 sys.path.insert(0,'../submodules')
 
 logging.basicConfig(filename="thread_logger.log", level=logging.ERROR, format="%(asctime)s - %(threadName)s - %(message)s")
+log = fastlog.getLogger("main_thread")
 
-def getAddrMapFromPartNum(part,addr_map : dict,ctrl_map:dict={}):
-    with open(path_config.path_cfg.base_path + 'modbus_mappings/mappings.json') as mapfile:
-        mbus_maps = json.load(mapfile)
-        addr_map['map'] = mbus_maps[part]
+def getInstallFilePath():
+    return path_config.path_cfg.base_path + "../submodules/RpiBackend/app/json_files/installer_cfg.json"
 
-    with open(path_config.path_cfg.base_path + 'modbus_mappings/control_registers.json') as ctrlfile:
-        mbus_maps = json.load(ctrlfile)
-        ctrl_map['map'] = mbus_maps[part]
+def getProjectDevicePath():
+    return path_config.path_cfg.base_path + "../submodules/RpiBackend/app/json_files/project_devices.json"
+
+def getSitePlanSources():
+    base_path = path_config.path_cfg.base_path
+    return [getInstallFilePath(), base_path + 'modbus_mappings/mappings.json', base_path + 'modbus_mappings/control_registers.json']
+
+def getSitePlanCachePath():
+    return path_config.path_cfg.base_path + "site_plan.cache"
 
 def readDeviceList():
     print(path_config.path_cfg.base_path)
     global install_file
     global send_project_details
-    install_file_path = path_config.path_cfg.base_path + "../submodules/RpiBackend/app/json_files/installer_cfg.json"
-    os.system("cat " + path_config.path_cfg.base_path + "../submodules/RpiBackend/app/json_files/installer_cfg.json")
-    project_device_path = path_config.path_cfg.base_path + "../submodules/RpiBackend/app/json_files/project_devices.json"
+    install_file_path = getInstallFilePath()
+    project_device_path = getProjectDevicePath()
     
     if(not os.path.exists(project_device_path)):
         send_project_details = True
@@ -47,181 +64,152 @@ def readDeviceList():
         return
     else:
         print("install file present")
-        if(True):
-            try:
-                with open(project_device_path) as project_device_path_file:
-                    project_cfg = json.load(project_device_path_file)
-                url = "https://app.enercog.com//ui/customer/project/create-project-device"
-                session = requests.Session()
-                retries = Retry(
-                    total=5,
-                    backoff_factor=1,
-                    status_forcelist=[500, 502, 503, 504],
-                    allowed_methods=["POST"]
-                )
-                adapter = HTTPAdapter(max_retries=retries)
-                session.mount("https://", adapter)
-                session.mount("http://", adapter)
-
-                response = session.post(url=url, json=project_cfg, verify=False)
-                print(f"Response status: {response.status_code}")
-                print(f"Response body: {response.text}")
-
-                install_file = True
-
-            except Exception as e:
-                print(f"Unexpected error: {e}")
+        try:
+            with open(project_device_path) as project_device_path_file:
+                project_cfg = json.load(project_device_path_file)
+            registration_queue.enqueue("create_project_device", CREATE_PROJECT_DEVICE_URL, project_cfg)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Unexpected error: {e}")
 
     with open(install_file_path) as installer_file:
         installer_cfg = json.load(installer_file)
     ctrl.site_id = installer_cfg["site id"]
     ctrl.controller_id = str(gma())
+    install_file = True
 
-    try:
-        payload = {"project_code": installer_cfg["site id"]}
-        livedataurl = "https://app.enercog.com/ui/no-auth/start-live-data"
-        session = requests.Session()
-        retries = Retry(
-            total=5,
-            backoff_factor=1,
-            status_forcelist=[500, 502, 503, 504],
-            allowed_methods=["POST"]
-        )
-        adapter = HTTPAdapter(max_retries=retries)
-        session.mount("https://", adapter)
-        session.mount("http://", adapter)
-
-        response = session.post(url=livedataurl, json=payload, verify=False)
-        print(f"Response status of LiveDataRestart: {response.status_code}")
-        print(f"Response body: {response.text}")
-
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+    registration_queue.enqueue("start_live_data", START_LIVE_DATA_URL, {"project_code": installer_cfg["site id"]})
 
     global number_of_devices
     number_of_devices = len(installer_cfg["device_list"])
     print('Number of devices is',number_of_devices)
-    i=-1
-    for device in installer_cfg["device_list"]:
-        i+=1
-        for x in device:
-            print(x)
-            
-        device_id = device["device_id"]
-        print(device['phases'])  
-        num_phases = eval(device['num_phases'])
-        
-        phase = [int(s) for s in device["phases"].split(',')]
-
-        if(device['comm_type']== 'modbus-tcp'):
-            devicetype = ctrl.deviceType_l2e[device['device_type']]
-            tcp_details = device['modbus_tcp_details']
-            ip = tcp_details['IP']
-            read_map = {}   
-            ctrl_map={}
-            getAddrMapFromPartNum(device["part_num"],read_map,ctrl_map)
-            
-            if('slave_id' in tcp_details):
-                slave_id = eval(tcp_details['slave_id'])
-            else:
-                slave_id = 1
-            scales={}
-            ctrl.device_list.append(mbus.modbusTCPDevice(devicetype, ctrl.commType.modbus_tcp,ip,port=eval(tcp_details['port']),slave_id=slave_id,address_map=read_map,ctrl_map=ctrl_map,cfg=device))
-            
-        elif(device['comm_type'] == 'modbus-rtu'):
-            devicetype = ctrl.deviceType_l2e[device['device_type']]
-            rtu_details = device['modbus_rtu_details']
-            port = rtu_details['port']
-            slave_id=eval(rtu_details['slave_id'])
-            parity=(rtu_details['parity'])
-            baud = eval(rtu_details['baudrate'])
-            stop_bits=eval(rtu_details['stop_bits'])
-            read_map = {}
-            ctrl_map = {}
-            
-            getAddrMapFromPartNum(device["part_num"],read_map,ctrl_map)
-            scales={}
-            ctrl.device_list.append(mbus.modbusRTUDevice(devicetype,ctrl.commType.modbus_rtu,read_map,ctrl_map,port,parity,stop_bits,baud,slave_id,cfg=device))
-            
-        elif(device['comm_type'] == 'none'):
-            ctrl.device_list.append(ctrl.systemDevice(devicetype=ctrl.deviceType.DG,commtype=ctrl.commType.none))
-
-        ctrl.device_list[-1].device_id = device_id
-        ctrl.device_list[-1].num_phases = num_phases
-        ctrl.device_list[-1].createMeasureRegisterMap()
-        ctrl.device_list[-1].createControlRegisterMap()
-        ctrl.device_list[-1].phase = phase
-        if("rated_power") in device:
-            ctrl.device_list[-1].rated_power = eval(device["rated_power"])
-            print("rated_power is : ")
-            print(ctrl.device_list[-1].rated_power)
-        if("connected_to" in device):
-            ctrl.device_list[-1].connected_to = ctrl.deviceType_l2e[device["connected_to"]]
-            print("connected_to device type is : ")
-            print(device["connected_to"])
-        if("minimum_limit" in device):
-            ctrl.device_list[-1].minimum_limit = eval(device["minimum_limit"])
-            print("dg_lim in main_thread: ",ctrl.device_list[-1].minimum_limit)
-        
-    print("maps are : ")
-
-    site_response = requests.Response()
+
+    config_paths = getSitePlanSources()
+    plan = site_plan.loadSitePlan(getSitePlanCachePath(), config_paths)
+    fresh = plan is None
+    if fresh:
+        plan = site_plan.compileSitePlan(installer_cfg, config_paths[1], config_paths[2])
+    ctrl.device_list.extend(site_plan.buildDevices(plan))
+    if fresh:
+        site_plan.saveSitePlan(getSitePlanCachePath(), config_paths, plan)
+    log.info("Site plan %s with %d devices", "compiled" if fresh else "loaded from cache", len(ctrl.device_list))
+
     for device in ctrl.device_list:
-        print(device.addr_map,device.device_id,device.device_type)
-    with open(path_config.path_cfg.base_path + "status_cfg.json") as status_file:
+        log.debug("map %s %s %s", device.addr_map, device.device_id, device.device_type)
+
+def markSiteCreated(response):
+    status_path = path_config.path_cfg.base_path + "status_cfg.json"
+    with open(status_path) as status_file:
         status_cfg = json.load(status_file)
+    if(not eval(status_cfg["site_created"])):
+        status_cfg["site_created"] = "1"
+        with open(status_path,"w") as status_file:
+            json.dump(status_cfg,status_file)
         print("site create : ",status_cfg["site_created"])
-        if(not eval(status_cfg["site_created"])):
-            with open(site_device_path) as site_device_file:
-                site_device_cfg = json.load(site_device_file)
-                try:
-                    site_response = requests.post("https://app.enercog.com//ui/customer/project/create-project-device",json=site_device_cfg,verify=False)
-                    print(site_response.status_code,site_response.content)
-                    
-                except Exception as e:
-                    print(site_response)
-                    print(e)
-        if(site_response.status_code == 200 or site_response.status_code == 201):
-            status_cfg["site_created"] = "1"
-            with open("status_cfg.json","w") as status_file:
-                json.dump(status_cfg,status_file)
 
-def getData():
-    global install_file
+def getReportCfgPath():
+    return path_config.path_cfg.base_path + "reports_handling/report_cfg.json"
 
-    while( not os.path.exists(path_config.path_cfg.base_path + "devices.json")):
-        install_file = False
-        pass
-    install_file = True
+_read_period_cache = {"mtime": None, "period": None}
 
-    while(install_file):
-        with open(path_config.path_cfg.base_path + "reports_handling/report_cfg.json") as report_file:
-            report_cfg = json.load(report_file)
+def getReadPeriod():
+    # Called on every scheduler tick: the file is only re-read when it changes, and a bad
+    # or half-written file keeps the last good period
+    cache = _read_period_cache
+    try:
+        mtime = os.stat(getReportCfgPath()).st_mtime_ns
+        if mtime != cache["mtime"]:
+            with open(getReportCfgPath()) as report_file:
+                report_cfg = json.load(report_file)
+            cache["period"] = float(report_cfg["reading_period"])
+            cache["mtime"] = mtime
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        if cache["period"] is None:
+            raise
+        log.warning("report_cfg.json unreadable, keeping reading period %ss: %s", cache["period"], e, every=300)
+    return cache["period"]
+
+def getReportSection(name):
+    with open(getReportCfgPath()) as report_file:
+        report_cfg = json.load(report_file)
+    return report_cfg.get(name, {})
 
-        read_period = report_cfg["reading_period"] 
-        for device in ctrl.device_list:
-            try:
-                if(device.comm_type == ctrl.commType.modbus_tcp or device.comm_type == ctrl.commType.modbus_rtu):
-                    device.decodeData(mbus.getModbusData(device))
+def getData():
+    global install_file
 
-            except Exception as e:
-                pass
-                print(e)
+    if(not install_file):
+        if(not devices_ready.is_set()):
+            return
+        install_file = True
 
-        rpthndler.data_handler.aggData(ctrl.getAllData())
-        #ctrl.runSysControlLoop()
+    for device in ctrl.device_list:
+        try:
+            if(device.comm_type == ctrl.commType.modbus_tcp or device.comm_type == ctrl.commType.modbus_rtu):
+                modbusdata = mbus.getModbusData(device)
+                capture_ts = time.time()
+                device.decodeData(modbusdata)
+                # Fault edges are detected per read, stamped with this read's capture time
+                if modbusdata['read'] and fault_processor is not None:
+                    fault_processor.observe(device.device_id, ctrl.getDeviceFaultWords(device), capture_ts)
 
-        if(ctrl.system_operating_details.live_data):
-            print("live_data_timer",ctrl.system_operating_details.live_data_timer)
-            ctrl.system_operating_details.live_data_timer -= 1
-            
+        except Exception as e:
+            log.warning("Read failed for device %s: %s", device.device_id, e, every=60, key=device.device_id)
+
+    if status_reporter is not None:
+        status_reporter.check_and_report()
+
+    all_data = ctrl.getAllData()
+    snapshot.shared_snapshot.update(all_data)
+    rpthndler.data_handler.aggData(all_data)
+    #ctrl.runSysControlLoop()
+
+    # With the fast stream on, the LiveStream task publishes live data and ends the session itself
+    if(ctrl.system_operating_details.live_data and live_stream is None):
+        log.debug("live_data_timer %s", ctrl.system_operating_details.live_data_timer)
+        ctrl.system_operating_details.live_data_timer -= 1
+        if ctrl.system_operating_details.live_data_timer <= 0:
+            ctrl.stopLiveData()
+        else:
             livedata.livdataHandler(ctrl.getLivePower())
-        time.sleep(read_period)
 
 def triggerThreads():
     global install_file
     install_file = False
 
+def startAcquisition(sched):
+    # Runs as soon as devices.json appears; the first cycle fires on the next scheduler tick
+    global live_stream
+    sched.add_task("getData", getData, period=getReadPeriod)
+    # Commands wake this task as soon as they arrive; the period only paces the regular passes
+    if getReportSection("control_loop").get("enabled", False):
+        sched.add_task(ctrl.CONTROL_TASK, ctrl.runSysControlLoop, period=getReadPeriod)
+    stream_cfg = getReportSection("live_stream")
+    if stream_cfg.get("enabled", False) and live_stream is None:
+        live_stream = livedata.LiveStream(period=stream_cfg.get("period", livedata.STREAM_PERIOD),
+                                          duration=stream_cfg.get("duration", livedata.STREAM_DURATION),
+                                          keyframe_interval=stream_cfg.get("keyframe_interval", livedata.KEYFRAME_INTERVAL),
+                                          steps=stream_cfg.get("steps"))
+        sched.add_task("LiveStream", live_stream.tick, period=live_stream.period)
+    rpthndler.data_handler.runDataLoop(sched)
+
+def startMnrePublisher():
+    # MNRE slots are encoded from this process's 15-minute rollups and published as each slot closes
+    try:
+        import mnre_encoder
+        import mnre_mqtt
+    except ImportError as e:
+        logging.error(f"MNRE publishing is enabled but its modules cannot be imported: {e}")
+        return
+
+    # One persistent client; its publish() only queues, so the acquisition task never waits on the broker
+    try:
+        publisher = mnre_mqtt.SlotPublisher()
+    except (OSError, ValueError) as e:
+        logging.error(f"MNRE publisher could not be set up: {e}")
+        return
+    # The DAQ payload reads this process's control module, not a separately imported control_base
+    mnre_encoder.attach(rpthndler.data_handler.rollups, publisher.publish, ctrl=ctrl)
+    log.info("MNRE publisher attached to the %d-minute rollups", mnre_encoder.STINTERVAL)
+
 def run_with_restart(target, name):
     while True:
         try:
@@ -233,38 +221,54 @@ def run_with_restart(target, name):
 if __name__ == "__main__":
 
     print("run file")
+    fastlog.configure()
+    fastlog.installDumpSignal()
     path_config.path_cfg = path_config.pathConfig()
+    watcher = config_watcher.shared_watcher
+    watcher.start()
+
+    registration_queue = RegistrationQueue(path_config.path_cfg.base_path + "registration_queue.json")
+    registration_queue.register_handler("create_project_device", markSiteCreated)
+    registration_queue.start()
 
     while(not install_file):
         print("waiting for install file..")
+        watcher.wait_for(getProjectDevicePath())
+        watcher.wait_for(getInstallFilePath())
         readDeviceList()
-        time.sleep(1) 
+        if(not install_file):
+            time.sleep(1)
 
     rpthndler.data_handler = rpthndler.dataBank()
 
     error_codes_path = os.path.join(path_config.path_cfg.base_path, 'modbus_mappings', 'error_codes.json')
-    fault_processor = FaultProcessor(error_codes_path=error_codes_path, poll_interval=10)
+    fault_processor = FaultProcessor(error_codes_path=error_codes_path)
     
-    #status_reporter = DeviceStatusReporter(poll_interval=60) 
-
-    t1 = threading.Thread(target=run_with_restart, args=(getData, "getData"), name="getData")
-    t2 = threading.Thread(target=run_with_restart, args=(rpthndler.data_handler.runDataLoop, "runDataLoop"), name="runDataLoop")
-    t3 = threading.Thread(target=run_with_restart, args=(fault_processor.run, "FaultProcessor"), name="FaultProcessor")
+    status_reporter = DeviceStatusReporter(poll_interval=60)
+
+    sched = scheduler.shared_scheduler
+    devices_path = path_config.path_cfg.base_path + "devices.json"
+    devices_ready = watcher.watch(devices_path)
+    rpthndler.data_handler.devices_ready = devices_ready
+    if getReportSection("mnre").get("enabled", False):
+        startMnrePublisher()
+    watcher.on_present(devices_path, lambda: startAcquisition(sched))
+    uplink = priority_scheduler.shared_uplink
+    uplink.enableDurableAlerts(path_config.path_cfg.base_path + "alert_queue.json")
+    uplink.start()
+    fault_processor.run(uplink)
+    status_reporter.run(sched)
+    api_cfg = getReportSection("local_api")
+    if api_cfg.get("enabled", False):
+        ipc_server.startServer(api_cfg.get("socket_path", path_config.path_cfg.base_path + "edge_api.sock"))
     tmqtt = threading.Thread(target=run_with_restart, args=(subscribe.start_subscriber, "MQTT_Subscriber"), name="MQTT_Subscriber")
-    #t4 = threading.Thread(target=run_with_restart, args=(status_reporter.run, "StatusReporter"), name="StatusReporter")
 
-    t1.start()
-    t2.start()
-    t3.start()
+    sched.start()
     tmqtt.start()
-    #t4.start()
 
     print("All threads started: Data Acquisition, Report Handling, Fault Processing, and Device Status Reporting.")
 
-    t1.join()
-    t2.join()
-    t3.join()
+    sched.join()
     tmqtt.join()
-    #t4.join()
     
     print("All threads have completed.")
\ No newline at end of file
@@ -15,10 +15,12 @@ import time
 import socket
 import struct
 import sys
+import threading
 
 sys.path.insert(0, "../")
 sys.path.insert(0,'../control/')
 from control import control_base as ctrl
+from utils import fastlog
 
 from pymodbus.pdu import ModbusExceptions as mexcpt
 from pymodbus.pdu import ExceptionResponse as mbusresp
@@ -29,6 +31,7 @@ from pymodbus import framer
 from typing import Union
 import logging
 
+log = fastlog.getLogger("modbusmasterapi")
 
 class modbusTCPDetails:
     ip = None
@@ -80,6 +83,17 @@ class mbusErrorCodes(enum.IntEnum):
         return int(obj)
 
 
+_comm_locks = {}
+_comm_locks_guard = threading.Lock()
+
+def commLock(key):
+    # One lock per physical link: a serial port or a TCP endpoint, shared by every slave behind it
+    with _comm_locks_guard:
+        lock = _comm_locks.get(key)
+        if lock is None:
+            lock = _comm_locks[key] = threading.RLock()
+        return lock
+
 class modbusTCPDevice(ctrl.systemDevice):
     modbusTCP_comm_details: modbusTCPDetails
     mbus_client: ModbusTcpClient
@@ -96,35 +110,31 @@ class modbusTCPDevice(ctrl.systemDevice):
         self.addr_map = address_map
         self.ctrl_map = ctrl_map
         self.mbus_client = ModbusTcpClient(ip, port=port)
-        print("port is : ", self.modbusTCP_comm_details.port)
+        self.comm_lock = commLock(("tcp", ip, port))
 
     def connect(self):
         if not self.mbus_client.is_socket_open():
             try:
-                print(f"---- Attempting TCP connection to {self.modbusTCP_comm_details.ip}:{self.modbusTCP_comm_details.port} ----")
-                logging.info(f"Attempting to connect to TCP device at {self.modbusTCP_comm_details.ip}:{self.modbusTCP_comm_details.port}")
+                log.debug("Attempting to connect to TCP device at %s:%s", self.modbusTCP_comm_details.ip, self.modbusTCP_comm_details.port)
                 self.device_connected = self.mbus_client.connect()
                 if not self.device_connected:
-                    print(f"---- TCP connection failed to {self.modbusTCP_comm_details.ip} ----")
-                    logging.warning(f"Connection failed to {self.modbusTCP_comm_details.ip}")
+                    log.warning("Connection failed to %s", self.modbusTCP_comm_details.ip, every=60, key=getattr(self, 'device_id', None))
                 else:
-                    print(f"---- TCP connection successful to {self.modbusTCP_comm_details.ip} ----")
+                    log.info("TCP connection successful to %s", self.modbusTCP_comm_details.ip)
             except Exception as e:
-                print(f"---- TCP connection exception: {e} ----")
-                logging.error(f"TCP connection exception: {e}")
+                log.error("TCP connection exception for %s: %s", self.modbusTCP_comm_details.ip, e, every=60, key=getattr(self, 'device_id', None))
                 self.device_connected = False
         else:
             self.device_connected = True
         return self.device_connected
 
     def close_connection(self):
-        print(f"---- Closing TCP connection for {self.modbusTCP_comm_details.ip} ----")
         try:
             self.mbus_client.close()
         except Exception:
             pass
         self.device_connected = False
-        logging.info(f"Connection closed for TCP device {self.modbusTCP_comm_details.ip}")
+        log.debug("Connection closed for TCP device %s", self.modbusTCP_comm_details.ip)
         return False
         
     def hard_reset(self):
@@ -147,70 +157,74 @@ class modbusTCPDevice(ctrl.systemDevice):
         self.mbus_client = ModbusTcpClient(self.modbusTCP_comm_details.ip, port=self.modbusTCP_comm_details.port)
 
     def writeDataToRegisters(self, reg_data_list,addr):
-        try:
-            if not self.mbus_client.is_socket_open():
-                self.connect()
+        # Setpoint writes run on the ControlLoop thread; one transaction on the link at a time
+        with self.comm_lock:
+            try:
+                if not self.mbus_client.is_socket_open():
+                    self.connect()
             
-            if self.device_connected:
-                print(f"Device ID: {getattr(self, 'device_id', 'N/A')}, Writing to Register: {addr}, Data: {reg_data_list}")
-                self.mbus_client.write_registers(addr, reg_data_list, slave=self.slave_id)
-                time.sleep(1.0)
-            else:
-                logging.warning(f"Unable to write data: device {self.modbusTCP_comm_details.ip} is not connected.")
-        except ModbusIOException as e:
-            logging.error(f"Modbus write error: {e}")
-            self.hard_reset()
-        except Exception as e:
-            logging.error(f"Unable to write data due to exception: {e}")
-            self.hard_reset()
+                if self.device_connected:
+                    log.debug("Device ID: %s, Writing to Register: %s, Data: %s", getattr(self, 'device_id', 'N/A'), addr, reg_data_list)
+                    self.mbus_client.write_registers(addr, reg_data_list, slave=self.slave_id)
+                    time.sleep(1.0)
+                else:
+                    log.warning("Unable to write data: device %s is not connected.", self.modbusTCP_comm_details.ip, every=60, key=getattr(self, 'device_id', None))
+            except ModbusIOException as e:
+                logging.error(f"Modbus write error: {e}")
+                self.hard_reset()
+            except Exception as e:
+                logging.error(f"Unable to write data due to exception: {e}")
+                self.hard_reset()
 
     def writeCoilStatus(self, coil_data):
-        try:
-            if not self.mbus_client.is_socket_open():
-                self.connect()
+        with self.comm_lock:
+            try:
+                if not self.mbus_client.is_socket_open():
+                    self.connect()
 
-            if self.device_connected:
-                print(f"Device ID: {getattr(self, 'device_id', 'N/A')}, Writing Coil to Address: {coil_data['address']}, Value: {coil_data['value']}")
-                self.mbus_client.write_coil(coil_data["address"], coil_data["value"], slave=self.slave_id)
-                time.sleep(1.0)
-            else:
-                logging.warning(f"Unable to write coil status: device {self.modbusTCP_comm_details.ip} is not connected.")
-        except KeyError as e:
-            logging.error(f"Missing key in coil data dictionary: {e}")
-        except ModbusIOException as e:
-            logging.error(f"Modbus write error: {e}")
-            self.hard_reset()
-        except Exception as e:
-            logging.error(f"Unable to write coil status due to exception: {e}")
-            self.hard_reset()
+                if self.device_connected:
+                    print(f"Device ID: {getattr(self, 'device_id', 'N/A')}, Writing Coil to Address: {coil_data['address']}, Value: {coil_data['value']}")
+                    self.mbus_client.write_coil(coil_data["address"], coil_data["value"], slave=self.slave_id)
+                    time.sleep(1.0)
+                else:
+                    logging.warning(f"Unable to write coil status: device {self.modbusTCP_comm_details.ip} is not connected.")
+            except KeyError as e:
+                logging.error(f"Missing key in coil data dictionary: {e}")
+            except ModbusIOException as e:
+                logging.error(f"Modbus write error: {e}")
+                self.hard_reset()
+            except Exception as e:
+                logging.error(f"Unable to write coil status due to exception: {e}")
+                self.hard_reset()
 
     def writeDataToCtrlRegisters(self, reg_data):
-        try:
-            if not self.mbus_client.is_socket_open():
-                self.connect()
-
-            if self.device_connected:
-                builder = BinaryPayloadBuilder(byteorder=getattr(Endian, reg_data["bo"]), wordorder=getattr(Endian, reg_data["wo"]))
-                attribute = getattr(builder, reg_data["format"])
-                attribute(int(reg_data["value"]))
-                payload = builder.build()
-                print(f"Device ID: {getattr(self, 'device_id', 'N/A')}, Writing Control Register: {reg_data['address']}, Value: {reg_data['value']}, Payload: {payload[0]}")
-                self.mbus_client.write_register(
-                        reg_data["address"], payload[0], skip_encode=True, slave=self.slave_id
-                    )
-                time.sleep(1.0)
-            else:
-                logging.warning(f"Unable to write control data: device {self.modbusTCP_comm_details.ip} is not connected.")
-        except KeyError as e:
-            logging.error(f"Missing key in control data dictionary: {e}")
-        except AttributeError as e:
-            logging.error(f"Invalid format attribute in control data: {e}")
-        except ModbusIOException as e:
-            logging.error(f"Modbus write error: {e}")
-            self.hard_reset()
-        except Exception as e:
-            logging.error(f"Unable to write control data due to exception: {e}")
-            self.hard_reset()
+        with self.comm_lock:
+            try:
+                if not self.mbus_client.is_socket_open():
+                    self.connect()
+
+                if self.device_connected:
+                    builder = BinaryPayloadBuilder(byteorder=getattr(Endian, reg_data["bo"]), wordorder=getattr(Endian, reg_data["wo"]))
+                    attribute = getattr(builder, reg_data["format"])
+                    attribute(int(reg_data["value"]))
+                    payload = builder.build()
+                    log.debug("Device ID: %s, Writing Control Register: %s, Value: %s, Payload: %s", getattr(self, 'device_id', 'N/A'), reg_data['address'], reg_data['value'], payload[0])
+                    self.mbus_client.write_register(
+                            reg_data["address"], payload[0], skip_encode=True, slave=self.slave_id
+                        )
+                    time.sleep(1.0)
+                else:
+                    logging.warning(f"Unable to write control data: device {self.modbusTCP_comm_details.ip} is not connected.")
+            except KeyError as e:
+                logging.error(f"Missing key in control data dictionary: {e}")
+            except AttributeError as e:
+                logging.error(f"Invalid format attribute in control data: {e}")
+            except ModbusIOException as e:
+                logging.error(f"Modbus write error: {e}")
+                self.hard_reset()
+            except Exception as e:
+                logging.error(f"Unable to write control data due to exception: {e}")
+                self.hard_reset()
 
 class modbusRTUDevice(ctrl.systemDevice):
     modbusRTU_comm_details: modbusRTUdetails
@@ -235,47 +249,39 @@ class modbusRTUDevice(ctrl.systemDevice):
         else:
             self.mbus_client = ModbusSerialClient(port, framer.FramerType.RTU, baud, 8, parity, stop_bits, timeout=3)
         self.device_connected = False
+        self.comm_lock = commLock(("rtu", port))
 
     def connect(self):
         try:
-            print(f"---- Attempting RTU connection to {self.modbusRTU_comm_details.port} ----")
-            logging.info(f"Attempting to connect to RTU device at {self.modbusRTU_comm_details.port}")
+            log.debug("Attempting to connect to RTU device at %s", self.modbusRTU_comm_details.port)
             time.sleep(0.05)  
             self.device_connected = self.mbus_client.connect()
             
             if self.device_connected:
-                print(f"---- RTU connection successful on {self.modbusRTU_comm_details.port}. Proceeding to flush buffers... ----")
                 if hasattr(self.mbus_client, 'socket') and self.mbus_client.socket:
                     try:
                         if hasattr(self.mbus_client.socket, 'reset_input_buffer'):
-                            print("---- Using reset_input_buffer() / reset_output_buffer() for flushing ----")
                             self.mbus_client.socket.reset_input_buffer()
                             self.mbus_client.socket.reset_output_buffer()
                         else:
-                            print("---- Using flushInput() / flushOutput() for flushing ----")
                             self.mbus_client.socket.flushInput()
                             self.mbus_client.socket.flushOutput()
-                        print("---- Serial port buffers flushed successfully ----")
-                        logging.debug("Serial port buffers flushed successfully.")
+                        log.debug("Serial port buffers flushed successfully.")
                     except Exception as e:
-                        print(f"---- Exception during buffer flush: {e} ----")
-                        logging.debug(f"Could not flush serial buffers: {e}")
+                        log.debug("Could not flush serial buffers: %s", e)
             else:
-                print(f"---- RTU connection failed to {self.modbusRTU_comm_details.port} ----")
-                logging.warning(f"Connection failed to {self.modbusRTU_comm_details.port}")
+                log.warning("Connection failed to %s", self.modbusRTU_comm_details.port, every=60, key=getattr(self, 'device_id', None))
 
         except Exception as e:
-            print(f"---- RTU connection exception: {e} ----")
-            logging.error(f"RTU connection exception: {e}")
+            log.error("RTU connection exception on %s: %s", self.modbusRTU_comm_details.port, e, every=60, key=getattr(self, 'device_id', None))
             self.device_connected = False
         return self.device_connected
 
     def close_connection(self):
         if self.mbus_client.is_socket_open():
-            print(f"---- Closing RTU connection for {self.modbusRTU_comm_details.port} ----")
             self.mbus_client.close()
             self.device_connected = False
-            logging.info(f"Connection closed for RTU device {self.modbusRTU_comm_details.port}")
+            log.debug("Connection closed for RTU device %s", self.modbusRTU_comm_details.port)
         return False
 
     def hard_reset(self):
@@ -308,74 +314,75 @@ class modbusRTUDevice(ctrl.systemDevice):
         print(f"---- RTU Hard Reset Complete for {self.modbusRTU_comm_details.port} ----")
 
     def writeDataToRegisters(self, reg_data_list,addr):
-        print("----into writeDataToRegisters in modbusRTUDevice----")
-        try:
-            if not self.mbus_client.is_socket_open():
-                self.connect()
+        # Setpoint writes run on the ControlLoop thread; one transaction on the link at a time
+        with self.comm_lock:
+            try:
+                if not self.mbus_client.is_socket_open():
+                    self.connect()
 
-            if self.device_connected:
-                print(f"Device ID: {getattr(self, 'device_id', 'N/A')}, Writing to Register: {addr}, Data: {reg_data_list}")
-                self.mbus_client.write_registers(addr, reg_data_list, slave=self.slave_id)
-                time.sleep(1.0) 
-            else:
-                logging.warning(f"Unable to write data: RTU device on port {self.modbusRTU_comm_details.port} is not connected.")
-        except ModbusIOException as e:
-            logging.error(f"Modbus write error: {e}")
-            self.hard_reset()
-        except Exception as e:
-            logging.error(f"Unable to write data due to exception: {e}")
-            self.hard_reset()
+                if self.device_connected:
+                    log.debug("Device ID: %s, Writing to Register: %s, Data: %s", getattr(self, 'device_id', 'N/A'), addr, reg_data_list)
+                    self.mbus_client.write_registers(addr, reg_data_list, slave=self.slave_id)
+                    time.sleep(1.0) 
+                else:
+                    log.warning("Unable to write data: RTU device on port %s is not connected.", self.modbusRTU_comm_details.port, every=60, key=getattr(self, 'device_id', None))
+            except ModbusIOException as e:
+                logging.error(f"Modbus write error: {e}")
+                self.hard_reset()
+            except Exception as e:
+                logging.error(f"Unable to write data due to exception: {e}")
+                self.hard_reset()
 
     def writeCoilStatus(self, coil_data):
-        try:
-            if not self.mbus_client.is_socket_open():
-                self.connect()
+        with self.comm_lock:
+            try:
+                if not self.mbus_client.is_socket_open():
+                    self.connect()
 
-            if self.device_connected:
-                print(f"Device ID: {getattr(self, 'device_id', 'N/A')}, Writing Coil to Address: {coil_data['address']}, Value: {coil_data['value']}")
-                self.mbus_client.write_coil(coil_data["address"], coil_data["value"], slave=self.slave_id)
-                time.sleep(1.0)
-            else:
-                logging.warning(f"Unable to write coil status: device {self.modbusRTU_comm_details.port} is not connected.")
-        except KeyError as e:
-            logging.error(f"Missing key in coil data dictionary: {e}")
-        except ModbusIOException as e:
-            logging.error(f"Modbus write error: {e}")
-            self.hard_reset()
-        except Exception as e:
-            logging.error(f"Unable to write coil status due to exception: {e}")
-            self.hard_reset()
+                if self.device_connected:
+                    print(f"Device ID: {getattr(self, 'device_id', 'N/A')}, Writing Coil to Address: {coil_data['address']}, Value: {coil_data['value']}")
+                    self.mbus_client.write_coil(coil_data["address"], coil_data["value"], slave=self.slave_id)
+                    time.sleep(1.0)
+                else:
+                    logging.warning(f"Unable to write coil status: device {self.modbusRTU_comm_details.port} is not connected.")
+            except KeyError as e:
+                logging.error(f"Missing key in coil data dictionary: {e}")
+            except ModbusIOException as e:
+                logging.error(f"Modbus write error: {e}")
+                self.hard_reset()
+            except Exception as e:
+                logging.error(f"Unable to write coil status due to exception: {e}")
+                self.hard_reset()
 
     def writeDataToCtrlRegisters(self, reg_data):
-        print("----into writeDataToCtrlRegisters----")
-        try:
-            if not self.mbus_client.is_socket_open():
-                self.connect()
-
-            if self.device_connected:
-                builder = BinaryPayloadBuilder(byteorder=getattr(Endian, reg_data["bo"]), wordorder=getattr(Endian, reg_data["wo"]))
-                attribute = getattr(builder, reg_data["format"])
-                attribute(int(reg_data["value"]))
-                payload = builder.build()
-                print(f"Device ID: {getattr(self, 'device_id', 'N/A')}, Writing Control Register: {reg_data['address']}, Value: {reg_data['value']}, Payload: {payload[0]}")
-                self.mbus_client.write_register(reg_data["address"], payload[0], skip_encode=True, slave=self.slave_id)
-                time.sleep(1.0)
-            else:
-                logging.warning(f"Unable to write control data: RTU device on port {self.modbusRTU_comm_details.port} is not connected.")
-        except KeyError as e:
-            logging.error(f"Missing key in control data dictionary: {e}")
-        except AttributeError as e:
-            logging.error(f"Invalid format attribute in control data: {e}")
-        except ModbusIOException as e:
-            logging.error(f"Modbus write error: {e}")
-            self.hard_reset()
-        except Exception as e:
-            logging.error(f"Unable to write control data due to exception: {e}")
-            self.hard_reset()
+        with self.comm_lock:
+            try:
+                if not self.mbus_client.is_socket_open():
+                    self.connect()
+
+                if self.device_connected:
+                    builder = BinaryPayloadBuilder(byteorder=getattr(Endian, reg_data["bo"]), wordorder=getattr(Endian, reg_data["wo"]))
+                    attribute = getattr(builder, reg_data["format"])
+                    attribute(int(reg_data["value"]))
+                    payload = builder.build()
+                    log.debug("Device ID: %s, Writing Control Register: %s, Value: %s, Payload: %s", getattr(self, 'device_id', 'N/A'), reg_data['address'], reg_data['value'], payload[0])
+                    self.mbus_client.write_register(reg_data["address"], payload[0], skip_encode=True, slave=self.slave_id)
+                    time.sleep(1.0)
+                else:
+                    logging.warning(f"Unable to write control data: RTU device on port {self.modbusRTU_comm_details.port} is not connected.")
+            except KeyError as e:
+                logging.error(f"Missing key in control data dictionary: {e}")
+            except AttributeError as e:
+                logging.error(f"Invalid format attribute in control data: {e}")
+            except ModbusIOException as e:
+                logging.error(f"Modbus write error: {e}")
+                self.hard_reset()
+            except Exception as e:
+                logging.error(f"Unable to write control data due to exception: {e}")
+                self.hard_reset()
 
 
 def bytes_to_registers(data, byteorder="little"):
-    print("----into byte_to_registers----")
     registers = []
     try:
         for x in data:
@@ -385,27 +392,27 @@ def bytes_to_registers(data, byteorder="little"):
     except Exception as e:
         logging.error(f"Error converting bytes to registers: {e}")
         return []
-    print("registers after bytes_to_registers : ",registers)
+    log.debug("registers after bytes_to_registers : %s", registers)
     return registers
 
 
 def writeModbusData(device: Union[modbusRTUDevice, modbusTCPDevice], address, data, byteorder="little"):
-    print("----into writeModbusData----")
     payload = []
-    try:
-        payload = bytes_to_registers(data, byteorder)
-        print(f"Device ID: {getattr(device, 'device_id', 'N/A')}, Writing to Register: {address}, Payload: {payload}")
-        device.mbus_client.write_registers(address, values=payload, slave=device.slave_id)
-    except ModbusIOException as e:
-        logging.error(f"Modbus write error: {e}")
-    except Exception as e:
-        logging.error(f"Unable to write data due to exception: {e}")
-    finally:
-        if isinstance(device, modbusRTUDevice):
-            time.sleep(1.0)
-            device.close_connection()
-        elif isinstance(device, modbusTCPDevice):
-            time.sleep(1.0)
+    with device.comm_lock:
+        try:
+            payload = bytes_to_registers(data, byteorder)
+            log.debug("Device ID: %s, Writing to Register: %s, Payload: %s", getattr(device, 'device_id', 'N/A'), address, payload)
+            device.mbus_client.write_registers(address, values=payload, slave=device.slave_id)
+        except ModbusIOException as e:
+            logging.error(f"Modbus write error: {e}")
+        except Exception as e:
+            logging.error(f"Unable to write data due to exception: {e}")
+        finally:
+            if isinstance(device, modbusRTUDevice):
+                time.sleep(1.0)
+                device.close_connection()
+            elif isinstance(device, modbusTCPDevice):
+                time.sleep(1.0)
 
 
 def getData(addrmap:dict,device:Union[modbusRTUDevice, modbusTCPDevice]):
@@ -493,23 +500,32 @@ def getData(addrmap:dict,device:Union[modbusRTUDevice, modbusTCPDevice]):
     return data
 
 def getModbusData(device: Union[modbusRTUDevice, modbusTCPDevice]):
+    # Acquisition and the live stream share the link; one transaction on it at a time
+    with device.comm_lock:
+        return _getModbusData(device)
+
+def _getModbusData(device: Union[modbusRTUDevice, modbusTCPDevice]):
     modbusdata = {'read': [], 'control': []}
     is_tcp = device.comm_type == ctrl.commType.modbus_tcp
     if not is_tcp or not device.mbus_client.is_socket_open():
         if not device.connect():
-            logging.warning(f"Failed to connect to device {getattr(device, 'device_id', 'N/A')}. Skipping read cycle.")
+            log.warning("Failed to connect to device %s. Skipping read cycle.", getattr(device, 'device_id', 'N/A'), every=60, key=getattr(device, 'device_id', None))
+            ctrl.recordReadResult(device, False)
             return modbusdata
     try:
         if not device.device_connected:
             logging.error(f"Device {getattr(device, 'device_id', 'N/A')} is not connected after calling connect(). Aborting read.")
+            ctrl.recordReadResult(device, False)
             return modbusdata
 
         modbusdata['read'] = getData(device.addr_map['map'], device)
         modbusdata['control'] = getData(device.ctrl_map['map'], device)
+        ctrl.recordReadResult(device, True)
         
     except Exception as e:
         logging.error(f"An error occurred during data read for device {getattr(device, 'device_id', 'N/A')}: {e}. Triggering hard reset.")
         device.hard_reset()
+        ctrl.recordReadResult(device, False)
         modbusdata['read'] = []
         modbusdata['control'] = []
     
@@ -517,4 +533,20 @@ def getModbusData(device: Union[modbusRTUDevice, modbusTCPDevice]):
         if device.device_connected and isinstance(device, modbusRTUDevice):
             device.close_connection()
 
-    return modbusdata
\ No newline at end of file
+    return modbusdata
+
+def getLiveData(device: Union[modbusRTUDevice, modbusTCPDevice], addrmap: dict):
+    # Reads a subset of the read map for the live stream; [] when the device is unreachable
+    with device.comm_lock:
+        is_tcp = device.comm_type == ctrl.commType.modbus_tcp
+        if not is_tcp or not device.mbus_client.is_socket_open():
+            if not device.connect():
+                return []
+        try:
+            return getData(addrmap, device)
+        except Exception as e:
+            log.warning("Live read failed for device %s: %s", getattr(device, 'device_id', 'N/A'), e, every=60, key=getattr(device, 'device_id', None))
+            return []
+        finally:
+            if device.device_connected and isinstance(device, modbusRTUDevice):
+                device.close_connection()
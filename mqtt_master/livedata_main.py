@@ -1,7 +1,16 @@
+import copy
 import json
+import queue
+import threading
+import time
 import aio_pika
 import datetime
 import pika
+from control import control_base as ctrl
+from modbus_master import modbusmasterapi as mbus
+from utils import fastlog
+
+log = fastlog.getLogger("livedata")
 
 RABBITMQ_HOST = '3.110.77.154'
 RABBITMQ_USER = 'enercog'
@@ -17,40 +26,278 @@ LISTEN_ROUTING_KEY = 'command.godrej_headspring'
 EXCHANGE_NAME = 'rpi' # <-- IMPORTANT: CHANGE THIS
 
 
-def livdataHandler(data):
-        print("livedata handler called with data : ",data)
-        message = json.dumps(data)
-        publish_message(message)
-        return
+QUEUE_SIZE = 100
+BATCH_MAX = 1
+BATCH_WAIT = 0.2
+HEARTBEAT = 30
+MAX_RECONNECT_DELAY = 30
+MAX_PUBLISH_ATTEMPTS = 3
 
-def publish_message(message):
-    try:
+class LivePublisher:
+    """Publisher thread with one persistent AMQP connection and publisher confirms.
+
+    Producers only enqueue; when the queue is full the oldest message is dropped, since live
+    data is only worth its latest value. With batch_max > 1 the messages waiting in the queue
+    (up to batch_max, collected for at most batch_wait seconds) go out as one JSON array.
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch_max=BATCH_MAX, batch_wait=BATCH_WAIT):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_max = batch_max
+        self.batch_wait = batch_wait
+        self.connection = None
+        self.channel = None
+        self.lock = threading.Lock()
+        self._thread = None
+        self.published = 0
+        self.dropped = 0
+        self.nacked = 0
+        self.reconnects = 0
+
+    def enqueue(self, data):
+        if self._thread is None:
+            self.start()
+        while True:
+            try:
+                self.queue.put_nowait(data)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    log.warning("Live data queue full, dropped oldest message", every=60)
+                except queue.Empty:
+                    pass
+
+    def _connect(self):
         credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials))
-        channel = connection.channel()
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+            host=RABBITMQ_HOST, credentials=credentials, heartbeat=HEARTBEAT, blocked_connection_timeout=HEARTBEAT))
+        channel = self.connection.channel()
 
+        # Topology is declared once per connection instead of once per message
         channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='topic', durable=True)
-                # Declare queues
         channel.queue_declare(queue=PUBLISH_ROUTING_KEY, durable=True, arguments={"x-message-ttl": 60000})
         channel.queue_declare(queue=LISTEN_QUEUE, durable=True, arguments={"x-message-ttl": 60000})
-
-        # Bind queues to the topic exchange
         channel.queue_bind(exchange=EXCHANGE_NAME, queue=PUBLISH_ROUTING_KEY, routing_key=PUBLISH_ROUTING_KEY)
         channel.queue_bind(exchange=EXCHANGE_NAME, queue=LISTEN_QUEUE, routing_key=LISTEN_QUEUE)
+        channel.confirm_delivery()
+        self.channel = channel
+        log.info("Live data publisher connected to %s", RABBITMQ_HOST)
+
+    def _close(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=1.0)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_max:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _publish(self, batch):
+        message = json.dumps(batch[0] if self.batch_max <= 1 else batch)
+        for attempt in range(MAX_PUBLISH_ATTEMPTS):
+            try:
+                # Blocks until the broker confirms the message
+                self.channel.basic_publish(
+                    exchange=EXCHANGE_NAME,
+                    routing_key=PUBLISH_ROUTING_KEY,
+                    body=message,
+                    properties=pika.BasicProperties(delivery_mode=2)
+                )
+                self.published += len(batch)
+                log.debug("Sent %s with topic %s", message, PUBLISH_ROUTING_KEY)
+                return
+            except pika.exceptions.NackError:
+                self.nacked += 1
+                log.warning("Broker nacked live data, attempt %d", attempt + 1, every=60)
+        self.dropped += len(batch)
+
+    def _run(self):
+        delay = 1
+        pending = []
+        while True:
+            try:
+                if self.channel is None:
+                    self._connect()
+                    delay = 1
+                if not pending:
+                    pending = self._next_batch()
+                if pending:
+                    self._publish(pending)
+                    pending = []
+                else:
+                    # Keeps heartbeats flowing while live data is off
+                    self.connection.process_data_events(time_limit=0)
+            except Exception as e:
+                log.error("Live data publisher error, reconnecting in %ss: %s", delay, e, every=60)
+                self._close()
+                self.reconnects += 1
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def start(self):
+        with self.lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="LivePublisher", daemon=True)
+                self._thread.start()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "published": self.published,
+            "dropped": self.dropped,
+            "nacked": self.nacked,
+            "reconnects": self.reconnects,
+        }
 
-        print(f"Connected. Publishing to '{PUBLISH_ROUTING_KEY}' via topic exchange '{EXCHANGE_NAME}'.")
-        channel.basic_publish(
-            exchange=EXCHANGE_NAME,
-            routing_key=PUBLISH_ROUTING_KEY,
-            body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
+shared_publisher = LivePublisher()
 
-        print(f" [x] Sent '{message}' with topic '{PUBLISH_ROUTING_KEY}'")
-        connection.close()
+# Fast tier: the meters DG sync is watched on
+STREAM_SOURCES = (ctrl.deviceType.grid, ctrl.deviceType.DG, ctrl.deviceType.solar)
+# Field -> quantization step; a value is sent once it moves a full step from the last sent one
+STREAM_STEPS = {"total_power": 0.1, "reactive_power": 0.1, "power_factor": 0.01, "acfreq": 0.01}
+STREAM_PERIOD = 1.0
+STREAM_DURATION = 300
+KEYFRAME_INTERVAL = 30
 
-    except Exception as e:
-        print(f"[!] Error publishing message: {e}")
+class _StreamDevice:
+    """Only the read-map blocks holding the streamed fields, with models re-pointed at the sub-read."""
+
+    def __init__(self, device, steps):
+        self.device = device
+        self.device_id = str(device.device_id)
+        blocks = list(device.addr_map["map"])
+        fields = []
+        needed = set()
+        for field, step in steps.items():
+            model = getattr(device.measured_data, field, None)
+            if model is None or not model.model_present:
+                continue
+            fields.append((field, model, step))
+            needed.add(model.block_num)
+            if model.factor_type == ctrl.factorType.sf_address:
+                needed.add(model.factor_block)
+        order = sorted(needed)
+        remap = {block_num: index for index, block_num in enumerate(order)}
+        self.addrmap = {blocks[i]: device.addr_map["map"][blocks[i]] for i in order}
+        self.fields = []
+        for field, model, step in fields:
+            # Decoding into a copy leaves the acquisition cycle's models untouched
+            live_model = copy.copy(model)
+            live_model.block_num = remap[model.block_num]
+            if model.factor_type == ctrl.factorType.sf_address:
+                live_model.factor_block = remap[model.factor_block]
+            self.fields.append((field, live_model, step))
+
+    def sample(self):
+        data = mbus.getLiveData(self.device, self.addrmap)
+        # A block that failed mid-read leaves the sub-read short
+        if len(data) < len(self.addrmap):
+            return None
+        values = {}
+        for field, model, _ in self.fields:
+            model.data = data[model.block_num][model.offset : model.offset + model.size]
+            model.getData(data)
+            values[field] = model.value
+        return values
+
+class LiveStream:
+    """Second-level live stream of the grid/DG/PV meters while live data is on.
+
+    Each tick reads only the blocks holding the streamed fields and publishes the values that moved
+    a full quantization step since they were last sent; every keyframe_interval ticks all values go
+    out. The stream ends on LIVE_DATA_STOP or once duration seconds have passed since the start.
+    Message: {"timestamp": ms, "keyframe": bool, "data": {device_id: {field: value}}}
+    """
+
+    def __init__(self, period=STREAM_PERIOD, duration=STREAM_DURATION, keyframe_interval=KEYFRAME_INTERVAL, steps=None, publisher=None):
+        self.period = period
+        self.duration = duration
+        self.keyframe_interval = keyframe_interval
+        self.steps = dict(STREAM_STEPS, **(steps or {}))
+        self.publisher = publisher or shared_publisher
+        self.devices = None
+        self.active = False
+        self.deadline = 0.0
+        self.last_sent = {}
+        self.since_keyframe = 0
+
+    def _compile(self):
+        devices = []
+        for source in STREAM_SOURCES:
+            for device in ctrl.getDeviceGroup(ctrl.deviceType.meter, source):
+                if device.comm_type in (ctrl.commType.modbus_tcp, ctrl.commType.modbus_rtu):
+                    stream_device = _StreamDevice(device, self.steps)
+                    if stream_device.fields:
+                        devices.append(stream_device)
+        log.info("Live stream covers %d meters", len(devices))
+        return devices
+
+    def _begin(self, now):
+        if self.devices is None:
+            self.devices = self._compile()
+        self.active = True
+        self.deadline = now + self.duration
+        self.last_sent = {}
+        self.since_keyframe = self.keyframe_interval
+
+    def tick(self):
+        if not ctrl.system_operating_details.live_data:
+            self.active = False
+            return
+        now = time.time()
+        if not self.active:
+            self._begin(now)
+        elif now >= self.deadline:
+            ctrl.stopLiveData()
+            self.active = False
+            return
+
+        keyframe = self.since_keyframe >= self.keyframe_interval
+        self.since_keyframe = 0 if keyframe else self.since_keyframe + 1
+        out = {}
+        for stream_device in self.devices:
+            values = stream_device.sample()
+            if values is None:
+                continue
+            changed = {}
+            for field, model, step in stream_device.fields:
+                value = values[field]
+                key = (stream_device.device_id, field)
+                last = self.last_sent.get(key)
+                if keyframe or last is None or abs(value - last) >= step:
+                    quantized = round(round(value / step) * step, 6)
+                    changed[field] = quantized
+                    self.last_sent[key] = quantized
+            if changed:
+                out[stream_device.device_id] = changed
+        if out or keyframe:
+            self.publisher.enqueue({"timestamp": int(now * 1000), "keyframe": keyframe, "data": out})
+
+def livdataHandler(data):
+        log.debug("livedata handler called with data : %s", data)
+        shared_publisher.enqueue(data)
+        return
+
+def publish_message(message):
+    shared_publisher.enqueue(json.loads(message))
 
 if __name__ == '__main__':
     publish_message(MESSAGE)
\ No newline at end of file
@@ -49,7 +49,7 @@ def start_subscriber():
                     #callFunc()
                     if isValidJson(message):
                         print("json is valid")
-                        ctrl.processMQTTMessage(body.decode())
+                        ctrl.processMQTTMessage(message)
                     else:
                         if(message == "LIVE_DATA_START"):
                             print("Starting Live Data")
@@ -0,0 +1,257 @@
+import collections
+import math
+import time
+from threading import Lock
+
+from utils import fastlog
+
+log = fastlog.getLogger("aggregator")
+
+# Cumulative counters reported as per-bucket deltas; a drop is treated as a counter reset
+ENERGY_FIELDS = ("total_energy", "today_energy", "import_energy", "export_energy")
+# Daily buckets follow the site's local day (Asia/Kolkata, as in set_localdate)
+DAY_OFFSET = 19800
+DEFAULT_RESOLUTIONS = (("1m", 60, 120), ("15m", 900, 96), ("1d", 86400, 31))
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class FieldAccumulator:
+    """Running count/sum/min/max/last for one field.
+
+    NaN/inf samples are counted in nan_count but never summed and never become first/last, so a
+    bad read at a bucket edge cannot poison the bucket's last value or the next energy delta.
+    """
+    __slots__ = ("count", "total", "minimum", "maximum", "first", "last", "nan_count")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.first = None
+        self.last = None
+        self.nan_count = 0
+
+    def add(self, value):
+        if not isNumber(value):
+            self.last = value
+            return
+        if not math.isfinite(value):
+            self.nan_count += 1
+            return
+        self.last = value
+        if self.first is None:
+            self.first = value
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def numeric(self):
+        return self.count > 0 or self.nan_count > 0
+
+    def mean(self):
+        # Report windows flag any bad sample; rollups use finiteMean()
+        if self.nan_count or not self.count:
+            return math.nan
+        return self.total / self.count
+
+    def finiteMean(self):
+        return self.total / self.count if self.count else None
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.minimum,
+            "max": self.maximum,
+            "last": self.last,
+            "nan_count": self.nan_count,
+        }
+
+class DeviceAccumulator:
+    """Accumulators for one device's fields; dict-valued fields (mppt, string) get one per nested key."""
+
+    def __init__(self):
+        self.type = None
+        self.samples = 0
+        self.fields = {}
+
+    def add(self, sample):
+        self.samples += 1
+        for param, value in sample.items():
+            if value is None:
+                continue
+            if param == "type":
+                if self.type is None:
+                    self.type = value
+                continue
+            if isinstance(value, dict):
+                nested = self.fields.get(param)
+                if not isinstance(nested, dict):
+                    nested = self.fields[param] = {}
+                for key, nested_value in value.items():
+                    if nested_value is None:
+                        continue
+                    acc = nested.get(key)
+                    if acc is None:
+                        acc = nested[key] = FieldAccumulator()
+                    acc.add(nested_value)
+                continue
+            acc = self.fields.get(param)
+            if not isinstance(acc, FieldAccumulator):
+                acc = self.fields[param] = FieldAccumulator()
+            acc.add(value)
+
+class WindowAggregator:
+    """Per-device accumulators for the current report window; memory is bounded by the field count."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.devices = {}
+        self.samples = 0
+
+    def add(self, msg):
+        with self.lock:
+            self.samples += 1
+            for device_id, sample in msg.items():
+                if not isinstance(sample, dict):
+                    continue
+                device = self.devices.get(device_id)
+                if device is None:
+                    device = self.devices[device_id] = DeviceAccumulator()
+                device.add(sample)
+
+    def reset(self):
+        # Swap in a fresh window; the caller owns the returned accumulators
+        with self.lock:
+            devices, samples = self.devices, self.samples
+            self.devices = {}
+            self.samples = 0
+        return devices, samples
+
+def summarize(acc):
+    if not acc.numeric():
+        return {"last": acc.last}
+    # Mean over the finite samples; nan_count says how many were left out
+    return {
+        "mean": acc.finiteMean(),
+        "min": acc.minimum,
+        "max": acc.maximum,
+        "last": acc.last,
+        "nan_count": acc.nan_count,
+    }
+
+class RollupResolution:
+    """One bucket size: the open bucket's accumulators plus a bounded history of closed buckets."""
+
+    def __init__(self, name, seconds, keep, offset=0):
+        self.name = name
+        self.seconds = seconds
+        self.offset = offset
+        self.bucket_start = None
+        self.devices = {}
+        self.samples = 0
+        self.history = collections.deque(maxlen=keep)
+        self.energy_ref = {}
+        self.subscribers = []
+
+    def bucketStart(self, ts):
+        return math.floor((ts + self.offset) / self.seconds) * self.seconds - self.offset
+
+    def add(self, msg, ts):
+        start = self.bucketStart(ts)
+        closed = None
+        if self.bucket_start is not None and start != self.bucket_start:
+            closed = self.close()
+        if self.bucket_start is None or closed is not None:
+            self.bucket_start = start
+        self.samples += 1
+        for device_id, sample in msg.items():
+            if not isinstance(sample, dict):
+                continue
+            device = self.devices.get(device_id)
+            if device is None:
+                device = self.devices[device_id] = DeviceAccumulator()
+            device.add(sample)
+        return closed
+
+    def _energyDelta(self, device_id, field, acc):
+        if acc.last is None or acc.first is None:
+            return None
+        ref = self.energy_ref.get((device_id, field), acc.first)
+        self.energy_ref[(device_id, field)] = acc.last
+        return acc.last if acc.last < ref else acc.last - ref
+
+    def close(self):
+        record = {
+            "resolution": self.name,
+            "start": self.bucket_start,
+            "end": self.bucket_start + self.seconds,
+            "samples": self.samples,
+            "devices": {},
+        }
+        for device_id, device in self.devices.items():
+            out = {"type": device.type} if device.type is not None else {}
+            energy = {}
+            for param, acc in device.fields.items():
+                if isinstance(acc, dict):
+                    out[param] = {k: summarize(a) for k, a in acc.items()}
+                    continue
+                out[param] = summarize(acc)
+                if param in ENERGY_FIELDS and acc.count:
+                    delta = self._energyDelta(device_id, param, acc)
+                    if delta is not None:
+                        energy[param] = delta
+            if energy:
+                out["energy_delta"] = energy
+            record["devices"][device_id] = out
+        self.history.append(record)
+        self.devices = {}
+        self.samples = 0
+        return record
+
+class RollupStage:
+    """Incremental 1-min/15-min/daily rollups of acquisition snapshots for every downstream consumer."""
+
+    def __init__(self, resolutions=DEFAULT_RESOLUTIONS):
+        self.lock = Lock()
+        self.resolutions = {}
+        for name, seconds, keep in resolutions:
+            offset = DAY_OFFSET if seconds % 86400 == 0 else 0
+            self.resolutions[name] = RollupResolution(name, seconds, keep, offset)
+
+    def add(self, msg, ts=None):
+        ts = time.time() if ts is None else ts
+        closed = []
+        with self.lock:
+            for resolution in self.resolutions.values():
+                record = resolution.add(msg, ts)
+                if record is not None:
+                    closed.append((resolution, record))
+        # Subscribers run outside the lock so they may call latest()/history()
+        for resolution, record in closed:
+            for callback in list(resolution.subscribers):
+                try:
+                    callback(record)
+                except Exception as e:
+                    log.error("Rollup subscriber for %s failed: %s", resolution.name, e, every=60)
+
+    def subscribe(self, name, callback):
+        with self.lock:
+            self.resolutions[name].subscribers.append(callback)
+
+    def latest(self, name):
+        with self.lock:
+            history = self.resolutions[name].history
+            return history[-1] if history else None
+
+    def history(self, name, since=None):
+        with self.lock:
+            records = list(self.resolutions[name].history)
+        if since is None:
+            return records
+        return [r for r in records if r["start"] >= since]
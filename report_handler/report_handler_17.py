@@ -10,132 +10,40 @@ import logging
 from datetime import datetime
 import pytz
 import enum
-from threading import Lock
+from threading import Lock, Event
 import math
-import psycopg2
-from psycopg2.extras import execute_values
 
 import path_config
 import main_thread
 from modbus_master import modbusmasterapi as mbus
 from io_master import iomasterapi as io
 from control import control_base as ctrl
+from utils import fastlog
+from utils import scheduler
+from reports_handling import aggregator
+from uplink import http_client
+from uplink import compact_codec
+from uplink import priority_scheduler
+from database import storage_backend
+from database import archive
 
 config_path = "/home/edge_device/edge_device/installer_cfg/"
 path = config_path + "installer_cfg.json"
 unsent_json_path = "/home/edge_device/edge_device/edge_device/unsent_data.json"
 
+UPLINK_BATCH_ROWS = 500
+UPLINK_BATCH_BYTES = 256 * 1024
+UPLINK_RETRY_PERIOD = 30
+QUARANTINE_FILE = "report_quarantine.jsonl"
+# Nightly archive at 02:00 IST (20:30 UTC)
+ARCHIVE_PERIOD = 86400
+ARCHIVE_OFFSET = 73800
+
 logger = logging.getLogger('report_handler')
 logger.setLevel(logging.ERROR)
 file_handler = logging.FileHandler('report_handler_error.log')
 logger.addHandler(file_handler)
-
-class LocalStorage:
-    def __init__(self, db_params):
-        print("Initializing LocalStorage...")
-        self.db_params = db_params
-        self.buffer = []
-        self.buffer_limit = 30
-        self._init_db()
-
-    def _get_connection(self):
-        print(f"Connecting to PostgreSQL as user: {self.db_params.get('user')}...")
-        return psycopg2.connect(**self.db_params)
-
-    def _init_db(self):
-        try:
-            print("Initializing Database...")
-            conn = self._get_connection()
-            cur = conn.cursor()
-
-            print("Ensuring TimescaleDB extension exists...")
-            cur.execute("CREATE EXTENSION IF NOT EXISTS timescaledb CASCADE;")
-
-            print("Ensuring table 'device_logs' exists...")
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS device_logs (
-                    timestamp TIMESTAMPTZ NOT NULL,
-                    device_id TEXT NOT NULL,
-                    data JSONB NOT NULL
-                );
-            """)
-
-            print("Configuring Hypertable...")
-            cur.execute("""
-                SELECT create_hypertable(
-                    'device_logs',
-                    'timestamp',
-                    if_not_exists => TRUE,
-                    migrate_data => TRUE,
-                    chunk_time_interval => INTERVAL '1 day'
-                );
-            """)
-
-            print("Setting 90-Day Retention Policy...")
-            cur.execute("""
-                SELECT add_retention_policy(
-                    'device_logs',
-                    drop_after => INTERVAL '90 days',
-                    if_not_exists => TRUE
-                );
-            """)
-
-            conn.commit()
-            cur.close()
-            conn.close()
-            print("TimescaleDB initialized successfully")
-
-        except Exception as e:
-            print("TimescaleDB Init Error:", e)
-
-    def save_device_data(self, device_id, data_dict, payload_timestamp=None):
-        print(f"Buffering data for device: {device_id}")
-        clean_data = data_dict.copy()
-        clean_data.pop('type', None)
-
-        # Resolve capture timestamp directly from payload data if available
-        if isinstance(payload_timestamp, (int, float)):
-            try:
-                capture_time = datetime.fromtimestamp(payload_timestamp, tz=pytz.utc)
-            except Exception as e:
-                logger.error(f"Timestamp parsing error for {device_id}: {e}. Using system time.")
-                capture_time = datetime.now(pytz.utc)
-        else:
-            capture_time = datetime.now(pytz.utc)
-
-        self.buffer.append(
-            (capture_time, device_id, json.dumps(clean_data))
-        )
-
-        if len(self.buffer) >= self.buffer_limit:
-            print(f"Buffer limit ({self.buffer_limit}) reached. Flushing to DB...")
-            self.flush()
-
-    def flush(self):
-        if not self.buffer:
-            print("Flush requested: Buffer is empty.")
-            return
-
-        try:
-            print(f"Inserting {len(self.buffer)} records into device_logs...")
-            conn = self._get_connection()
-            cur = conn.cursor()
-
-            execute_values(
-                cur,
-                "INSERT INTO device_logs (timestamp, device_id, data) VALUES %s",
-                self.buffer
-            )
-
-            conn.commit()
-            cur.close()
-            conn.close()
-
-            print("Batch insertion successful. Buffer cleared.")
-            self.buffer = []
-
-        except Exception as e:
-            print("PostgreSQL Flush Error during insertion:", e)
+log = fastlog.getLogger("report_handler")
 
 class reportType(enum.IntEnum):
     average = 0
@@ -153,14 +61,24 @@ def set_localdate():
     local_date = utc_date.astimezone(local_timezone)
     return local_date.strftime('%Y-%m-%d')
 
+def loadStorageConfig():
+    # Optional "local_storage" section of report_cfg.json
+    try:
+        with open(path_config.path_cfg.base_path + "reports_handling/report_cfg.json") as report_cfg:
+            return json.load(report_cfg).get("local_storage", {})
+    except (OSError, json.JSONDecodeError):
+        return {}
+
 class dataBank:
     def __init__(self):
-        self.data_queue = []
+        self.window = aggregator.WindowAggregator()
+        self.rollups = aggregator.RollupStage()
         self.avg_data = {}
         self.report_url = ""
         self.report_period = 0
         self.report_type = reportType.average
         self.lock = Lock()
+        self.devices_ready = Event()
         
         self.db_params = {
             'dbname': 'solar_data',
@@ -169,124 +87,217 @@ class dataBank:
             'host': '127.0.0.1',
             'port': '5432'
         }
-        self.storage = LocalStorage(self.db_params)
+        storage_cfg = loadStorageConfig()
+        # Windows spill to this file while the store is down and are replayed once it is back
+        self.storage = storage_backend.createStorage(storage_cfg, self.db_params,
+                                                     spill_path=path_config.path_cfg.base_path + "report_spill.jsonl")
+        self.archiver = None
+        if storage_cfg.get("archive_dir"):
+            if archive.available():
+                self.archiver = archive.DailyArchiver(self.storage, storage_cfg["archive_dir"],
+                                                      hot_days=storage_cfg.get("hot_days", archive.HOT_DAYS),
+                                                      archive_days=storage_cfg.get("archive_days", archive.ARCHIVE_DAYS))
+            else:
+                log.warning("archive_dir is set but pyarrow is not installed, cold archive disabled")
+        self.sched = None
+        self.codec = None
+        self._migrate_unsent_data()
 
+    def aggData(self, msg):
+        self.window.add(msg)
+        self.rollups.add(msg)
+
+    def _fieldAvg(self, device_id, param, acc):
+        if not acc.numeric():
+            return acc.last
+        avg_val = acc.mean()
+        if math.isnan(avg_val):
+            logger.error(f"NaN value detected for device {device_id} on parameter {param}")
+            return None
+        return round(avg_val, 2)
+
+    def getAvg(self, device_id, window):
+        self.avg_data[str(device_id)] = {"local_date": set_localdate()}
+        device_acc = window.get(str(device_id))
+        if device_acc is None:
+            return
+
+        if device_acc.type is not None:
+            self.avg_data[str(device_id)]["type"] = device_acc.type
+        for param, acc in device_acc.fields.items():
+            if isinstance(acc, dict):
+                self.avg_data[str(device_id)][param] = {k: self._fieldAvg(device_id, f"{param}.{k}", a) for k, a in acc.items()}
+            else:
+                self.avg_data[str(device_id)][param] = self._fieldAvg(device_id, param, acc)
+
+    def _migrate_unsent_data(self):
+        # One-time import of the old unsent_data.json backlog into the local store
         if not os.path.exists(unsent_json_path):
-            with open(unsent_json_path, 'w') as f:
-                json.dump([], f)
+            return
+        try:
+            with open(unsent_json_path, "r") as f:
+                unsent_data = json.load(f)
+        except json.JSONDecodeError:
+            log.error("Error decoding unsent_data.json, leaving it in place.")
+            return
 
-    def aggData(self, msg):
-        self.data_queue.append(msg)
+        for report in unsent_data:
+            self.storage.save_window(report)
+        if not self.storage.flush(timeout=10):
+            log.warning("Local store unavailable, unsent_data.json kept until the next start")
+            return
+        os.replace(unsent_json_path, unsent_json_path + ".migrated")
+        log.info("Migrated %d unsent reports into the local store", len(unsent_data))
+
+    def _group_backlog(self, rows):
+        # Rows of one report window share a timestamp and are contiguous in seq order
+        reports = []
+        for seq, timestamp, device_id, data in rows:
+            ts = int(timestamp.timestamp())
+            if not reports or reports[-1][1]["timestamp"] != ts:
+                reports.append([seq, {"timestamp": ts}])
+            reports[-1][0] = seq
+            reports[-1][1][device_id] = data
+        if len(rows) >= UPLINK_BATCH_ROWS and len(reports) > 1:
+            # The last window may continue past the row limit
+            reports.pop()
+        return reports
+
+    def _next_batch(self, cursor):
+        reports = self._group_backlog(self.storage.fetch_backlog(cursor, UPLINK_BATCH_ROWS))
+        batch = []
+        size = 0
+        last_seq = cursor
+        for seq, report in reports:
+            report_size = len(json.dumps(report))
+            if batch and size + report_size > UPLINK_BATCH_BYTES:
+                break
+            batch.append(report)
+            size += report_size
+            last_seq = seq
+        return batch, last_seq, size
+
+    def _uplinkLane(self, batch):
+        # Windows from the last couple of report periods are live reports, anything older is replay
+        fresh_after = time.time() - 2 * max(self.report_period, UPLINK_RETRY_PERIOD)
+        return priority_scheduler.REPORTS if batch[0]["timestamp"] >= fresh_after else priority_scheduler.BACKLOG
+
+    def _postBatch(self, batch):
+        codec = self.codec
+        if codec is None:
+            return http_client.shared_client.post("reports", batch)
+
+        body, commit_state = codec.encode(batch)
+        if codec.needsDictionary():
+            dictionary = codec.dictionary.payload()
+            response = http_client.shared_client.post("report_dictionary", dictionary)
+            if response.status_code != 200:
+                return response
+            codec.dictionaryAcked(dictionary["version"])
+        response = http_client.shared_client.post_bytes("reports_compact", body, compact_codec.CONTENT_TYPE)
+        if response.status_code == 200:
+            codec.commit(commit_state)
+        elif response.status_code == 409:
+            # Server no longer has our delta base; the next batch starts with a keyframe
+            codec.reset()
+        return response
+
+    def _quarantine(self, batch, error):
+        logging.error(f"Unable to encode {len(batch)} reports up to {batch[-1]['timestamp']}, quarantining them: {error}")
+        try:
+            with open(path_config.path_cfg.base_path + QUARANTINE_FILE, "a") as quarantine_file:
+                quarantine_file.write(json.dumps({"error": str(error), "reports": batch}) + "\n")
+        except OSError as e:
+            logging.error(f"Unable to write report quarantine: {e}")
 
-    def getAvg(self, device_id):
-        self.avg_data[str(device_id)] = {"local_date": set_localdate()}
-        device_data = [x.get(str(device_id)) for x in self.data_queue if str(device_id) in x]
-
-        if len(device_data) > 0:
-            for param in device_data[0]:
-                if param != "type":
-                    data = [x.get(param) for x in device_data if x.get(param) is not None]
-                    if not data:
-                        continue
-                    
-                    if isinstance(data[0], (int, float)):
-                        avg_val = sum(data) / len(data)
-                        if math.isnan(avg_val):
-                            logger.error(f"NaN value detected for device {device_id} on parameter {param}")
-                            self.avg_data[str(device_id)][param] = None
-                        else:
-                            self.avg_data[str(device_id)][param] = round(avg_val, 2)
-                    else:
-                        val = data[-1]
-                        if isinstance(val, float) and math.isnan(val):
-                            logger.error(f"NaN value detected for device {device_id} on parameter {param}")
-                            self.avg_data[str(device_id)][param] = None
-                        else:
-                            self.avg_data[str(device_id)][param] = val
-                else:
-                    self.avg_data[str(device_id)]["type"] = device_data[0]["type"]
-
-    def _load_unsent_data(self):
-        with self.lock:
-            if os.path.exists(unsent_json_path):
-                with open(unsent_json_path, "r") as f:
-                    try:
-                        loaded_data = json.load(f)
-                        print(f"Loaded unsent data from file: {json.dumps(loaded_data)}")
-                        return loaded_data
-                    except json.JSONDecodeError:
-                        print("Error decoding unsent_data.json, returning empty list.")
-                        return []
-            return []
-
-    def _save_unsent_data(self, data):
-        with self.lock:
-            with open(unsent_json_path, "w") as f:
-                json.dump(data, f, indent=2)
-
-    def _append_to_unsent_data(self, new_data):
-        unsent_data = self._load_unsent_data()
-        unsent_data.append(new_data)
-        print(f"Appending new data to unsent list: {json.dumps(new_data)}")
-        self._save_unsent_data(unsent_data)
-
-    def _clear_unsent_data(self):
-        self._save_unsent_data([])
-
-    def runDataLoop(self):
-        print("-------into runDataLoop-------")
-        while not os.path.exists(path_config.path_cfg.base_path + "devices.json"):
-            time.sleep(1)
-
-        while os.path.exists(path_config.path_cfg.base_path + "devices.json"):
-            with open(path_config.path_cfg.base_path + "reports_handling/report_cfg.json") as report_cfg:
-                report_config = json.load(report_cfg)
-
-            self.report_url = report_config["report_url"]
-            self.report_period = report_config["reporting_period"]
-            self.report_type = getattr(reportType, report_config["report_type"])
-
-            self.avg_data = {}
-            for device in ctrl.device_list:
-                self.getAvg(device.device_id)
-
-            self.data_queue = []
-            self.avg_data["timestamp"] = int(time.time())
-
-            unsent_data = self._load_unsent_data()
-            print("-------json loaded-------")
-
-            if unsent_data:
-                try:
-                    response = requests.post(self.report_url, json=unsent_data, verify=False)
-                    if response.status_code == 200:
-                        print(f"Successfully sent stored offline data: {json.dumps(unsent_data)}")
-                        self._clear_unsent_data()
-                    else:
-                        print(f"Failed to send stored offline data (Status: {response.status_code})")
-                except requests.RequestException as e:
-                    print(f"Failed to send stored data: {e}")
+    def shipBacklog(self):
+        if not self.report_url:
+            return
+        try:
+            cursor = self.storage.get_cursor()
+        except Exception as e:
+            log.warning("Uplink cursor unavailable: %s", e, every=300)
+            return
 
+        while True:
+            try:
+                batch, last_seq, size = self._next_batch(cursor)
+            except Exception as e:
+                log.warning("Unable to read backlog from local store: %s", e, every=300)
+                return
+            if not batch:
+                return
             try:
-                response = requests.post(self.report_url, json=[self.avg_data], verify=False)
-                if response.status_code == 200:
-                    print(f"Successfully sent current data: {json.dumps(self.avg_data)}")
-                    
-                    # Extract the payload root timestamp safely
-                    payload_ts = self.avg_data.get("timestamp")
-                    
-                    for key, value in self.avg_data.items():
-                        if key != "timestamp":
-                            # Pass payload explicit timestamp down to local database insertion
-                            self.storage.save_device_data(key, value, payload_timestamp=payload_ts)
-                    self.storage.flush()
-                else:
-                    print(f"Failed to send current data (Status: {response.status_code}), saving for later.")
-                    self._append_to_unsent_data(self.avg_data.copy())
-            except requests.RequestException as e:
-                print(f"Failed to send current data, saving for later: {e}")
-                self._append_to_unsent_data(self.avg_data.copy())
-
-            time.sleep(self.report_period)
-
-data_handler: dataBank = None
\ No newline at end of file
+                response = priority_scheduler.shared_uplink.call(self._uplinkLane(batch), lambda: self._postBatch(batch), size)
+            except (requests.RequestException, TimeoutError) as e:
+                log.warning("Failed to send reports, will retry: %s", e, every=300)
+                return
+            except (OverflowError, ValueError, TypeError) as e:
+                # The batch cannot be encoded (e.g. an inf value); retrying would block the uplink on it forever
+                self._quarantine(batch, e)
+                self.storage.set_cursor(last_seq)
+                cursor = last_seq
+                continue
+            if response.status_code != 200:
+                log.warning("Failed to send reports (Status: %s), will retry", response.status_code, every=300)
+                return
+            self.storage.set_cursor(last_seq)
+            cursor = last_seq
+            log.debug("Uplinked %d reports up to seq %s", len(batch), last_seq)
+
+    def loadReportConfig(self):
+        with open(path_config.path_cfg.base_path + "reports_handling/report_cfg.json") as report_cfg:
+            report_config = json.load(report_cfg)
+
+        self.report_url = report_config["report_url"]
+        self.report_period = report_config["reporting_period"]
+        self.report_type = getattr(reportType, report_config["report_type"])
+        http_client.shared_client.register("reports", self.report_url, timeout=(5, 30), retries=1, gzip=True, verify=False)
+        self.configureEncoding(report_config)
+
+    def configureEncoding(self, report_config):
+        # "uplink_encoding": "msgpack" switches to the compact endpoint; JSON stays the default
+        if report_config.get("uplink_encoding", "json") != "msgpack":
+            self.codec = None
+            return
+        if self.codec is not None:
+            return
+        if not compact_codec.available():
+            log.warning("msgpack is not installed, reports stay on JSON", every=3600)
+            return
+        http_client.shared_client.register("reports_compact", report_config["compact_report_url"], timeout=(5, 30), retries=1, verify=False)
+        http_client.shared_client.register("report_dictionary", report_config["compact_dictionary_url"], timeout=15, retries=1, verify=False)
+        self.codec = compact_codec.CompactEncoder(path_config.path_cfg.base_path + "uplink_dictionary.json")
+
+    def getReportPeriod(self):
+        return self.report_period
+
+    def runDataLoop(self, sched=None):
+        print("-------into runDataLoop-------")
+        self.loadReportConfig()
+        self.sched = sched or scheduler.shared_scheduler
+        self.sched.add_task("runDataLoop", self.reportData, period=self.getReportPeriod, align=True)
+        self.sched.add_task("ReportUplink", self.shipBacklog, period=UPLINK_RETRY_PERIOD, start_delay=5)
+        self.storage.on_commit = lambda: self.sched.wake("ReportUplink")
+        if self.archiver is not None:
+            self.sched.add_task("StorageArchive", self.archiver.run, period=ARCHIVE_PERIOD, align=True, offset=ARCHIVE_OFFSET)
+
+    def reportData(self):
+        if not self.devices_ready.is_set():
+            return
+
+        self.loadReportConfig()
+
+        window, samples = self.window.reset()
+        log.debug("Closing report window with %d samples", samples)
+        self.avg_data = {}
+        for device in ctrl.device_list:
+            self.getAvg(device.device_id, window)
+
+        self.avg_data["timestamp"] = int(time.time())
+
+        # Store first; the writer wakes the uplink task once the window is committed
+        if not self.storage.save_window(self.avg_data):
+            log.error("Report window for %s dropped, local store is backed up", self.avg_data["timestamp"], every=300)
+
+data_handler: dataBank = None
@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+import logging
+
+from utils import fastlog
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = fastlog.getLogger("compact_codec")
+
+CONTENT_TYPE = "application/x-msgpack"
+DEFAULT_SCALE = 100
+KEYFRAME_INTERVAL = 60
+# Finer quantization for cumulative energy so per-window deltas stay exact
+FIELD_SCALES = {
+    "total_energy": 1000,
+    "today_energy": 1000,
+    "import_energy": 1000,
+    "export_energy": 1000,
+    "power_factor": 1000,
+}
+
+def available():
+    return msgpack is not None
+
+def flattenReport(device_data):
+    # Nested mppt/string dicts become "mppt.mppt1_voltage" so every leaf gets one field id
+    for param, value in device_data.items():
+        if isinstance(value, dict):
+            for key, nested_value in value.items():
+                yield f"{param}.{key}", nested_value
+        else:
+            yield param, value
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class FieldDictionary:
+    """Append-only field name -> (id, scale) map; the version bumps whenever a field is added."""
+
+    def __init__(self, path):
+        self.path = path
+        self.version = 0
+        self.acked_version = -1
+        self.fields = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as dict_file:
+                saved = json.load(dict_file)
+            self.version = saved["version"]
+            self.acked_version = saved.get("acked_version", -1)
+            self.fields = {name: tuple(entry) for name, entry in saved["fields"].items()}
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, KeyError) as e:
+            logging.error(f"Corrupt uplink dictionary {self.path}, starting a new one: {e}")
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as dict_file:
+            json.dump({"version": self.version, "acked_version": self.acked_version,
+                       "fields": {name: list(entry) for name, entry in self.fields.items()}}, dict_file)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, name):
+        entry = self.fields.get(name)
+        if entry is None:
+            entry = (len(self.fields), FIELD_SCALES.get(name, DEFAULT_SCALE))
+            self.fields[name] = entry
+            self.version += 1
+        return entry
+
+    def payload(self):
+        return {"version": self.version, "fields": {name: {"id": fid, "scale": scale} for name, (fid, scale) in self.fields.items()}}
+
+class CompactEncoder:
+    """MessagePack report batches: integer field ids, quantized values, deltas against the last acked window.
+
+    Batch layout: {"v": dictionary version, "b": base window timestamp or None,
+                   "r": [{"t": timestamp, "k": keyframe, "d": {device_id: {field_id: value}}}]}
+    In delta windows numeric values are quantized differences, unchanged fields are omitted and
+    removed fields are sent as None. The base only moves when the server acknowledges a batch.
+    """
+
+    def __init__(self, dictionary_path, keyframe_interval=KEYFRAME_INTERVAL):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed")
+        self.dictionary = FieldDictionary(dictionary_path)
+        self.keyframe_interval = keyframe_interval
+        self.lock = threading.Lock()
+        self.base = None
+        self.base_ts = None
+        self.since_keyframe = 0
+
+    def _quantize(self, device_data):
+        state = {}
+        for name, value in flattenReport(device_data):
+            if value is None:
+                continue
+            fid, scale = self.dictionary.lookup(name)
+            state[fid] = round(value * scale) if isNumber(value) and value == value else value
+        return state
+
+    def _diff(self, prev, cur):
+        out = {}
+        for fid, value in cur.items():
+            old = prev.get(fid)
+            if type(value) is int and type(old) is int:
+                if value != old:
+                    out[fid] = value - old
+            elif value != old or fid not in prev:
+                out[fid] = value
+        for fid in prev:
+            if fid not in cur:
+                out[fid] = None
+        return out
+
+    def encode(self, reports):
+        """Returns (body, commit_state); pass commit_state to commit() once the server accepts the batch."""
+        with self.lock:
+            base, base_ts, since_keyframe = self.base, self.base_ts, self.since_keyframe
+            dict_version = self.dictionary.version
+            windows = []
+            prev = base
+            for report in reports:
+                state = {str(dev): self._quantize(data) for dev, data in report.items() if dev != "timestamp" and isinstance(data, dict)}
+                keyframe = prev is None or since_keyframe >= self.keyframe_interval
+                if keyframe:
+                    devices = state
+                    since_keyframe = 0
+                else:
+                    devices = {dev: self._diff(prev.get(dev, {}), values) for dev, values in state.items()}
+                    devices = {dev: values for dev, values in devices.items() if values or dev not in prev}
+                    since_keyframe += 1
+                windows.append({"t": report.get("timestamp"), "k": keyframe, "d": devices})
+                prev = state
+            if self.dictionary.version != dict_version:
+                self.dictionary.save()
+            body = msgpack.packb({"v": self.dictionary.version, "b": base_ts, "r": windows}, use_bin_type=True)
+            last_ts = reports[-1].get("timestamp") if reports else base_ts
+        return body, (prev, last_ts, since_keyframe)
+
+    def commit(self, commit_state):
+        with self.lock:
+            self.base, self.base_ts, self.since_keyframe = commit_state
+
+    def reset(self):
+        # Next batch starts from a keyframe, e.g. after the server lost its base window
+        with self.lock:
+            self.base = None
+            self.base_ts = None
+
+    def needsDictionary(self):
+        return self.dictionary.acked_version != self.dictionary.version
+
+    def dictionaryAcked(self, version):
+        with self.lock:
+            self.dictionary.acked_version = version
+            self.dictionary.save()
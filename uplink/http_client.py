@@ -0,0 +1,129 @@
+import gzip
+import json
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import fastlog
+
+log = fastlog.getLogger("http_client")
+
+DEFAULT_TIMEOUT = (5, 15)
+GZIP_MIN_BYTES = 1024
+RETRY_STATUS = (502, 503, 504)
+GZIP_REJECT_STATUS = (400, 415)
+BUDGET_WINDOW = 60
+
+class Endpoint:
+    def __init__(self, name, url, timeout=DEFAULT_TIMEOUT, retries=2, retry_budget=10, backoff=1.0, gzip=False, verify=True):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self.backoff = backoff
+        self.gzip = gzip
+        self.verify = verify
+        self.requests = 0
+        self.failures = 0
+        self.retried = 0
+        self.bytes_raw = 0
+        self.bytes_sent = 0
+        self._budget_used = 0
+        self._budget_start = time.monotonic()
+
+    def takeRetry(self):
+        # Caps retries per minute so an unreachable server does not multiply uplink traffic
+        now = time.monotonic()
+        if now - self._budget_start >= BUDGET_WINDOW:
+            self._budget_start = now
+            self._budget_used = 0
+        if self._budget_used >= self.retry_budget:
+            return False
+        self._budget_used += 1
+        return True
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "retried": self.retried,
+            "bytes_raw": self.bytes_raw,
+            "bytes_sent": self.bytes_sent,
+        }
+
+class UplinkClient:
+    """One pooled keep-alive session shared by every cloud reporter, with per-endpoint policies."""
+
+    def __init__(self, pool_size=4):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, url, **policy):
+        with self.lock:
+            # Re-registering only follows URL changes; policy and learned gzip support are kept
+            endpoint = self.endpoints.get(name)
+            if endpoint is None:
+                endpoint = Endpoint(name, url, **policy)
+                self.endpoints[name] = endpoint
+            else:
+                endpoint.url = url
+        return endpoint
+
+    def _encode(self, endpoint, raw_body, content_type):
+        body = raw_body
+        headers = {"Content-Type": content_type}
+        raw_size = len(body)
+        if endpoint.gzip and raw_size >= GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers, raw_size
+
+    def _send(self, endpoint, body, headers):
+        return self.session.post(endpoint.url, data=body, headers=headers, timeout=endpoint.timeout, verify=endpoint.verify)
+
+    def post(self, name, payload):
+        return self.post_bytes(name, json.dumps(payload, separators=(",", ":")).encode(), "application/json")
+
+    def post_bytes(self, name, raw_body, content_type):
+        endpoint = self.endpoints[name]
+        body, headers, raw_size = self._encode(endpoint, raw_body, content_type)
+        attempt = 0
+        while True:
+            endpoint.requests += 1
+            endpoint.bytes_raw += raw_size
+            endpoint.bytes_sent += len(body)
+            try:
+                response = self._send(endpoint, body, headers)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                endpoint.failures += 1
+                if attempt >= endpoint.retries or not endpoint.takeRetry():
+                    raise
+                log.debug("%s: %s, retrying", name, e)
+            else:
+                if response.status_code in GZIP_REJECT_STATUS and "Content-Encoding" in headers:
+                    log.warning("%s rejected a gzip body (Status: %s), sending uncompressed from now on", name, response.status_code)
+                    endpoint.gzip = False
+                    body, headers, raw_size = self._encode(endpoint, raw_body, content_type)
+                    continue
+                if response.status_code not in RETRY_STATUS or attempt >= endpoint.retries or not endpoint.takeRetry():
+                    if response.status_code >= 400:
+                        endpoint.failures += 1
+                    return response
+                endpoint.failures += 1
+                log.debug("%s: status %s, retrying", name, response.status_code)
+            attempt += 1
+            endpoint.retried += 1
+            time.sleep(endpoint.backoff * 2 ** (attempt - 1))
+
+    def stats(self):
+        with self.lock:
+            return {name: endpoint.stats() for name, endpoint in self.endpoints.items()}
+
+shared_client = UplinkClient()
@@ -0,0 +1,232 @@
+import collections
+import json
+import os
+import threading
+import time
+import logging
+
+from utils import fastlog
+from uplink import http_client
+
+log = fastlog.getLogger("priority_scheduler")
+
+ALERTS = "alerts"
+STATUS = "status"
+LIVE = "live"
+REPORTS = "reports"
+BACKLOG = "backlog"
+# Highest priority first; alerts are strict priority, the other lanes split the link by share
+LANES = (ALERTS, STATUS, LIVE, REPORTS, BACKLOG)
+DEFAULT_SHARES = {STATUS: 0.15, LIVE: 0.25, REPORTS: 0.4, BACKLOG: 0.2}
+QUANTUM_BYTES = 64 * 1024
+MAX_BACKOFF = 300
+MAX_LANE_JOBS = 1000
+MAX_DURABLE_ALERTS = 5000
+# Client errors that will not go away on retry; the alert is dropped instead of blocking the lane
+RETRYABLE_CLIENT_STATUS = (408, 429)
+
+class _Job:
+    __slots__ = ("func", "size", "retry", "entry", "attempts", "next_try", "result", "error", "cancelled", "done")
+
+    def __init__(self, func, size, retry=False, entry=None):
+        self.func = func
+        self.size = size
+        self.retry = retry
+        self.entry = entry
+        self.attempts = 0
+        self.next_try = 0.0
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+class _Lane:
+    def __init__(self, name, share):
+        self.name = name
+        self.share = share
+        self.jobs = collections.deque()
+        self.deficit = 0.0
+        self.sent_jobs = 0
+        self.sent_bytes = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def due(self, now):
+        return bool(self.jobs) and self.jobs[0].next_try <= now
+
+    def stats(self):
+        return {
+            "queued": len(self.jobs),
+            "sent_jobs": self.sent_jobs,
+            "sent_bytes": self.sent_bytes,
+            "failures": self.failures,
+            "dropped": self.dropped,
+        }
+
+class UplinkScheduler:
+    """Single sender for every cloud POST, so bulk uploads cannot starve alerts.
+
+    Alerts go first whenever one is due; status, live, reports and backlog share the remaining
+    link by deficit round robin over bytes, in that order. A request in flight is never cut
+    short, so bulk senders keep each job bounded (report batches are capped by size) and an
+    alert waits for at most one of them. The alert lane is persisted and retried until accepted.
+    """
+
+    def __init__(self, shares=None):
+        shares = dict(DEFAULT_SHARES, **(shares or {}))
+        self.lanes = {name: _Lane(name, shares.get(name, 0.0)) for name in LANES}
+        self.cond = threading.Condition()
+        self.alert_path = None
+        self._thread = None
+
+    def enableDurableAlerts(self, path):
+        # Alerts queued before a restart are replayed ahead of anything new
+        self.alert_path = path
+        try:
+            with open(path) as alert_file:
+                entries = json.load(alert_file)
+        except FileNotFoundError:
+            entries = []
+        except json.JSONDecodeError:
+            logging.error(f"Corrupt alert queue {path}, starting empty")
+            entries = []
+        with self.cond:
+            lane = self.lanes[ALERTS]
+            for entry in reversed(entries):
+                lane.jobs.appendleft(self._alertJob(entry))
+            self.cond.notify()
+
+    def _saveAlerts(self):
+        if self.alert_path is None:
+            return
+        entries = [job.entry for job in self.lanes[ALERTS].jobs if job.entry is not None]
+        tmp_path = self.alert_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as alert_file:
+                json.dump(entries, alert_file)
+            os.replace(tmp_path, self.alert_path)
+        except OSError as e:
+            log.error("Unable to persist alert queue: %s", e, every=60)
+
+    def _postEntry(self, entry):
+        response = http_client.shared_client.post(entry["endpoint"], entry["payload"])
+        if response.status_code < 400:
+            return True
+        if response.status_code < 500 and response.status_code not in RETRYABLE_CLIENT_STATUS:
+            logging.error(f"{entry['endpoint']} rejected alert (Status: {response.status_code}), dropping it")
+            return True
+        log.warning("%s returned %s, will retry", entry["endpoint"], response.status_code, every=60)
+        return False
+
+    def _alertJob(self, entry):
+        return _Job(lambda: self._postEntry(entry), len(json.dumps(entry["payload"])), retry=True, entry=entry)
+
+    def _enqueue(self, lane_name, job):
+        if self._thread is None:
+            self.start()
+        with self.cond:
+            lane = self.lanes[lane_name]
+            limit = MAX_DURABLE_ALERTS if lane_name == ALERTS else MAX_LANE_JOBS
+            if len(lane.jobs) >= limit:
+                dropped = lane.jobs.popleft()
+                lane.dropped += 1
+                dropped.cancelled = True
+                dropped.done.set()
+                log.error("Uplink lane %s full, dropped its oldest job", lane_name, every=60)
+            lane.jobs.append(job)
+            if job.entry is not None:
+                self._saveAlerts()
+            self.cond.notify()
+        return job
+
+    def submit(self, lane, func, size=0, retry=False):
+        """Queues func() to run on the sender; with retry, a falsy result or an exception is retried with backoff."""
+        return self._enqueue(lane, _Job(func, size, retry=retry))
+
+    def call(self, lane, func, size=0, timeout=None):
+        """Runs func() on the sender in lane order and returns its result, re-raising its exception."""
+        job = self._enqueue(lane, _Job(func, size))
+        if not job.done.wait(timeout):
+            job.cancelled = True
+            raise TimeoutError(f"uplink lane {lane} busy")
+        if job.cancelled:
+            raise TimeoutError(f"uplink lane {lane} dropped the request")
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def postAlert(self, endpoint, payload):
+        """Durable POST on the alert lane: kept on disk and retried until the endpoint accepts it."""
+        return self._enqueue(ALERTS, self._alertJob({"endpoint": endpoint, "payload": payload}))
+
+    def _pick(self):
+        # Called with cond held; returns (lane, job) or (None, seconds to wait)
+        now = time.monotonic()
+        alerts = self.lanes[ALERTS]
+        if alerts.due(now):
+            return alerts, alerts.jobs.popleft()
+        due = [self.lanes[name] for name in LANES[1:] if self.lanes[name].due(now)]
+        for lane in self.lanes.values():
+            if not lane.jobs:
+                lane.deficit = 0.0
+        if due:
+            while True:
+                for lane in due:
+                    if lane.deficit >= 0:
+                        return lane, lane.jobs.popleft()
+                if all(lane.share <= 0 for lane in due):
+                    return due[0], due[0].jobs.popleft()
+                for lane in due:
+                    lane.deficit = min(lane.deficit + lane.share * QUANTUM_BYTES, lane.share * QUANTUM_BYTES)
+        waits = [lane.jobs[0].next_try - now for lane in self.lanes.values() if lane.jobs]
+        return None, min(waits) if waits else None
+
+    def _run(self, lane, job):
+        try:
+            job.result = job.func()
+            ok = bool(job.result)
+        except Exception as e:
+            job.error = e
+            ok = False
+            if not job.retry:
+                log.warning("Uplink %s job failed: %s", lane.name, e, every=60)
+        with self.cond:
+            lane.deficit -= job.size
+            lane.sent_jobs += 1
+            lane.sent_bytes += job.size
+            if not ok:
+                lane.failures += 1
+            if job.retry and not ok:
+                job.attempts += 1
+                job.error = None
+                job.next_try = time.monotonic() + min(MAX_BACKOFF, 2 ** job.attempts)
+                # Head of its lane again so alerts keep their order
+                lane.jobs.appendleft(job)
+                return
+            if job.entry is not None:
+                self._saveAlerts()
+        job.done.set()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    lane, job = self._pick()
+                    if lane is not None:
+                        if job.cancelled:
+                            continue
+                        break
+                    self.cond.wait(job)
+            self._run(lane, job)
+
+    def start(self):
+        with self.cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="UplinkScheduler", daemon=True)
+                self._thread.start()
+
+    def stats(self):
+        with self.cond:
+            return {name: lane.stats() for name, lane in self.lanes.items()}
+
+shared_uplink = UplinkScheduler()
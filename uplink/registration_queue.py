@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+import logging
+import requests
+
+from utils import fastlog
+from uplink import http_client
+from uplink import priority_scheduler
+
+log = fastlog.getLogger("registration_queue")
+
+MAX_BACKOFF = 300
+REQUEST_TIMEOUT = 15
+
+class RegistrationQueue:
+    """Cloud registration POSTs persisted to disk and retried with backoff off the boot path."""
+
+    def __init__(self, queue_path):
+        self.queue_path = queue_path
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.handlers = {}
+        self.entries = self._load()
+        self._thread = None
+
+    def _load(self):
+        try:
+            with open(self.queue_path) as queue_file:
+                return json.load(queue_file)
+        except FileNotFoundError:
+            return []
+        except json.JSONDecodeError:
+            logging.error(f"Corrupt registration queue {self.queue_path}, starting empty")
+            return []
+
+    def _save(self):
+        tmp_path = self.queue_path + ".tmp"
+        with open(tmp_path, "w") as queue_file:
+            json.dump(self.entries, queue_file)
+        os.replace(tmp_path, self.queue_path)
+
+    def register_handler(self, kind, on_success):
+        self.handlers[kind] = on_success
+
+    def enqueue(self, kind, url, payload):
+        # One pending entry per kind; a newer payload replaces the queued one
+        entry = {"kind": kind, "url": url, "payload": payload, "attempts": 0, "next_try": 0}
+        with self.lock:
+            self.entries = [e for e in self.entries if e["kind"] != kind]
+            self.entries.append(entry)
+            self._save()
+        self.wakeup.set()
+
+    def pending(self):
+        with self.lock:
+            return [e["kind"] for e in self.entries]
+
+    def _post(self, entry):
+        # The queue does its own backoff, so the shared client must not retry on top of it
+        http_client.shared_client.register(entry["kind"], entry["url"], timeout=REQUEST_TIMEOUT, retries=0, verify=False)
+        response = priority_scheduler.shared_uplink.call(
+            priority_scheduler.STATUS, lambda: http_client.shared_client.post(entry["kind"], entry["payload"]))
+        log.info("%s response status: %s", entry["kind"], response.status_code)
+        log.debug("%s response body: %s", entry["kind"], response.text)
+        return response
+
+    def _process_due(self):
+        now = time.time()
+        with self.lock:
+            due = [e for e in self.entries if e["next_try"] <= now]
+        for entry in due:
+            # Anything raised for one entry is retried later instead of ending the queue thread
+            try:
+                response = self._post(entry)
+                ok = response.status_code in (200, 201)
+                rejected = (not ok and 400 <= response.status_code < 500
+                            and response.status_code not in priority_scheduler.RETRYABLE_CLIENT_STATUS)
+            except (requests.RequestException, TimeoutError) as e:
+                log.warning("%s failed: %s", entry["kind"], e, every=60, key=entry["kind"])
+                response = None
+                ok = rejected = False
+            except Exception as e:
+                logging.error(f"{entry['kind']} post failed: {e}", exc_info=True)
+                response = None
+                ok = rejected = False
+
+            if rejected:
+                logging.error(f"{entry['kind']} rejected (Status: {response.status_code}), dropping it: {response.text[:200]}")
+
+            with self.lock:
+                if ok or rejected:
+                    self.entries = [e for e in self.entries if e is not entry]
+                elif entry in self.entries:
+                    entry["attempts"] += 1
+                    entry["next_try"] = time.time() + min(MAX_BACKOFF, 2 ** entry["attempts"])
+                try:
+                    self._save()
+                except OSError as e:
+                    log.error("Unable to persist registration queue: %s", e, every=60)
+
+            if ok and entry["kind"] in self.handlers:
+                try:
+                    self.handlers[entry["kind"]](response)
+                except Exception as e:
+                    logging.error(f"Registration handler for {entry['kind']} failed: {e}")
+
+    def _next_wait(self):
+        with self.lock:
+            if not self.entries:
+                return None
+            return max(0.0, min(e["next_try"] for e in self.entries) - time.time())
+
+    def _loop(self):
+        while True:
+            try:
+                self._process_due()
+            except Exception as e:
+                logging.error(f"Registration queue pass failed: {e}", exc_info=True)
+            self.wakeup.wait(self._next_wait())
+            self.wakeup.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="RegistrationQueue", daemon=True)
+            self._thread.start()
@@ -0,0 +1,171 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import logging
+
+from utils import fastlog
+
+log = fastlog.getLogger("config_watcher")
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+POLL_INTERVAL = 1.0
+
+class ConfigWatcher:
+    """Sets a threading.Event per watched file while it exists; inotify on Linux, stat polling otherwise."""
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.events = {}
+        self.callbacks = {}
+        self.dir_watches = {}
+        self.fd = None
+        self._libc = None
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._pipe_r, self._pipe_w = os.pipe()
+
+    def _init_inotify(self):
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = self._libc.inotify_init1(IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            self.fd = fd
+            return True
+        except (OSError, AttributeError, TypeError) as e:
+            log.warning("inotify unavailable, falling back to polling: %s", e)
+            self.fd = None
+            return False
+
+    def _add_dir_watch(self, directory):
+        if self.fd is None or directory in self.dir_watches.values():
+            return True
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            log.warning("Cannot watch %s (errno %s), polling it instead", directory, ctypes.get_errno(), every=300)
+            return False
+        self.dir_watches[wd] = directory
+        return True
+
+    def watch(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            event = self.events.get(path)
+            if event is None:
+                event = threading.Event()
+                self.events[path] = event
+                if self.fd is not None and not self._add_dir_watch(os.path.dirname(path)):
+                    self._wake()
+            self._refresh(path)
+        return event
+
+    def on_present(self, path, callback):
+        path = os.path.abspath(path)
+        event = self.watch(path)
+        with self.lock:
+            self.callbacks.setdefault(path, []).append(callback)
+        if event.is_set():
+            self._fire(path)
+
+    def _wake(self):
+        self._wakeup.set()
+        os.write(self._pipe_w, b"\0")
+
+    def wait_for(self, path, timeout=None):
+        return self.watch(path).wait(timeout)
+
+    def _refresh(self, path):
+        event = self.events[path]
+        if os.path.exists(path):
+            if not event.is_set():
+                event.set()
+                log.info("Configuration file present: %s", path)
+                return True
+        elif event.is_set():
+            event.clear()
+            log.info("Configuration file removed: %s", path)
+        return False
+
+    def _fire(self, path):
+        with self.lock:
+            callbacks = self.callbacks.pop(path, [])
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"Config watcher callback for {path} failed: {e}", exc_info=True)
+
+    def _refresh_dir(self, directory):
+        appeared = []
+        with self.lock:
+            for path in self.events:
+                if os.path.dirname(path) == directory and self._refresh(path):
+                    appeared.append(path)
+        for path in appeared:
+            self._fire(path)
+
+    def _unwatched_dirs(self):
+        with self.lock:
+            watched = set(self.dir_watches.values())
+            return {os.path.dirname(p) for p in self.events if os.path.dirname(p) not in watched}
+
+    def _loop(self):
+        while True:
+            polled = self._unwatched_dirs() if self.fd is not None else {os.path.dirname(p) for p in list(self.events)}
+            if self.fd is None:
+                for directory in polled:
+                    self._refresh_dir(directory)
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            # Directories that do not exist yet are polled until inotify can take over
+            for directory in polled:
+                with self.lock:
+                    self._add_dir_watch(directory)
+                self._refresh_dir(directory)
+            timeout = self.poll_interval if self._unwatched_dirs() else None
+            readable, _, _ = select.select([self.fd, self._pipe_r], [], [], timeout)
+            if self._pipe_r in readable:
+                os.read(self._pipe_r, 64)
+            if self.fd not in readable:
+                continue
+            buf = os.read(self.fd, 4096)
+            offset = 0
+            changed = set()
+            while offset + EVENT_HEADER.size <= len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size + length
+                directory = self.dir_watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_DELETE_SELF:
+                    with self.lock:
+                        self.dir_watches.pop(wd, None)
+                changed.add(directory)
+            for directory in changed:
+                self._refresh_dir(directory)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._init_inotify()
+        with self.lock:
+            for path in self.events:
+                self._add_dir_watch(os.path.dirname(path))
+        self._thread = threading.Thread(target=self._loop, name="ConfigWatcher", daemon=True)
+        self._thread.start()
+
+shared_watcher = ConfigWatcher()
@@ -0,0 +1,153 @@
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+
+LOG_LEVEL_ENV = "EDGE_LOG_LEVEL"
+TRACE_SIZE_ENV = "EDGE_TRACE_SIZE"
+DEFAULT_TRACE_SIZE = 2000
+TRACE_DUMP_PATH = "debug_trace.log"
+TRACE_ENTRY_MAX = 500
+
+class lazyJson:
+    """Defers json.dumps until the record is actually formatted."""
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        try:
+            return json.dumps(self.obj)
+        except (TypeError, ValueError):
+            return repr(self.obj)
+
+class TraceRing:
+    """Last DEBUG records, kept even when DEBUG is not logged; off unless EDGE_TRACE_SIZE is set."""
+
+    def __init__(self, size=DEFAULT_TRACE_SIZE):
+        self.enabled = False
+        self._entries = collections.deque(maxlen=size)
+
+    def resize(self, size):
+        self._entries = collections.deque(self._entries.copy(), maxlen=size)
+
+    def append(self, name, level, msg, args):
+        # Formatted and capped here, so the ring never keeps a payload alive or sees it change later
+        try:
+            text = msg % args if args else msg
+        except Exception as e:
+            text = f"{msg} {args!r} (format error: {e})"
+        if len(text) > TRACE_ENTRY_MAX:
+            text = text[:TRACE_ENTRY_MAX] + "..."
+        self._entries.append((time.time(), threading.current_thread().name, name, level, text))
+
+    def clear(self):
+        self._entries.clear()
+
+    def lines(self):
+        out = []
+        for ts, thread_name, name, level, text in self._entries.copy():
+            stamp = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            out.append(f"{stamp} - {thread_name} - {name} - {logging.getLevelName(level)} - {text}")
+        return out
+
+    def dump(self, path=TRACE_DUMP_PATH):
+        lines = self.lines()
+        with open(path, "w") as trace_file:
+            trace_file.write("\n".join(lines) + "\n")
+        return len(lines)
+
+trace_ring = TraceRing()
+
+class FastLogger:
+    def __init__(self, name):
+        self.name = name
+        self.logger = logging.getLogger("edge." + name)
+        self._site_lock = threading.Lock()
+        self._last_emit = {}
+        self._suppressed = {}
+
+    def _allow(self, every, key=None):
+        # Limited per call site, and per key within it so one device cannot hide another
+        site = sys._getframe(3)
+        key = (site.f_code, site.f_lineno, key)
+        now = time.monotonic()
+        with self._site_lock:
+            last = self._last_emit.get(key)
+            if last is not None and now - last < every:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return False, 0
+            self._last_emit[key] = now
+            return True, self._suppressed.pop(key, 0)
+
+    def _log(self, level, msg, args, every, key=None):
+        enabled = self.logger.isEnabledFor(level)
+        if level == logging.DEBUG and trace_ring.enabled:
+            trace_ring.append(self.name, level, msg, args)
+        if not enabled:
+            return
+        if every:
+            allowed, suppressed = self._allow(every, key)
+            if not allowed:
+                return
+            if suppressed:
+                msg = msg + " (%d similar suppressed)"
+                args = args + (suppressed,)
+        self.logger.log(level, msg, *args, stacklevel=3)
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level) or (level == logging.DEBUG and trace_ring.enabled)
+
+    def debug(self, msg, *args, every=None, key=None):
+        self._log(logging.DEBUG, msg, args, every, key)
+
+    def info(self, msg, *args, every=None, key=None):
+        self._log(logging.INFO, msg, args, every, key)
+
+    def warning(self, msg, *args, every=None, key=None):
+        self._log(logging.WARNING, msg, args, every, key)
+
+    def error(self, msg, *args, every=None, key=None):
+        self._log(logging.ERROR, msg, args, every, key)
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+def getLogger(name):
+    with _loggers_lock:
+        if name not in _loggers:
+            _loggers[name] = FastLogger(name)
+        return _loggers[name]
+
+def configure(level=None, trace_size=None, stream=True):
+    level = level or os.environ.get(LOG_LEVEL_ENV, "WARNING")
+    edge_logger = logging.getLogger("edge")
+    edge_logger.setLevel(level if isinstance(level, int) else level.upper())
+    if stream and not edge_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(threadName)s - %(name)s - %(levelname)s - %(message)s"))
+        edge_logger.addHandler(handler)
+        edge_logger.propagate = False
+    trace_size = trace_size or os.environ.get(TRACE_SIZE_ENV)
+    if trace_size is not None:
+        size = int(trace_size)
+        trace_ring.enabled = size > 0
+        if size > 0:
+            trace_ring.resize(size)
+
+def dumpTrace(path=TRACE_DUMP_PATH):
+    count = trace_ring.dump(path)
+    logging.getLogger("edge").warning(f"Dumped {count} debug trace entries to {path}")
+    return count
+
+def installDumpSignal(path=TRACE_DUMP_PATH, signum=getattr(signal, "SIGUSR1", None)):
+    # kill -USR1 <pid> writes the ring buffer without restarting the service
+    if signum is None:
+        return
+    signal.signal(signum, lambda sig, frame: dumpTrace(path))
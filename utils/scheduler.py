@@ -0,0 +1,239 @@
+import math
+import threading
+import time
+import logging
+
+from utils import fastlog
+
+log = fastlog.getLogger("scheduler")
+
+DEFAULT_TICK = 0.1
+DEFAULT_WHEEL_SIZE = 512
+# Used when a callable period fails before it ever returned a value
+FALLBACK_PERIOD = 60.0
+
+class PeriodicTask:
+    def __init__(self, name, func, period, align=False, offset=0.0):
+        self.name = name
+        self.func = func
+        self.period = period
+        self.align = align
+        self.offset = offset
+        self.deadline = 0.0
+        self.target_tick = 0
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.max_lateness = 0.0
+        self.busy = False
+        self.removed = False
+        self.last_period = None
+        self._pending = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def getPeriod(self):
+        # A callable period that fails (e.g. a half-written config file) keeps the last good period
+        try:
+            period = max(float(self.period() if callable(self.period) else self.period), DEFAULT_TICK)
+        except Exception as e:
+            period = self.last_period if self.last_period is not None else FALLBACK_PERIOD
+            log.error("Task %s period unavailable, using %ss: %s", self.name, period, e, every=60, key=self.name)
+            return period
+        self.last_period = period
+        return period
+
+    def firstDeadline(self, now, start_delay=0.0):
+        if self.align:
+            return self.alignedDeadline(now + start_delay)
+        return now + start_delay
+
+    def alignedDeadline(self, after, guard=0.0):
+        # Map the next wall-clock boundary (e.g. hh:mm:00 for 60 s) onto the monotonic clock
+        period = self.getPeriod()
+        wall_after = time.time() + (after - time.monotonic())
+        boundary = (math.floor((wall_after + guard - self.offset) / period) + 1) * period + self.offset
+        return after + (boundary - wall_after)
+
+    def nextDeadline(self, now):
+        if self.align:
+            period = self.getPeriod()
+            nxt = self.alignedDeadline(max(now, self.deadline), guard=period / 2)
+            missed = int((now - self.deadline) // period) if now > self.deadline else 0
+        else:
+            period = self.getPeriod()
+            nxt = self.deadline + period
+            missed = 0
+            if nxt <= now:
+                missed = int((now - nxt) // period) + 1
+                nxt += missed * period
+        self.skipped += missed
+        return nxt
+
+    def trigger(self, deadline):
+        with self._cond:
+            if self.busy or self._pending is not None:
+                self.skipped += 1
+                return False
+            self._pending = deadline
+            self._cond.notify()
+            return True
+
+    def stop(self):
+        with self._cond:
+            self.removed = True
+            self._cond.notify()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self.removed:
+                    self._cond.wait()
+                if self.removed:
+                    return
+                deadline = self._pending
+                self._pending = None
+                self.busy = True
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            start = time.monotonic()
+            self.max_lateness = max(self.max_lateness, start - deadline)
+            try:
+                self.func()
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Task {self.name} crashed: {e}", exc_info=True)
+            finished = time.monotonic()
+            self.runs += 1
+            self.last_duration = finished - start
+            self.max_duration = max(self.max_duration, self.last_duration)
+            if finished > deadline + self.getPeriod():
+                self.overruns += 1
+                log.warning("Task %s overran its period (%.3fs)", self.name, self.last_duration, every=60)
+            with self._cond:
+                self.busy = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "last_duration": round(self.last_duration, 4),
+            "max_duration": round(self.max_duration, 4),
+            "max_lateness": round(self.max_lateness, 4),
+        }
+
+class PeriodicScheduler:
+    """Hashed timer wheel on the monotonic clock; each task runs on its own worker at fixed deadlines."""
+
+    def __init__(self, tick=DEFAULT_TICK, wheel_size=DEFAULT_WHEEL_SIZE):
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self.wheel = [[] for _ in range(wheel_size)]
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.origin = time.monotonic()
+        self.current_tick = 0
+        self._running = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _insert(self, task):
+        # One tick early; the worker sleeps the sub-tick remainder to hit the exact deadline
+        target = math.floor((task.deadline - self.origin) / self.tick)
+        task.target_tick = max(target, self.current_tick + 1)
+        self.wheel[task.target_tick % self.wheel_size].append(task)
+
+    def add_task(self, name, func, period, align=False, offset=0.0, start_delay=0.0):
+        task = PeriodicTask(name, func, period, align=align, offset=offset)
+        with self.lock:
+            if name in self.tasks:
+                self.tasks[name].stop()
+            task.deadline = task.firstDeadline(time.monotonic(), start_delay)
+            self.tasks[name] = task
+            self._insert(task)
+        task.start()
+        log.info("Registered task %s (period %s, align %s)", name, period, align)
+        return task
+
+    def remove_task(self, name):
+        with self.lock:
+            task = self.tasks.pop(name, None)
+        if task is not None:
+            task.stop()
+
+    def wake(self, name):
+        # Run a task now without moving its deadline grid
+        task = self.tasks.get(name)
+        if task is not None:
+            return task.trigger(time.monotonic())
+        return False
+
+    def _advance(self):
+        now = time.monotonic()
+        while self.origin + (self.current_tick + 1) * self.tick <= now:
+            self.current_tick += 1
+            slot = self.wheel[self.current_tick % self.wheel_size]
+            if not slot:
+                continue
+            due = [t for t in slot if t.target_tick <= self.current_tick]
+            if not due:
+                continue
+            slot[:] = [t for t in slot if t.target_tick > self.current_tick]
+            for task in due:
+                if task.removed:
+                    continue
+                try:
+                    task.trigger(task.deadline)
+                    task.deadline = task.nextDeadline(now)
+                except Exception as e:
+                    # One bad task must not stop the wheel for every other task
+                    task.deadline = now + (task.last_period or FALLBACK_PERIOD)
+                    logging.error(f"Scheduling task {task.name} failed: {e}", exc_info=True)
+                self._insert(task)
+
+    def _loop(self):
+        while self._running:
+            with self.lock:
+                try:
+                    self._advance()
+                except Exception as e:
+                    logging.error(f"Scheduler tick failed: {e}", exc_info=True)
+            wait = self.origin + (self.current_tick + 1) * self.tick - time.monotonic()
+            if wait > 0:
+                self._stop_event.wait(wait)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="PeriodicScheduler")
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._stop_event.set()
+        with self.lock:
+            tasks = list(self.tasks.values())
+        for task in tasks:
+            task.stop()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {name: task.stats() for name, task in self.tasks.items()}
+
+shared_scheduler = PeriodicScheduler()
@@ -0,0 +1,57 @@
+import collections
+import threading
+import time
+
+DELTA_HISTORY = 256
+
+class SiteSnapshot:
+    """Latest getAllData() result plus a short history of per-cycle deltas.
+
+    Every update replaces the changed device dicts instead of mutating them, so readers can hold
+    on to what get() returned without a lock. Subscribers follow `version`; one that falls more
+    than DELTA_HISTORY updates behind gets None from deltasSince() and has to re-read the snapshot.
+    """
+
+    def __init__(self, history=DELTA_HISTORY):
+        self.cond = threading.Condition()
+        self.version = 0
+        self.timestamp = 0.0
+        self.data = {}
+        self.deltas = collections.deque(maxlen=history)
+
+    def update(self, data, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        delta = {}
+        with self.cond:
+            current = dict(self.data)
+            for device_id, fields in data.items():
+                old = current.get(device_id, {})
+                changed = {name: value for name, value in fields.items() if name not in old or old[name] != value}
+                if changed or device_id not in current:
+                    delta[device_id] = changed
+                    current[device_id] = dict(fields)
+            self.data = current
+            self.timestamp = timestamp
+            self.version += 1
+            self.deltas.append((self.version, timestamp, delta))
+            self.cond.notify_all()
+        return delta
+
+    def get(self):
+        with self.cond:
+            return self.version, self.timestamp, self.data
+
+    def deltasSince(self, version):
+        with self.cond:
+            if version >= self.version:
+                return []
+            if not self.deltas or self.deltas[0][0] > version + 1:
+                return None
+            return [entry for entry in self.deltas if entry[0] > version]
+
+    def wait(self, version, timeout=None):
+        # True once an update newer than `version` exists
+        with self.cond:
+            return self.cond.wait_for(lambda: self.version > version, timeout)
+
+shared_snapshot = SiteSnapshot()